@@ -0,0 +1,167 @@
+"""
+Static assets (audio, grammar, scripts) served from memory.
+
+The files are read once, at startup, together with a hash of their content and, for text files,
+a gzip-compressed variant. Templates link them with static_url(), which appends the hash as
+?v=<hash>, so that the URL changes whenever the content does: responses to such URLs may be cached
+forever, while the others are revalidated with their ETag. Use as the static_handler_class of the
+application.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+import tornado.web
+
+COMPRESSED_TYPES = ('text/', 'application/xml', 'application/javascript', 'application/json')
+"""
+Prefixes of the content types of the files that are also kept gzip-compressed
+"""
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class Asset(object):
+    __slots__ = ('content', 'gzipped', 'version', 'content_type', 'modified')
+
+    def __init__(self, content, content_type, modified):
+        """
+        :param content: bytes of the file
+        :param modified: modification time of the file
+        """
+        self.content = content
+        self.content_type = content_type
+        self.modified = modified
+        self.version = hashlib.sha1(content).hexdigest()[:16]
+        self.gzipped = None
+        """
+        gzip-compressed content, None if the file is not text or does not get smaller
+        """
+        if content_type.startswith(COMPRESSED_TYPES):
+            gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(gzipped) < len(content):
+                self.gzipped = gzipped
+
+
+class AssetStore(object):
+    """
+    The files of a directory, by their path relative to it
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.assets = {}
+        self.checked = None
+        """
+        paths of the files checked for changes since the store was marked stale, None if it never was
+        """
+        for (directory, _, names) in os.walk(self.root):
+            for name in names:
+                path = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, '/')
+                self._read(path)
+
+    def mark_stale(self):
+        """
+        Makes get check the file of each asset for changes, once per asset until the next call
+        """
+        self.checked = set()
+
+    def _read(self, path):
+        """
+        Reads the file if it is new or has been modified since it was read, and forgets it if it was removed
+        """
+        full_path = os.path.abspath(os.path.join(self.root, path))
+        if not full_path.startswith(self.root + os.sep) or not os.path.isfile(full_path):
+            self.assets.pop(path, None)
+            return
+        modified = os.path.getmtime(full_path)
+        asset = self.assets.get(path)
+        if asset is None or asset.modified != modified:
+            with open(full_path, 'rb') as f:
+                content = f.read()
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            self.assets[path] = Asset(content, content_type, modified)
+
+    def get(self, path):
+        """
+        :return: Asset, None if there is no such file
+        """
+        if self.checked is not None and path not in self.checked:
+            self._read(path)
+            self.checked.add(path)
+        return self.assets.get(path)
+
+
+class StaticAssetHandler(tornado.web.RequestHandler):
+    """
+    Serves the assets of the static_path from memory, gzip-compressed if possible. In debug mode,
+    i.e. when static_hash_cache is off, Tornado calls reset before every request, which only marks
+    the stores stale: the file of an asset is checked, and read again if changed, when it is used.
+    """
+
+    stores = {}
+    """
+    AssetStore per static path
+    """
+
+    @classmethod
+    def get_store(cls, root):
+        store = cls.stores.get(root)
+        if store is None:
+            store = cls.stores[root] = AssetStore(root)
+        return store
+
+    @classmethod
+    def reset(cls):
+        for store in cls.stores.values():
+            store.mark_stale()
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        """
+        :return: URL of the asset, with the hash of its content as version, like StaticFileHandler's
+        """
+        url = settings.get('static_url_prefix', '/static/') + path
+        if include_version:
+            asset = cls.get_store(settings['static_path']).get(path)
+            if asset is not None:
+                url += '?v=' + asset.version
+        return url
+
+    def initialize(self, path, default_filename=None):
+        self.store = self.get_store(path)
+        self.asset = None
+        self.gzipped = False
+
+    def head(self, path):
+        return self.get(path, include_body=False)
+
+    def get(self, path, include_body=True):
+        self.asset = self.store.get(path)
+        if self.asset is None:
+            raise tornado.web.HTTPError(404)
+        content = self.asset.content
+        if self.asset.gzipped is not None:
+            self.set_header('Vary', 'Accept-Encoding')
+            if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+                self.gzipped = True
+                content = self.asset.gzipped
+                self.set_header('Content-Encoding', 'gzip')
+        self.set_header('Content-Type', self.asset.content_type)
+        if self.get_argument('v', None) == self.asset.version:
+            self.set_header('Cache-Control', IMMUTABLE_CACHE_CONTROL)
+        else:
+            # the URL stays the same when the content changes
+            self.set_header('Cache-Control', 'no-cache')
+        if include_body:
+            self.write(content)
+        else:
+            self.set_header('Content-Length', len(content))
+
+    def compute_etag(self):
+        # answered with 304 by finish() if the client has this version
+        if self.asset is None:
+            return None
+        return '"%s%s"' % (self.asset.version, '-gzip' if self.gzipped else '')
@@ -0,0 +1,147 @@
+"""
+Logging that does not block the IOLoop: records are put into a bounded queue and written to
+disk in batches by a background thread. If the disk cannot keep up and the queue is full,
+records are dropped and counted instead of stalling the caller.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+
+EXCEPTION_FORMATTER = logging.Formatter()
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line
+    """
+
+    EXTRA_FIELDS = ('handler', 'token', 'method', 'path', 'status', 'duration', 'gamestate')
+    """
+    Attributes copied into the JSON object if they were passed to the logger as extra
+    """
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        for field in self.EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records into a bounded queue without ever blocking. Records not fitting are dropped and counted.
+    """
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Like QueueHandler.prepare, merges the arguments into the message and drops the exception, but keeps
+        its traceback apart from the message, as exc_text, for the formatter of the writer
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = EXCEPTION_FORMATTER.formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingLogWriter(threading.Thread):
+    """
+    Background thread writing the records of a queue to a file, in batches of up to BATCH_SIZE records
+    with a single write and flush each.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, record_queue, path, formatter, queue_handler):
+        super().__init__(name='log-writer', daemon=True)
+        self.queue = record_queue
+        self.stream = open(path, 'a', encoding='utf-8')
+        self.formatter = formatter
+        self.queue_handler = queue_handler
+        self.reported_dropped = 0
+
+    def run(self):
+        stop = False
+        while not stop:
+            records = [self.queue.get()]
+            while len(records) < self.BATCH_SIZE:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(record is None for record in records)
+            self.write(records)
+
+    def write(self, records):
+        lines = [self.formatter.format(record) for record in records if record is not None]
+        dropped = self.queue_handler.dropped
+        if dropped != self.reported_dropped:
+            lines.append(self.formatter.format(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': 'Dropped %d log records, the disk cannot keep up', 'args': (dropped - self.reported_dropped,),
+            })))
+            self.reported_dropped = dropped
+        if lines:
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+
+    def stop(self):
+        """
+        Writes the records still in the queue and stops the thread
+        """
+        self.queue.put(None)
+        self.join()
+        self.stream.close()
+
+
+def log_to_file(logger, path, structured=True, max_queue_size=10000):
+    """
+    Makes the logger write its records to the file in the background
+    :param logger: logger to add the handler to
+    :param path: file to append the records to
+    :param structured: write JSON Lines if true, otherwise the classic colon separated lines
+    :param max_queue_size: maximum number of records waiting to be written; further records are dropped
+    :return: the DroppingQueueHandler added to the logger
+    """
+    if structured:
+        formatter = JSONLinesFormatter()
+    else:
+        formatter = logging.Formatter("%(created)s:%(levelname)s:%(name)s:%(module)s:%(message)s")
+    record_queue = queue.Queue(max_queue_size)
+    handler = DroppingQueueHandler(record_queue)
+    writer = BatchingLogWriter(record_queue, path, formatter, handler)
+    writer.start()
+    atexit.register(writer.stop)
+    logger.addHandler(handler)
+    return handler
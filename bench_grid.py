@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Micro-benchmark comparing the Grid implementations
+
+Times the bytearray Grid against the BitboardGrid for a game on a square board:
+  setup   creating the grid and placing one ship of every size from 2 to 5 per five rows
+  shoot   shooting a fixed pseudo-random tenth of the fields
+  sunk    checking whether all ships have been sunk
+
+Usage:
+  bench_grid.py [options]
+
+Options:
+  -h, --help                  Show this screen.
+  -s SIZES, --sizes=SIZES     Comma separated grid sizes to benchmark [default: 6,32,100]
+  -r NUMBER, --repeat=NUMBER  Number of timed repetitions, the best one is reported [default: 5]
+"""
+
+import random
+import timeit
+
+from docopt import docopt
+
+import game
+
+GRID_CLASSES = (game.Grid, game.BitboardGrid)
+
+
+def fleet_coords(grid_size):
+    fleet = []
+    for y in range(0, grid_size, 5):
+        x = 0
+        for size in range(2, 6):
+            if x + size > grid_size:
+                break
+            fleet.append([game.Coord(x + i, y) for i in range(size)])
+            x += size + 1
+    return fleet
+
+
+def setup(grid_class, grid_size, fleet):
+    grid = grid_class(grid_size)
+    for coords in fleet:
+        grid.put(game.Ship('Ship', len(coords)), coords)
+    return grid
+
+
+def shoot(grid, shots):
+    for coord in shots:
+        grid.shoot(coord)
+
+
+def best_time(function, repeat):
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def bench(grid_class, grid_size, repeat):
+    fleet = fleet_coords(grid_size)
+    fields = [game.Coord(x, y) for x in range(grid_size) for y in range(grid_size)]
+    shots = random.Random(grid_size).sample(fields, max(1, len(fields) // 10))
+
+    setup_time = best_time(lambda: setup(grid_class, grid_size, fleet), repeat)
+    shoot_time = best_time(lambda: shoot(setup(grid_class, grid_size, fleet), shots), repeat) - setup_time
+    grid = setup(grid_class, grid_size, fleet)
+    shoot(grid, shots)
+    sunk_time = best_time(grid.all_sunk, repeat)
+    return setup_time, shoot_time, sunk_time
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+    print('%6s %-14s %12s %12s %12s' % ('size', 'grid', 'setup', 'shoot', 'sunk'))
+    for grid_size in (int(size) for size in args['--sizes'].split(',')):
+        for grid_class in GRID_CLASSES:
+            times = bench(grid_class, grid_size, repeat)
+            print('%6d %-14s %10.1fus %10.1fus %10.2fus' % ((grid_size, grid_class.__name__) +
+                                                            tuple(t * 1e6 for t in times)))
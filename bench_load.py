@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""End-to-end load test of the HTTP protocol
+
+Runs the application in this process and lets simulated VoiceXML clients call it like the dialog
+does: /dialog, /log, /waitforgame until matched, /placeship for every ship, /waitforturn and /shootandwait
+until the game is over, and /quitapp. Each client plays calls one after the other until the duration
+is over; the client sides run on the same IOLoop, so that they share the CPU with the server.
+
+Reports the p50 and p99 response times per endpoint (the long-polls include the time waiting for the
+opponent), the number of games completed per second, the peak RSS of the process and the peak number
+of open connections, and the number of long-polls the server shed. With --output, the results are
+also written as JSON, e.g. to compare commits.
+
+Usage:
+  bench_load.py [options]
+
+Options:
+  -h, --help                  Show this screen.
+  -c NUMBER, --clients=NUMBER
+                              Number of simultaneous callers [default: 1000]
+  -d SECONDS, --duration=SECONDS
+                              Seconds during which new calls are started [default: 30]
+  -r SECONDS, --ramp=SECONDS  Seconds over which the clients start their first call [default: 2]
+  -t SECONDS, --think=SECONDS
+                              Mean pause of the callers before placing a ship or shooting, like people
+                              listening to the prompts and answering; no pauses if 0 [default: 0]
+  -p NUMBER, --port=NUMBER    Port to run the application on [default: 18200]
+  --max-long-polls=NUMBER     Maximum number of waiting long-polls of the server, like main.py's option;
+                              unlimited if 0 [default: 0]
+  --separate-shots            Shoot with /putcoord and wait for the turn with /waitforturn, as the dialog
+                              did before /shootandwait
+  -o FILE, --output=FILE      File to write the results to as JSON
+  --log=FILE                  Write the server's log to this file like the server does, not at all if not given
+"""
+
+import collections
+import json
+import logging
+import random
+import re
+import resource
+import subprocess
+import time
+import urllib.parse
+
+from docopt import docopt
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+
+import asynclog
+import main
+
+ATTRIBUTE = re.compile(r'(\w+)="([^"]*)"')
+TOKEN = re.compile(r"<var name=\"token\" expr=\"'(\w+)'\"/>")
+
+PERCENTILES = (50, 99)
+
+LONG_POLL_TIMEOUT_SECONDS = 8
+
+
+class DialogException(Exception):
+    """
+    Raised if the dialog has no token, e.g. because the templates are not found
+    """
+    pass
+
+
+def percentile(ordered, p):
+    return ordered[max(0, -(-p * len(ordered) // 100) - 1)]
+
+
+class LoadTest(object):
+    def __init__(self, base_url, clients, duration, ramp, think, separate_shots=False):
+        self.base_url = base_url
+        self.clients = clients
+        self.duration = duration
+        self.ramp = ramp
+        self.think = think
+        self.separate_shots = separate_shots
+        self.http_client = tornado.httpclient.AsyncHTTPClient()
+        self.latencies = collections.defaultdict(list)
+        """
+        response times in seconds per endpoint
+        """
+        self.statuses = collections.defaultdict(collections.Counter)
+        """
+        number of responses per status code per endpoint
+        """
+        self.games_completed = 0
+        self.retries = 0
+        """
+        number of responses asking to retry later, i.e. long-polls shed by the server
+        """
+        self.calls_completed = 0
+        self.deadline = None
+        self.peak_connections = 0
+        self.open_requests = 0
+        self.peak_open_requests = 0
+
+    @tornado.gen.coroutine
+    def request(self, path, method='GET', **arguments):
+        """
+        :return: tuple (status, dict of the attributes of the response element or the body if it is not XML)
+        """
+        query = urllib.parse.urlencode(arguments)
+        url = self.base_url + path
+        body = None
+        if method == 'POST':
+            body = query
+        elif query:
+            url += '?' + query
+        self.open_requests += 1
+        self.peak_open_requests = max(self.peak_open_requests, self.open_requests)
+        started = time.perf_counter()
+        try:
+            response = yield self.http_client.fetch(url, method=method, body=body, raise_error=False,
+                                                    request_timeout=LONG_POLL_TIMEOUT_SECONDS + 60)
+        finally:
+            self.open_requests -= 1
+        self.latencies[path].append(time.perf_counter() - started)
+        self.statuses[path][response.code] += 1
+        text = response.body.decode('utf-8', 'replace') if response.body else ''
+        if path == '/dialog':
+            return response.code, text
+        attributes = dict(ATTRIBUTE.findall(text))
+        if 'retry' in attributes:
+            # pauses like the dialog
+            self.retries += 1
+            yield tornado.gen.sleep(float(attributes['retry']))
+        return response.code, attributes
+
+    @tornado.gen.coroutine
+    def call(self, rng):
+        """
+        One call of the dialog, from calling in to hanging up
+        """
+        (status, dialog) = yield self.request('/dialog')
+        token_match = TOKEN.search(dialog)
+        if token_match is None:
+            raise DialogException('/dialog answered %d without a token: %s' % (status, dialog[:200]))
+        token = token_match.group(1)
+        yield self.request('/log', 'POST', token=token, feedback='explicit')
+
+        (status, match) = yield self.request('/waitforgame', token=token, feedback='explicit')
+        while match.get('ready') == 'false' and time.monotonic() < self.deadline:
+            (status, match) = yield self.request('/waitforgame', token=token, feedback='explicit',
+                                                 timeout=LONG_POLL_TIMEOUT_SECONDS)
+        if match.get('ready') == 'true':
+            yield self.play(token, rng)
+        yield self.request('/quitapp', 'POST', token=token)
+        self.calls_completed += 1
+
+    @tornado.gen.coroutine
+    def pause(self, rng):
+        if self.think:
+            yield tornado.gen.sleep(rng.expovariate(1 / self.think))
+
+    @tornado.gen.coroutine
+    def play(self, token, rng):
+        (status, ship) = yield self.request('/placeship', token=token)
+        row = 1
+        while status == 200 and 'name' in ship:
+            yield self.pause(rng)
+            (status, ship) = yield self.request('/placeship', 'POST', token=token, coord='A%d' % row,
+                                                orientation='horizontally')
+            row += 1
+
+        grid_size = main.game.Game.GRID_SIZE
+        fields = [str(main.game.Coord(x, y)) for x in range(grid_size) for y in range(grid_size)]
+        rng.shuffle(fields)
+        (status, turn) = yield self.request('/waitforturn', token=token, timeout=LONG_POLL_TIMEOUT_SECONDS)
+        while status == 200 and fields:
+            game_state = turn.get('gamestate')
+            if game_state == 'canPlay':
+                yield self.pause(rng)
+                if self.separate_shots:
+                    (status, shot) = yield self.request('/putcoord', token=token, coord=fields.pop())
+                    turn = {'gamestate': 'wait'}
+                else:
+                    (status, turn) = yield self.request('/shootandwait', token=token, coord=fields.pop(),
+                                                        timeout=LONG_POLL_TIMEOUT_SECONDS)
+            elif game_state == 'wait':
+                (status, turn) = yield self.request('/waitforturn', token=token, timeout=LONG_POLL_TIMEOUT_SECONDS)
+            else:
+                if game_state == 'won':
+                    self.games_completed += 1
+                return
+
+    @tornado.gen.coroutine
+    def client(self, number):
+        rng = random.Random(number)
+        yield tornado.gen.sleep(self.ramp * number / self.clients)
+        while time.monotonic() < self.deadline:
+            yield self.call(rng)
+
+    def sample_connections(self, server):
+        # HTTPServer keeps its open connections in a private set, there is no public counter
+        self.peak_connections = max(self.peak_connections, len(server._connections))
+
+    @tornado.gen.coroutine
+    def run(self, server):
+        sampler = tornado.ioloop.PeriodicCallback(lambda: self.sample_connections(server), 100)
+        sampler.start()
+        started = time.monotonic()
+        self.deadline = started + self.duration
+        yield [self.client(number) for number in range(self.clients)]
+        sampler.stop()
+        return time.monotonic() - started
+
+    def results(self, seconds):
+        endpoints = {}
+        for (path, latencies) in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            endpoints[path] = {
+                'requests': len(ordered),
+                'statuses': {str(status): count for (status, count) in sorted(self.statuses[path].items())},
+            }
+            for p in PERCENTILES:
+                endpoints[path]['p%d_ms' % p] = percentile(ordered, p) * 1000
+        return {
+            'commit': git_commit(),
+            'clients': self.clients,
+            'think_seconds': self.think,
+            'separate_shots': self.separate_shots,
+            'seconds': seconds,
+            'calls_completed': self.calls_completed,
+            'games_completed': self.games_completed,
+            'games_per_second': self.games_completed / seconds,
+            'requests_per_second': sum(len(latencies) for latencies in self.latencies.values()) / seconds,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_connections': self.peak_connections,
+            'peak_open_requests': self.peak_open_requests,
+            'long_polls_shed': self.retries,
+            'endpoints': endpoints,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results):
+    lines = ['%d clients, %.1fs, commit %s' % (results['clients'], results['seconds'], results['commit'])]
+    lines.append('%d calls, %d games completed, %.1f games/s, %.1f requests/s' %
+                 (results['calls_completed'], results['games_completed'], results['games_per_second'],
+                  results['requests_per_second']))
+    lines.append('peak RSS %.1f MB, peak %d open connections, %d long-polls shed' %
+                 (results['peak_rss_mb'], results['peak_connections'], results['long_polls_shed']))
+    lines.append('')
+    lines.append('%-16s %9s %10s %10s  %s' % ('endpoint', 'requests', 'p50', 'p99', 'statuses'))
+    for (path, endpoint) in results['endpoints'].items():
+        statuses = ' '.join('%s:%d' % item for item in endpoint['statuses'].items())
+        lines.append('%-16s %9d %8.2fms %8.2fms  %s' % (path, endpoint['requests'], endpoint['p50_ms'],
+                                                         endpoint['p99_ms'], statuses))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    clients = int(args['--clients'])
+    port = int(args['--port'])
+
+    logger = logging.getLogger('battleships-web')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    if args['--log']:
+        asynclog.log_to_file(logger, args['--log'])
+    main.logger = logger
+    main.PollDynamicDataHandler.MAX_POLLS = int(args['--max-long-polls'])
+    main.GAMES = main.SessionTokenToGame()
+    main.GAMES.start_sweeper()
+
+    # every client has at most one request in flight, mostly long-polls
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=clients)
+    app = main.make_app()
+    server = app.listen(port, address='127.0.0.1')
+    load_test = LoadTest('http://127.0.0.1:%d' % port, clients, float(args['--duration']), float(args['--ramp']),
+                         float(args['--think']), separate_shots=args['--separate-shots'])
+    try:
+        seconds = tornado.ioloop.IOLoop.current().run_sync(lambda: load_test.run(server))
+    except DialogException as e:
+        raise SystemExit('%s\nRun the load test from the directory of main.py, which has the templates' % e)
+    results = load_test.results(seconds)
+
+    print(report(results))
+    if args['--output']:
+        with open(args['--output'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Memory benchmark of live games
+
+Measures the memory taken per game with tracemalloc, for games whose players have placed all ships
+and made some moves, and the number of such games fitting in 1 GB:
+  game     a game.Game
+  session  a game of two players matched by SessionTokenToGame, with their sessions, proxies and futures
+
+It only uses APIs that older versions have as well, so the memory before a change is measured by
+running it in a checkout of the parent commit:
+  git worktree add /tmp/before <commit>^
+  cp bench_memory.py /tmp/before/ && cd /tmp/before && python bench_memory.py
+
+Usage:
+  bench_memory.py [options]
+
+Options:
+  -h, --help                  Show this screen.
+  -n NUMBER, --games=NUMBER   Number of games to create [default: 10000]
+  -m NUMBER, --moves=NUMBER   Number of shots of each player [default: 10]
+"""
+
+import gc
+import logging
+import random
+import tracemalloc
+import uuid
+
+from docopt import docopt
+
+import game
+import main
+
+GIGABYTE = 1024 ** 3
+
+
+def play(player_games, moves, rng):
+    """
+    Places all ships in rows from the top left corner and shoots at random fields
+    :param player_games: GameProxies of both players
+    """
+    for player_game in player_games:
+        row = 0
+        while player_game.get_ship_to_place():
+            player_game.place_ship(game.Coord(0, row), game.Orientation.horizontal)
+            row += 1
+    grid_size = game.Game.GRID_SIZE
+    fields = [(x, y) for x in range(grid_size) for y in range(grid_size)]
+    shots = [rng.sample(fields, moves) for _ in player_games]
+    for move in range(moves):
+        for (player_game, player_shots) in zip(player_games, shots):
+            if player_game.get_game_state() is game.GameState.canPlay:
+                player_game.shoot_field(game.Coord(*player_shots[move]))
+
+
+def create_games(number, moves):
+    rng = random.Random(number)
+    games = []
+    for _ in range(number):
+        (p1_token, p2_token) = (uuid.uuid1().hex, uuid.uuid1().hex)
+        new_game = game.Game(p1_token, p2_token)
+        play([game.GameProxy(new_game, p1_token), game.GameProxy(new_game, p2_token)], moves, rng)
+        games.append(new_game)
+    return games
+
+
+def create_sessions(number, moves):
+    rng = random.Random(number)
+    sessions = main.SessionTokenToGame()
+    for _ in range(number):
+        (p1_token, p2_token) = (sessions.generate_token(), sessions.generate_token())
+        sessions.get_game(p1_token)
+        sessions.get_game(p2_token)
+        play([sessions[p1_token], sessions[p2_token]], moves, rng)
+    return sessions
+
+
+def measure(create, number, moves):
+    """
+    :return: bytes allocated per game by create(number, moves) and still in use afterwards
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    created = create(number, moves)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del created
+    return (after - before) / number
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    number = int(args['--games'])
+    moves = int(args['--moves'])
+    main.logger = logging.getLogger('battleships-web')
+    main.logger.disabled = True
+
+    print('%-8s %12s %14s' % ('', 'bytes/game', 'games per GB'))
+    for (name, create) in (('game', create_games), ('session', create_sessions)):
+        bytes_per_game = measure(create, number, moves)
+        print('%-8s %12.0f %14.0f' % (name, bytes_per_game, GIGABYTE / bytes_per_game))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of calls through GameProxy
+
+Times the calls a handler makes per request, i.e. get_game_state, get_last_opponent_move,
+wait_for_turn and get_opponent, made
+  direct    on the Game, passing the session token
+  getattr   through the former GameProxy binding a new functools.partial on every access
+  proxy     through the current GameProxy
+
+Usage:
+  bench_proxy.py [options]
+
+Options:
+  -h, --help                 Show this screen.
+  -r NUMBER, --repeat=NUMBER
+                             Number of timed repetitions, the best one is reported [default: 5]
+"""
+
+import functools
+import timeit
+from types import MethodType
+
+from docopt import docopt
+
+import game
+
+METHODS = ('get_game_state', 'get_last_opponent_move', 'wait_for_turn', 'get_opponent')
+
+
+class GetattrGameProxy(object):
+    """
+    GameProxy as it was before the methods were cached, for comparison
+    """
+
+    def __init__(self, game, player_token):
+        self.__player_token = player_token
+        self.__game = game
+
+    def __getattr__(self, item):
+        attr = getattr(self.__game, item)
+
+        if isinstance(attr, MethodType):
+            return functools.partial(attr, self.__player_token)
+        else:
+            return attr
+
+
+def best_time(function, repeat):
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def bench(method_name, repeat):
+    the_game = game.Game('p1', 'p2')
+    getattr_proxy = GetattrGameProxy(the_game, 'p1')
+    proxy = game.GameProxy(the_game, 'p1')
+    # the attribute lookup is part of what is measured, hence the lambdas
+    calls = (
+        lambda: getattr(the_game, method_name)('p1'),
+        lambda: getattr(getattr_proxy, method_name)(),
+        lambda: getattr(proxy, method_name)(),
+    )
+    return tuple(best_time(call, repeat) for call in calls)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+    print('%-24s %10s %10s %10s %8s' % ('method', 'direct', 'getattr', 'proxy', 'speedup'))
+    for method_name in METHODS:
+        times = bench(method_name, repeat)
+        print('%-24s %8.0fns %8.0fns %8.0fns %7.1fx' % ((method_name,) + tuple(t * 1e9 for t in times) +
+                                                         (times[1] / times[2],)))
@@ -0,0 +1,178 @@
+"""
+Computer opponent for players who would otherwise wait too long for a game.
+
+The bot plays through a GameProxy like a human player's handlers do: it places its fleet at random
+and shoots at the field with the highest probability of holding a ship, computed over all placements
+of the opponent's remaining ships that are still possible.
+"""
+
+import logging
+import random
+
+import numpy
+import tornado.gen
+
+import game
+
+logger = logging.getLogger('battleships-web')
+
+TOKEN_PREFIX = 'bot'
+"""
+Prefix of the session tokens of bots, telling them apart from players when games are restored
+"""
+
+
+def is_bot_token(player_token):
+    return player_token.startswith(TOKEN_PREFIX)
+
+
+def cumulative_sums(grid):
+    """
+    :param grid: 2d array
+    :return: array c with one more row than grid, c[i] being the sum of the rows before i, so that
+             c[length:] - c[:-length] are the sums of all windows of length rows
+    """
+    cumulative = numpy.zeros((grid.shape[0] + 1, grid.shape[1]), dtype=numpy.int32)
+    numpy.cumsum(grid, axis=0, out=cumulative[1:])
+    return cumulative
+
+
+class Bot(object):
+    """
+    Plays one game as one of the players
+    """
+
+    HIT_WEIGHT = 50
+    """
+    Weight of a placement per unresolved hit it covers, so that ships that have been hit are sunk first
+    """
+
+    def __init__(self, player_game, player_token, rng=None):
+        """
+        :param player_game: GameProxy of the bot's player
+        :param player_token: token of the bot's player
+        :param rng: random.Random used for placements and ties, a new one if None
+        """
+        self.game = player_game
+        self.token = player_token
+        self.rng = rng or random.Random()
+        grid_size = player_game.grid_size
+        self.shot = numpy.zeros((grid_size, grid_size), dtype=bool)
+        """
+        fields of the opponent the bot has shot at
+        """
+        self.blocked = numpy.zeros((grid_size, grid_size), dtype=numpy.int32)
+        """
+        1 for the fields of the opponent that cannot hold a ship that has not been sunk
+        """
+        self.hits = numpy.zeros((grid_size, grid_size), dtype=numpy.int32)
+        """
+        1 for the fields of the opponent that have been hit and belong to a ship that has not been sunk
+        """
+        self.remaining_sizes = [ship.size for (ship, count) in player_game.available_ships for _ in range(count)]
+        """
+        sizes of the opponent's ships that have not been sunk
+        """
+        self.sunk_ships = set()
+
+        # a restored game may have been played already
+        for (coord, what_was_at_coord) in player_game.get_own_moves():
+            self.learn(coord, what_was_at_coord)
+
+    @tornado.gen.coroutine
+    def play(self):
+        """
+        Places the fleet and plays until the game is over
+        """
+        self.place_fleet()
+        while True:
+            yield self.game.wait_for_turn()
+            if self.game.get_game_state() is not game.GameState.canPlay:
+                logger.debug('Bot %s finished: %s' % (self.token, self.game.get_game_state().name))
+                return
+            self.shoot()
+
+    def place_fleet(self):
+        grid_size = self.game.grid_size
+        occupied = numpy.zeros((grid_size, grid_size), dtype=numpy.int32)
+        for coord in self.game.get_own_ship_coords():
+            occupied[coord.x, coord.y] = 1
+        ship = self.game.get_ship_to_place()
+        while ship:
+            placements = []
+            if ship.size <= grid_size:
+                # the first index of the arrays is x, horizontal ships extend along it
+                for (fields, orientation) in ((occupied, game.Orientation.horizontal),
+                                              (occupied.T, game.Orientation.vertical)):
+                    cumulative = cumulative_sums(fields)
+                    free = numpy.nonzero(cumulative[ship.size:] == cumulative[:-ship.size])
+                    placements.extend((orientation, start, line) for (start, line) in zip(*free))
+            (orientation, start, line) = self.rng.choice(placements)
+            if orientation is game.Orientation.horizontal:
+                (x, y) = (int(start), int(line))
+                occupied[x:x + ship.size, y] = 1
+            else:
+                (x, y) = (int(line), int(start))
+                occupied[x, y:y + ship.size] = 1
+            self.game.place_ship(game.Coord(x, y), orientation)
+            ship = self.game.get_ship_to_place()
+
+    def heatmap(self):
+        """
+        :return: array with the number of possible placements of the remaining ships covering each field,
+                 placements covering unresolved hits weighted by HIT_WEIGHT per hit
+        """
+        grid_size = self.shot.shape[0]
+        counts = [(size, self.remaining_sizes.count(size)) for size in set(self.remaining_sizes) if size <= grid_size]
+        density = numpy.zeros(self.shot.shape, dtype=numpy.int32)
+        targeting = self.hits.any()
+        # both orientations are handled along the first axis, the vertical one on the transposed arrays
+        for (blocked, hits, density_view) in ((self.blocked, self.hits, density),
+                                              (self.blocked.T, self.hits.T, density.T)):
+            blocked_sums = cumulative_sums(blocked)
+            hit_sums = cumulative_sums(hits) if targeting else None
+            # weights of the placements are added at their first field and subtracted after their last,
+            # so that the cumulative sum over these differences is the weight of all placements covering a field
+            differences = numpy.zeros((grid_size + 1, grid_size), dtype=numpy.int32)
+            for (size, count) in counts:
+                weights = (blocked_sums[size:] == blocked_sums[:-size]).astype(numpy.int32)
+                if targeting:
+                    weights *= 1 + self.HIT_WEIGHT * (hit_sums[size:] - hit_sums[:-size])
+                weights *= count
+                differences[:grid_size + 1 - size] += weights
+                differences[size:] -= weights
+            density_view += numpy.cumsum(differences[:-1], axis=0)
+        density[self.shot] = -1
+        return density
+
+    def choose_shot(self):
+        """
+        :return: Coord of one of the fields most likely holding a ship
+        """
+        density = self.heatmap()
+        best = numpy.flatnonzero(density == density.max())
+        (x, y) = numpy.unravel_index(self.rng.choice(best), density.shape)
+        return game.Coord(int(x), int(y))
+
+    def shoot(self):
+        self.game.shoot_field(self.choose_shot())
+        self.learn(*self.game.get_last_own_move())
+
+    def learn(self, coord, what_was_at_coord):
+        """
+        Updates what is known about the opponent's field from the result of a shot
+        :param coord: Coord shot at
+        :param what_was_at_coord: None or the Ship that was hit
+        """
+        self.shot[coord.x, coord.y] = True
+        if what_was_at_coord is None:
+            self.blocked[coord.x, coord.y] = 1
+        elif what_was_at_coord.fields_intact:
+            self.hits[coord.x, coord.y] = 1
+        elif what_was_at_coord not in self.sunk_ships:
+            # like in the board game, the sunk ship is announced, i.e. which fields it covered
+            self.sunk_ships.add(what_was_at_coord)
+            for sunk_coord in what_was_at_coord.coords:
+                self.hits[sunk_coord.x, sunk_coord.y] = 0
+                self.blocked[sunk_coord.x, sunk_coord.y] = 1
+            self.remaining_sizes.remove(what_was_at_coord.size)
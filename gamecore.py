@@ -0,0 +1,687 @@
+"""
+The rules of the game, without any I/O or event loop, so that games can also be played
+outside of the server, e.g. for simulations. See game.Game for the server's version.
+
+Games are kept small, so that many of them fit into memory: all classes use __slots__, Coords
+of the fields are shared, and the moves are packed into arrays.
+"""
+
+import re
+from array import array
+from enum import Enum
+
+Orientation = Enum('Orientation', 'horizontal vertical')
+GameState = Enum('GameState', 'won lost canPlay wait opponentLeft')
+ShotResult = Enum('ShotResult', 'hit miss sunk alreadyShot')
+
+
+class Ship(object):
+    __slots__ = ('name', 'size', 'fields_intact', 'coords')
+
+    def __init__(self, name, size, fields_intact=None):
+        self.name = name
+        self.size = size
+        self.fields_intact = fields_intact or size
+        self.coords = ()
+
+    def __repr__(self):
+        return 'Ship(%s, %s, %s)' % (self.name, self.size, self.fields_intact)
+
+
+class PlayerState(object):
+    """
+    The part of a game belonging to one player
+    """
+
+    __slots__ = ('token', 'opponent', 'own_ships', 'ships_placed', 'grid', 'moves', 'fields_intact',
+                 'ship_coords_string', 'game_state')
+
+    def __init__(self, token, own_ships, grid):
+        """
+        :param token: unique token/identifier of the player
+        :param own_ships: tuple of the player's Ships, in the order they are placed
+        :param grid: the player's field
+        """
+        self.token = token
+        self.opponent = None
+        """
+        PlayerState of the opponent
+        """
+        self.own_ships = own_ships
+        self.ships_placed = 0
+        """
+        number of own_ships that have been placed
+        """
+        self.grid = grid
+        self.moves = array('I')
+        """
+        the player's shots, packed as field index << 8 | number of the opponent's ship that was hit, 0 for a miss
+        """
+        # bookkeeping updated by place_ship, shoot_field and abandon, so that queries don't have to
+        # look at the ships
+        self.fields_intact = sum(ship.size for ship in own_ships)
+        self.ship_coords_string = ''
+        self.game_state = GameState.wait
+
+
+class GameCore(object):
+    """
+    Represents the game logic.
+
+    Subclasses are told about turns and the end of the game by the _turn_passed and _game_ended hooks.
+    """
+
+    __slots__ = ('p1_token', 'p2_token', 'grid_size', 'available_ships', 'players', 'whose_turn', 'abandoned_by',
+                 'listeners')
+
+    GRID_SIZE = 6
+    """
+    Size of the grid/field
+    """
+
+    AVAILABLE_SHIPS = [
+        (Ship('Battleship', 4), 1),
+        (Ship('Destroyer', 3), 1),
+        (Ship('Submarine', 2), 2),
+    ]
+    """
+    Initial list of number of ships available for each type as list of tuples (ship, count).
+    The list and its ships are templates shared by all games, and never changed.
+    """
+
+    GRID_CLASS = None
+    """
+    Grid implementation used for the players' fields, e.g. BitboardGrid; Grid if None
+    """
+
+    def __init__(self, p1_token, p2_token, grid_size=None, available_ships=None):
+        """
+        :param p1_token: unique token/identifier for player 1
+        :param p2_token: unique token/identifier for player 2
+        :param grid_size: size of the grid, GRID_SIZE if None
+        :param available_ships: ships to place like AVAILABLE_SHIPS, AVAILABLE_SHIPS if None
+        """
+        self.p1_token = p1_token
+        self.p2_token = p2_token
+        self.grid_size = grid_size or self.GRID_SIZE
+        self.available_ships = available_ships or self.AVAILABLE_SHIPS
+
+        grid_class = self.GRID_CLASS or Grid
+        p1 = PlayerState(p1_token, self.generate_ships_to_place(self.available_ships), grid_class(self.grid_size))
+        p2 = PlayerState(p2_token, self.generate_ships_to_place(self.available_ships), grid_class(self.grid_size))
+        p1.opponent = p2
+        p2.opponent = p1
+        self.players = {
+            p1_token: p1,
+            p2_token: p2,
+        }
+
+        self.whose_turn = self.p1_token
+        self.abandoned_by = None
+
+        self.listeners = []
+        """
+        callables called as listener(game, method_name, player_token, *args) after every
+        call of place_ship, shoot_field or abandon that changed the game
+        """
+
+    def get_opponent(self, player_token):
+        return self.players[player_token].opponent.token
+
+    def get_own_ship_coords(self, player_token):
+        """
+        :return: list of the Coords of all placed ships of the player
+        """
+        player = self.players[player_token]
+        return [coord for ship in player.own_ships[:player.ships_placed] for coord in ship.coords]
+
+    def get_opponent_ship_coords(self, player_token):
+        opponent = self.get_opponent(player_token)
+        return self.get_own_ship_coords(opponent)
+
+    def get_own_ship_coords_string(self, player_token):
+        """
+        :return: space separated coordinates of all placed ships of the player, e.g. 'A1 A2'
+        """
+        return self.players[player_token].ship_coords_string
+
+    def get_opponent_ship_coords_string(self, player_token):
+        return self.players[player_token].opponent.ship_coords_string
+
+    def get_game_state(self, player_token):
+        """
+        :param player_token: unique player token
+        :return: GameState
+        """
+        return self.players[player_token].game_state
+
+    def _compute_game_state(self, player):
+        state = GameState.wait
+
+        if not player.fields_intact:
+            state = GameState.lost
+        elif not player.opponent.fields_intact:
+            state = GameState.won
+        elif self.abandoned_by is not None:
+            state = GameState.opponentLeft
+        elif self.all_ships_placed() and self.is_players_turn(player.token):
+            state = GameState.canPlay
+
+        return state
+
+    def _update_game_states(self):
+        """
+        To be called whenever something the game state depends on changed
+        """
+        for player in self.players.values():
+            player.game_state = self._compute_game_state(player)
+
+    def all_ships_placed(self):
+        return all(player.ships_placed == len(player.own_ships) for player in self.players.values())
+
+    def is_players_turn(self, player_token):
+        """
+        :param player_token: unique player token
+        :return: true if it is the players turn; false if it is not
+        """
+        return self.whose_turn == player_token
+
+    def is_over(self, player_token):
+        """
+        :param player_token: unique player token
+        :return: true if the game has been won or lost, or a player has left
+        """
+        return self.get_game_state(player_token) in (GameState.won, GameState.lost, GameState.opponentLeft)
+
+    def abandon(self, player_token):
+        """
+        Ends the game because the given player left it
+        :param player_token: unique token of the player leaving the game
+        """
+        if self.abandoned_by is None:
+            self.abandoned_by = player_token
+            self._update_game_states()
+            self._notify_listeners('abandon', player_token)
+        self._game_ended()
+
+    def _notify_listeners(self, method_name, player_token, *args):
+        for listener in self.listeners:
+            listener(self, method_name, player_token, *args)
+
+    def _turn_passed(self, from_player_token, to_player_token):
+        """
+        Called when it becomes a player's turn
+        :param from_player_token: player whose turn ended, None for the first turn
+        :param to_player_token: player whose turn it is now
+        """
+        pass
+
+    def _game_ended(self):
+        """
+        Called when the game has been won or abandoned; may be called more than once
+        """
+        pass
+
+    def get_ship_to_place(self, player_token):
+        """
+        Returns instance of the ship that is to be placed next by the given player
+        :param player_token: unique player token
+        :return: instance of Ship, None if all ships have been placed
+        """
+        player = self.players[player_token]
+        if player.ships_placed < len(player.own_ships):
+            return player.own_ships[player.ships_placed]
+        else:
+            return None
+
+    def place_ship(self, player_token, top_left_coord, orientation):
+        """
+        Places the *current* ship (returned by get_ship_to_place)
+        :param player_token: unique player token
+        :param top_left_coord: top left Coord of the ship on the field
+        :param orientation: Orientation of the ship on the field, e.g. Orientation.vertical
+        :raises OccupiedFieldsException if fields are blocked by other ships
+        :raises IndexError if coord out of range
+        """
+
+        ship_to_place = self.get_ship_to_place(player_token)
+        player = self.players[player_token]
+        if orientation is Orientation.horizontal:
+            coord_range_x = range(top_left_coord.x, top_left_coord.x + ship_to_place.size)
+            coords = [Coord(x, top_left_coord.y) for x in coord_range_x]
+        else:
+            coord_range_y = range(top_left_coord.y, top_left_coord.y + ship_to_place.size)
+            coords = [Coord(top_left_coord.x, y) for y in coord_range_y]
+
+        player.grid.put(ship_to_place, coords)
+        player.ships_placed += 1
+        coords_string = ' '.join(str(coord) for coord in coords)
+        if player.ship_coords_string:
+            coords_string = player.ship_coords_string + ' ' + coords_string
+        player.ship_coords_string = coords_string
+        self._update_game_states()
+        self._notify_listeners('place_ship', player_token, top_left_coord, orientation)
+
+        if self.all_ships_placed():
+            self._turn_passed(None, self.whose_turn)
+
+    def shoot_field(self, player_token, opponent_field_coord):
+        """
+        shoots a field on the opponent's given by opponent_field_coord.
+        :param player_token: player_token
+        :param opponent_field_coord: the coordinate to shoot on the opponent's field
+        :return: a ShotResult
+        """
+        if self.get_game_state(player_token) != GameState.canPlay:
+            raise Exception('Not your turn')
+
+        player = self.players[player_token]
+        opponent = player.opponent
+        what_is_at_coord = opponent.grid.shoot(opponent_field_coord)
+        shot_result = None
+        if what_is_at_coord is None:
+            shot_result = ShotResult.miss
+        elif what_is_at_coord is Grid.FIELD_SHOT:
+            shot_result = ShotResult.alreadyShot
+        else:
+            shot_result = ShotResult.hit
+            what_is_at_coord.fields_intact -= 1
+            opponent.fields_intact -= 1
+            if not what_is_at_coord.fields_intact:
+                shot_result = ShotResult.sunk
+        if shot_result != ShotResult.alreadyShot:
+            ship_number = 0 if what_is_at_coord is None else opponent.own_ships.index(what_is_at_coord) + 1
+            player.moves.append((opponent_field_coord.x * self.grid_size + opponent_field_coord.y) << 8 | ship_number)
+
+            self.whose_turn = opponent.token
+            self._update_game_states()
+            self._turn_passed(player_token, opponent.token)
+            if shot_result is ShotResult.sunk and self.is_over(player_token):
+                self._game_ended()
+            self._notify_listeners('shoot_field', player_token, opponent_field_coord)
+
+        return shot_result
+
+    def _unpack_move(self, player, move):
+        """
+        :return: tuple (Coord shot at, Ship that was hit or None)
+        """
+        (field, ship_number) = divmod(move, 256)
+        what_was_at_coord = player.opponent.own_ships[ship_number - 1] if ship_number else None
+        return Coord(*divmod(field, self.grid_size)), what_was_at_coord
+
+    def get_own_moves(self, player_token):
+        """
+        :return: list of tuples (Coord shot at, Ship that was hit or None) of the player's moves
+        """
+        player = self.players[player_token]
+        return [self._unpack_move(player, move) for move in player.moves]
+
+    def get_last_opponent_move(self, player_token):
+        return self.get_last_own_move(self.get_opponent(player_token))
+
+    def get_last_own_move(self, player_token):
+        """
+        :return: tuple (Coord shot at, what was at the field) of the player's last move, (None, None) if none
+        """
+        player = self.players[player_token]
+        if player.moves:
+            return self._unpack_move(player, player.moves[-1])
+        return None, None
+
+    def get_state(self):
+        """
+        :return: the state of the game as dict of JSON-compatible values, to build it again with from_state.
+                 The fields of the placed ships and the moves are given as packed numbers like in PlayerState.
+        """
+        players = {}
+        for (token, player) in self.players.items():
+            players[token] = {
+                'ships': [[coord.x * self.grid_size + coord.y for coord in ship.coords]
+                          for ship in player.own_ships[:player.ships_placed]],
+                'moves': player.moves.tolist(),
+            }
+        return {
+            'p1': self.p1_token,
+            'p2': self.p2_token,
+            'grid_size': self.grid_size,
+            'fleet': [[ship.name, ship.size, count] for (ship, count) in self.available_ships],
+            'whose_turn': self.whose_turn,
+            'abandoned_by': self.abandoned_by,
+            'players': players,
+        }
+
+    @classmethod
+    def from_state(cls, state, available_ships=None):
+        """
+        Builds a game from the result of get_state, without repeating the calls that led to it
+        :param available_ships: ships to place like AVAILABLE_SHIPS, built from the fleet of the state if None
+        :return: new instance of cls
+        """
+        if available_ships is None:
+            available_ships = [(Ship(name, size), count) for (name, size, count) in state['fleet']]
+        restored = cls(state['p1'], state['p2'], grid_size=state['grid_size'], available_ships=available_ships)
+        grid_size = restored.grid_size
+        for (token, player_state) in state['players'].items():
+            player = restored.players[token]
+            for (ship, fields) in zip(player.own_ships, player_state['ships']):
+                player.grid.put(ship, [Coord(*divmod(field, grid_size)) for field in fields])
+            player.ships_placed = len(player_state['ships'])
+            player.ship_coords_string = ' '.join(str(coord) for ship in player.own_ships[:player.ships_placed]
+                                                 for coord in ship.coords)
+            player.moves = array('I', player_state['moves'])
+        for player in restored.players.values():
+            opponent = player.opponent
+            for move in player.moves:
+                (field, ship_number) = divmod(move, 256)
+                opponent.grid.shoot(Coord(*divmod(field, grid_size)))
+                if ship_number:
+                    opponent.own_ships[ship_number - 1].fields_intact -= 1
+                    opponent.fields_intact -= 1
+        restored.whose_turn = state['whose_turn']
+        restored.abandoned_by = state['abandoned_by']
+        restored._update_game_states()
+        if restored.all_ships_placed():
+            restored._turn_passed(None, restored.whose_turn)
+        if restored.is_over(restored.p1_token):
+            restored._game_ended()
+        return restored
+
+    @classmethod
+    def generate_ships_to_place(cls, available_ships=None):
+        """
+        :return: tuple of new Ships, in the order they are placed
+        """
+        # new ships from the templates, because we need to be able to detect that an /individual/ ship has sunk
+        return tuple(Ship(ship.name, ship.size)
+                     for (ship, number) in available_ships or cls.AVAILABLE_SHIPS for _ in range(number))
+
+
+class Coord(object):
+    """
+    Coordinate of a field. Coords are immutable, and those of the fields of grids up to INTERNED_SIZE
+    are shared, i.e. Coord(0, 0) is Coord('A', '1').
+    """
+
+    __slots__ = ('x', 'y')
+
+    INTERNED_SIZE = 128
+
+    PATTERN = re.compile(r'([A-Z]+)([1-9][0-9]*)')
+    """
+    Coordinate string: column letters A to Z, then AA, AB and so on, followed by the row number from 1
+    """
+
+    _interned = {}
+
+    def __new__(cls, x, y):
+        """
+        Accepts coordinates either as ('A', '1') or (0,0) or with kwargs x and y.
+        Use parse for strings like 'A10'.
+        """
+
+        if isinstance(x, str):
+            x = cls.column_index(x)
+            y = int(y) - 1
+        interned = 0 <= x < cls.INTERNED_SIZE and 0 <= y < cls.INTERNED_SIZE
+        if interned:
+            coord = cls._interned.get((x, y))
+            if coord is not None:
+                return coord
+        coord = super().__new__(cls)
+        coord.x = x
+        coord.y = y
+        if interned:
+            cls._interned[(x, y)] = coord
+        return coord
+
+    @classmethod
+    def parse(cls, coord_string, grid_size):
+        """
+        :param coord_string: coordinate string, e.g. 'A1' or 'AB12'
+        :param grid_size: size of the grid the coordinate must be on
+        :raises ValueError if the string is not a coordinate
+        :raises IndexError if the coordinate is out of the grid
+        """
+        match = cls.PATTERN.fullmatch(coord_string)
+        if match is None:
+            raise ValueError('%r is not a coordinate' % coord_string)
+        coord = cls(*match.groups())
+        if not (coord.x < grid_size and coord.y < grid_size):
+            raise IndexError('%r is out of grid' % coord)
+        return coord
+
+    @staticmethod
+    def column_index(letters):
+        """
+        :param letters: column letters, e.g. 'A' for 0 or 'AA' for 26
+        """
+        index = 0
+        for letter in letters:
+            index = index * 26 + ord(letter) - ord('A') + 1
+        return index - 1
+
+    @staticmethod
+    def column_letters(index):
+        letters = ''
+        index += 1
+        while index:
+            (index, remainder) = divmod(index - 1, 26)
+            letters = chr(remainder + ord('A')) + letters
+        return letters
+
+    def __reduce__(self):
+        return Coord, (self.x, self.y)
+
+    def __str__(self):
+        return self.column_letters(self.x) + str(self.y + 1)
+
+    def __repr__(self):
+        return 'Coord(%r, %r)' % (self.column_letters(self.x), str(self.y + 1))
+
+
+class OccupiedFieldsException(Exception):
+    def __init__(self, message=None, occupied_fields=None):
+        """
+        :param message: exception message
+        :param occupied_fields: list of Coord-objects denoting the fields that are occupied
+        """
+        super(Exception, self).__init__(message)
+        self.occupied_fields = occupied_fields
+
+
+class Grid(object):
+    """
+    Field of a player, one byte per field: 0 if empty, SHOT_CELL if shot, otherwise the number of the ship
+    in ships plus one
+    """
+
+    __slots__ = ('grid_size', 'cells', 'ships')
+
+    FIELD_SHOT = "SHOT"
+    SHOT_CELL = 255
+
+    def __init__(self, grid_size):
+        self.grid_size = grid_size
+        self.cells = bytearray(grid_size * grid_size)
+        self.ships = []
+
+    def _index(self, coord):
+        if not (0 <= coord.x < self.grid_size and 0 <= coord.y < self.grid_size):
+            raise IndexError('%r is out of grid' % coord)
+        return coord.x * self.grid_size + coord.y
+
+    def __getitem__(self, coord):
+        cell = self.cells[self._index(coord)]
+        if cell == Grid.SHOT_CELL:
+            return Grid.FIELD_SHOT
+        return self.ships[cell - 1] if cell else None
+
+    def __setitem__(self, coord, value):
+        if value is None:
+            cell = 0
+        elif value is Grid.FIELD_SHOT:
+            cell = Grid.SHOT_CELL
+        else:
+            if value not in self.ships:
+                if len(self.ships) >= Grid.SHOT_CELL - 1:
+                    raise ValueError('At most %d ships fit on a Grid' % (Grid.SHOT_CELL - 1))
+                self.ships.append(value)
+            cell = self.ships.index(value) + 1
+        self.cells[self._index(coord)] = cell
+
+    def put(self, ship, coords):
+        """
+        :param ship: instance of Ship (note to properly clone objects, when placing two ships of the same type)
+        :param coords: list of Coords
+        :raises IndexError if ship is partially or completely out of grid
+        :raises OccupiedFieldsException if field is not empty
+        :return: None
+        """
+
+        occupied_fields = [coord for coord in coords if self[coord] is not None]
+        if occupied_fields:
+            raise OccupiedFieldsException(occupied_fields=occupied_fields)
+
+        for coord in coords:
+            self[coord] = ship
+        ship.coords = tuple(coords)
+
+    def shoot(self, coord):
+        """
+        Marks the field at coord as shot.
+        :param coord: Coord to shoot at
+        :return: what was at the field before, i.e. None, a Ship or FIELD_SHOT
+        :raises IndexError if coord is out of grid
+        """
+        index = self._index(coord)
+        cell = self.cells[index]
+        self.cells[index] = Grid.SHOT_CELL
+        if cell == Grid.SHOT_CELL:
+            return Grid.FIELD_SHOT
+        return self.ships[cell - 1] if cell else None
+
+    def is_sunk(self, ship):
+        """
+        :param ship: a Ship put on this grid
+        :return: true if every field of the ship has been shot
+        """
+        return all(self[coord] is Grid.FIELD_SHOT for coord in ship.coords)
+
+    def all_sunk(self):
+        """
+        :return: true if every field occupied by a ship has been shot
+        """
+        # fields that are neither empty nor shot hold a ship
+        return not self.cells.translate(None, bytes((0, Grid.SHOT_CELL)))
+
+
+class BitboardGrid(object):
+    """
+    Grid storing occupancy, shots and ships as integer bitboards instead of per-cell objects.
+    Field (x, y) maps to bit x * grid_size + y. Supports the same API as Grid, so it can be
+    used as a drop-in replacement, also for boards much larger than the default one.
+    """
+
+    __slots__ = ('grid_size', 'occupied', 'shot', 'ship_masks', 'ships_by_index')
+
+    FIELD_SHOT = Grid.FIELD_SHOT
+
+    def __init__(self, grid_size):
+        self.grid_size = grid_size
+        self.occupied = 0
+        """
+        bitboard of fields occupied by a ship that has not been shot there yet
+        """
+        self.shot = 0
+        """
+        bitboard of fields that have been shot
+        """
+        self.ship_masks = {}
+        """
+        bitboard of the fields of every ship put on the grid
+        """
+        self.ships_by_index = {}
+        """
+        ship for every bit index of a field occupied by a ship
+        """
+
+    def _index(self, coord):
+        if not (0 <= coord.x < self.grid_size and 0 <= coord.y < self.grid_size):
+            raise IndexError('%r is out of grid' % coord)
+        return coord.x * self.grid_size + coord.y
+
+    def __getitem__(self, coord):
+        index = self._index(coord)
+        if self.shot >> index & 1:
+            return self.FIELD_SHOT
+        return self.ships_by_index.get(index)
+
+    def __setitem__(self, coord, value):
+        index = self._index(coord)
+        bit = 1 << index
+        ship = self.ships_by_index.pop(index, None)
+        if ship is not None:
+            self.occupied &= ~bit
+            self.ship_masks[ship] &= ~bit
+        self.shot &= ~bit
+        if value is self.FIELD_SHOT:
+            self.shot |= bit
+        elif value is not None:
+            self.occupied |= bit
+            self.ship_masks[value] = self.ship_masks.get(value, 0) | bit
+            self.ships_by_index[index] = value
+
+    def put(self, ship, coords):
+        """
+        :param ship: instance of Ship (note to properly clone objects, when placing two ships of the same type)
+        :param coords: list of Coords
+        :raises IndexError if ship is partially or completely out of grid
+        :raises OccupiedFieldsException if field is not empty
+        :return: None
+        """
+        indices = [self._index(coord) for coord in coords]
+        mask = 0
+        for index in indices:
+            mask |= 1 << index
+
+        occupied_mask = mask & (self.occupied | self.shot)
+        if occupied_mask:
+            occupied_fields = [coord for (coord, index) in zip(coords, indices) if occupied_mask >> index & 1]
+            raise OccupiedFieldsException(occupied_fields=occupied_fields)
+
+        self.occupied |= mask
+        self.ship_masks[ship] = self.ship_masks.get(ship, 0) | mask
+        for index in indices:
+            self.ships_by_index[index] = ship
+        ship.coords = tuple(coords)
+
+    def shoot(self, coord):
+        """
+        Marks the field at coord as shot.
+        :param coord: Coord to shoot at
+        :return: what was at the field before, i.e. None, a Ship or FIELD_SHOT
+        :raises IndexError if coord is out of grid
+        """
+        index = self._index(coord)
+        bit = 1 << index
+        if self.shot & bit:
+            return self.FIELD_SHOT
+        self.shot |= bit
+        if self.occupied & bit:
+            self.occupied &= ~bit
+            return self.ships_by_index[index]
+        return None
+
+    def is_sunk(self, ship):
+        """
+        :param ship: a Ship put on this grid
+        :return: true if every field of the ship has been shot
+        """
+        return not self.ship_masks[ship] & self.occupied
+
+    def all_sunk(self):
+        """
+        :return: true if every field occupied by a ship has been shot
+        """
+        return not self.occupied
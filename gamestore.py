@@ -0,0 +1,242 @@
+"""
+Storage backends for the games of SessionTokenToGame.
+
+A game is stored as its state (see GameCore.get_state) as of the last snapshot, plus the log of the
+calls that changed it since (see Game.listeners). It is restored by building it from the state and
+repeating the few calls of the log.
+"""
+
+import concurrent.futures
+import functools
+import json
+import logging
+import sqlite3
+
+import tornado.gen
+import tornado.ioloop
+
+import game
+
+logger = logging.getLogger('battleships-web')
+
+
+class MemoryGameStore(object):
+    """
+    Keeps games in memory only, i.e. does not store anything. All games are lost on restart.
+    """
+
+    def game_created(self, new_game):
+        pass
+
+    def record(self, changed_game, method_name, player_token, *args):
+        """
+        Game listener recording a change of the game
+        """
+        pass
+
+    def load_games(self):
+        """
+        :return: list of the stored games that have not ended
+        """
+        return []
+
+    def start(self):
+        pass
+
+
+@functools.lru_cache(maxsize=64)
+def decode_fleet(fleet):
+    """
+    :param fleet: tuple of (name, size, count) per type of ship
+    :return: ships to place like Game.AVAILABLE_SHIPS, shared by all games with the same fleet
+    """
+    return tuple((game.Ship(name, size), count) for (name, size, count) in fleet)
+
+
+class SQLiteGameStore(MemoryGameStore):
+    """
+    Stores games in a SQLite database: one row with the state per game as of the last snapshot, and an
+    append-only log of the calls since.
+
+    The database is only used by one writer thread with its own connection, so that the IOLoop never
+    waits for SQLite. New log entries are handed to it every FLUSH_INTERVAL_SECONDS. Every
+    snapshot_interval seconds the states of the games that changed are taken, SNAPSHOT_CHUNK_SIZE
+    games per IOLoop iteration, and the writer replaces their rows and deletes their log entries.
+    Games that have ended, won or abandoned, are deleted instead.
+    """
+
+    FLUSH_INTERVAL_SECONDS = 1
+
+    SNAPSHOT_CHUNK_SIZE = 1000
+
+    def __init__(self, path, snapshot_interval=300):
+        """
+        :param path: path of the SQLite database file, created if it does not exist
+        :param snapshot_interval: seconds between snapshots
+        """
+        self.snapshot_interval = snapshot_interval
+        self.pending = []
+        self.changed = {}
+        """
+        games changed since the last snapshot, per id
+        """
+        self.connection = None
+        """
+        connection of the writer thread, only to be used there
+        """
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='gamestore')
+        self.writer.submit(self._connect, path).result()
+
+    def _connect(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS log '
+                                '(seq INTEGER PRIMARY KEY, game TEXT, player TEXT, call TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS log_game ON log (game)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS games (game TEXT PRIMARY KEY, state TEXT)')
+        self.connection.commit()
+
+    def game_created(self, new_game):
+        fleet = [[ship.name, ship.size, count] for (ship, count) in new_game.available_ships]
+        self.pending.append((new_game.p1_token, new_game.p1_token,
+                             json.dumps(['create', new_game.p2_token, new_game.grid_size, fleet])))
+        self.changed[new_game.p1_token] = new_game
+
+    def record(self, changed_game, method_name, player_token, *args):
+        self.pending.append((changed_game.p1_token, player_token,
+                             json.dumps([method_name] + self.encode_args(args))))
+        self.changed[changed_game.p1_token] = changed_game
+
+    @staticmethod
+    def encode_args(args):
+        encoded = []
+        for arg in args:
+            if isinstance(arg, game.Coord):
+                encoded.extend((arg.x, arg.y))
+            elif isinstance(arg, game.Orientation):
+                encoded.append(arg.name)
+            else:
+                encoded.append(arg)
+        return encoded
+
+    @staticmethod
+    def decode_call(player_token, call):
+        """
+        :param player_token: token of the player who made the call
+        :param call: decoded JSON list [method_name, *encoded_args]
+        :return: tuple (method_name, args)
+        """
+        method_name = call[0]
+        if method_name == 'place_ship':
+            args = (player_token, game.Coord(call[1], call[2]), game.Orientation[call[3]])
+        elif method_name == 'shoot_field':
+            args = (player_token, game.Coord(call[1], call[2]))
+        else:
+            args = (player_token,)
+        return method_name, args
+
+    def flush(self):
+        """
+        Hands the recorded calls to the writer
+        :return: Future resolved once they are written
+        """
+        pending, self.pending = self.pending, []
+        written = self.writer.submit(self._write_log, pending)
+        written.add_done_callback(self._log_failure)
+        return written
+
+    @staticmethod
+    def _log_failure(written):
+        if written.exception() is not None:
+            logger.error('Writing the game log failed', exc_info=written.exception())
+
+    def _write_log(self, pending):
+        if pending:
+            with self.connection:
+                self.connection.executemany('INSERT INTO log (game, player, call) VALUES (?, ?, ?)', pending)
+
+    @tornado.gen.coroutine
+    def snapshot(self):
+        """
+        Writes the states of the games changed since the last snapshot, and deletes their log entries
+        """
+        changed, self.changed = self.changed, {}
+        items = list(changed.items())
+        for start in range(0, len(items), self.SNAPSHOT_CHUNK_SIZE):
+            if start:
+                yield tornado.gen.moment
+            states = []
+            ended = []
+            for (game_id, changed_game) in items[start:start + self.SNAPSHOT_CHUNK_SIZE]:
+                if changed_game.is_over(changed_game.p1_token):
+                    ended.append(game_id)
+                else:
+                    states.append((game_id, changed_game.get_state()))
+            # the log entries of these games written so far are all part of their states, the writer
+            # runs the tasks in order
+            self.flush()
+            yield self.writer.submit(self._write_snapshot, states, ended)
+        logger.debug('Snapshot of %d changed games written' % len(items))
+
+    def _write_snapshot(self, states, ended):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO games (game, state) VALUES (?, ?)',
+                                        [(game_id, json.dumps(state)) for (game_id, state) in states])
+            self.connection.executemany('DELETE FROM games WHERE game = ?', [(game_id,) for game_id in ended])
+            self.connection.executemany('DELETE FROM log WHERE game = ?',
+                                        [(game_id,) for (game_id, _) in states] + [(game_id,) for game_id in ended])
+
+    def load_games(self):
+        """
+        :return: list of the stored games that have not ended, built from their states and the calls of the
+                 log. Games with calls in the log count as changed, so that the next snapshot folds them in.
+        """
+        (states, calls_by_game) = self.writer.submit(self._read_games).result()
+        games = []
+        for (game_id, state) in states.items():
+            state = json.loads(state)
+            fleet = decode_fleet(tuple(tuple(ship) for ship in state['fleet']))
+            restored_game = game.Game.from_state(state, available_ships=fleet)
+            self._repeat_calls(restored_game, calls_by_game.pop(game_id, ()))
+            games.append(restored_game)
+        for (game_id, calls) in calls_by_game.items():
+            (p1_token, create_call) = calls[0]
+            if create_call[0] != 'create':
+                # the game ended and was deleted by a snapshot, its last calls are left over
+                continue
+            if len(create_call) > 2:
+                fleet = decode_fleet(tuple(tuple(ship) for ship in create_call[3]))
+                restored_game = game.Game(p1_token, create_call[1], grid_size=create_call[2], available_ships=fleet)
+            else:
+                # stored before games had variants
+                restored_game = game.Game(p1_token, create_call[1])
+            self._repeat_calls(restored_game, calls[1:])
+            games.append(restored_game)
+        return [restored_game for restored_game in games if not restored_game.is_over(restored_game.p1_token)]
+
+    def _repeat_calls(self, restored_game, calls):
+        for (player_token, call) in calls:
+            (method_name, args) = self.decode_call(player_token, call)
+            getattr(restored_game, method_name)(*args)
+        if calls:
+            self.changed[restored_game.p1_token] = restored_game
+
+    def _read_games(self):
+        """
+        :return: tuple (dict of the JSON states per game id, dict of the lists of [player_token, call] in the log
+                 per game id)
+        """
+        states = dict(self.connection.execute('SELECT game, state FROM games'))
+        calls_by_game = {}
+        for (game_id, player_token, call) in self.connection.execute(
+                'SELECT game, player, call FROM log ORDER BY seq'):
+            calls_by_game.setdefault(game_id, []).append([player_token, json.loads(call)])
+        return states, calls_by_game
+
+    def start(self):
+        """
+        Starts writing the log and snapshots periodically on the current IOLoop
+        """
+        tornado.ioloop.PeriodicCallback(self.flush, self.FLUSH_INTERVAL_SECONDS * 1000).start()
+        tornado.ioloop.PeriodicCallback(self.snapshot, self.snapshot_interval * 1000).start()
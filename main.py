@@ -5,61 +5,218 @@ Usage:
   main.py [options]
 
 Options:
-  -h, --help                Show this screen.
-  -p NUMBER, --port=NUMBER  Port to listen on [default: 8080]
-  -l ADDR, --listen=ADDR    Address to listen on, by default all interfaces
+  -h, --help                   Show this screen.
+  -p NUMBER, --port=NUMBER     Port to listen on [default: 8080]
+  -l ADDR, --listen=ADDR       Address to listen on, by default all interfaces
+  --grid=CLASS                 Implementation of the players' grids, Grid (a byte per field) or
+                               BitboardGrid (integer bitboards) [default: Grid]
+  --session-timeout=SECONDS    Seconds after which idle sessions are evicted [default: 300]
+  --finished-timeout=SECONDS   Seconds after which finished games are evicted [default: 30]
+  --max-sessions=NUMBER        Maximum number of live sessions, unlimited if 0 [default: 0]
+  -s PATH, --store=PATH        SQLite database to store games in, so that they survive restarts.
+                               With multiple workers, the shard number is appended to the name
+  --snapshot-interval=SECONDS  Seconds between snapshots of the stored games [default: 300]
+  --log-format=FORMAT          Format of battleships.log, json (JSON Lines) or text [default: json]
+  --log-queue-size=NUMBER      Log records waiting to be written before further ones are dropped [default: 10000]
+  --response-log-sample=RATE   Fraction of the XML responses that are logged [default: 1]
+  --production                 Cache templates and pre-render the dialog instead of reloading
+                               the application whenever a file changes
+  -w NUMBER, --workers=NUMBER  Shard sessions across this many worker processes, which all accept
+                               connections on the port and forward the requests of the sessions of the
+                               others to them, single process if 0 [default: 0]
+  --worker-port=NUMBER         First private port of the workers, listening on localhost for the
+                               requests forwarded by the others [default: 8100]
+  --bot-wait=SECONDS           Seconds after which a waiting player is matched with a computer
+                               opponent, never if 0. Needs NumPy [default: 0]
+  --max-long-polls=NUMBER      Maximum number of waiting long-poll requests per process, further ones are
+                               answered at once and asked to retry, unlimited if 0 [default: 4000]
+  --max-poll-timeout=SECONDS   Upper bound of the timeout of long-poll requests [default: 9]
+  --admin-port=NUMBER          Port of the admin endpoints (profiler, tracing), listening on localhost,
+                               none if 0. With multiple workers, worker n listens on the port + n
+                               [default: 0]
+  --stall-threshold=SECONDS    Seconds a callback may block the IOLoop before the stack is logged,
+                               never if 0 [default: 0.5]
 """
 
+import collections
 import datetime
 import logging
 logging.basicConfig(format="%(created)s:%(levelname)s:%(name)s:%(module)s:%(message)s")
 import uuid
-import math
+import functools
+import json
+import random
+import re
+import threading
+import time
 import traceback
 
 from docopt import docopt
-from lxml import etree
 import tornado.concurrent
 import tornado.ioloop
 import tornado.gen
+import tornado.httpserver
+import tornado.iostream
+import tornado.locks
+import tornado.netutil
+import tornado.process
 import tornado.web
+import tornado.websocket
 
+import assets
+import asynclog
+try:
+    import bot
+except ImportError:  # NumPy is not installed
+    bot = None
 import game
+import gamestore
+import matchmaking
+import metrics
+import profiling
+import sharding
+import spectate
+import timingwheel
 
 
 class SessionTokenToGame(object):
     """
+    Maps session tokens to the game (proxies) of the players.
+    Sessions that have not been accessed for a while are evicted by a periodic sweeper.
+    """
+
+    SWEEP_INTERVAL_SECONDS = 5
+
+    SHARD = None
+    """
+    Shard of this process in multi-process mode, encoded into every generated token
+    """
 
+    LOBBY = None
+    """
+    sharding.Lobby shared by the processes in multi-process mode, told how many players are waiting here
     """
 
-    def __init__(self):
+    def __init__(self, session_timeout=300, finished_timeout=30, max_sessions=0, store=None, bot_wait=0):
+        """
+        :param session_timeout: seconds after which sessions that have not been accessed are evicted
+        :param finished_timeout: seconds after which sessions whose game is over are evicted
+        :param max_sessions: maximum number of live sessions, unlimited if 0
+        :param store: gamestore backend the games are stored in, gamestore.MemoryGameStore if None
+        :param bot_wait: seconds after which a waiting player is matched with a bot, never if 0
+        """
         self.session_token_game_dict = {}
-        self.unmatched_players = set()
+        self.matchmaker = matchmaking.Matchmaker()
         self.futures = {}
 
-    def get_game(self, player_token):
+        self.session_timeout = session_timeout
+        self.finished_timeout = finished_timeout
+        self.max_sessions = max_sessions
+        # Tokens in order of last access, mapped to the time of that access. Since every access
+        # moves the token to the end, the sweeper only has to look at the front of these dicts.
+        self.last_access = collections.OrderedDict()
+        self.finished_last_access = collections.OrderedDict()
+        self.sweeper = None
+        self.store = store or gamestore.MemoryGameStore()
+        self.bot_wait = bot_wait
+        self.games_by_id = {}
+        """
+        running games per public id, see spectate.game_id
+        """
+        self.move_streams = {}
+        """
+        spectate.MoveStream per game id, for the games that have been spectated
+        """
+
+    def get_game(self, player_token, variant=None):
+        """
+        Starts a poll of the player for a game, matching the player with a waiting one if possible
+        :param player_token: token of the player
+        :param variant: matchmaking.Variant the player wants to play, the default variant if None
+        :return: Future resolved with the GameProxy of the player once matched, or None if the session is evicted
+        """
         if player_token not in self.session_token_game_dict:
+            if self.max_sessions and len(self.session_token_game_dict) >= self.max_sessions:
+                raise tornado.web.HTTPError(503, 'too many sessions')
             self.session_token_game_dict[player_token] = None
             self.futures[player_token] = tornado.concurrent.Future()
-            self.unmatched_players.add(player_token)
+        self.touch(player_token)
 
-        if self.session_token_game_dict[player_token] is None and len(self.unmatched_players) > 1:
-            unmatched_player = self.unmatched_players.pop()
-            if unmatched_player == player_token:  # oops, we popped ourselves, let's pop once more
-                unmatched_player = self.unmatched_players.pop()
-            logger.debug('Matching players %s and %s' % (unmatched_player, player_token))
-            self.unmatched_players.discard(player_token)
+        if self.session_token_game_dict[player_token] is None:
+            if self.matchmaker.is_waiting(player_token):
+                self.matchmaker.poll_started(player_token)
+            else:
+                variant = variant or matchmaking.Variant.default()
+                unmatched_player = self.matchmaker.match(player_token, variant)
+                self._waiting_changed()
+                if unmatched_player is not None:
+                    logger.debug('Matching players %s and %s' % (unmatched_player, player_token))
+                    new_game = variant.create_game(unmatched_player, player_token)
+                    self.store.game_created(new_game)
+                    self._add_game(new_game)
+                elif self.bot_wait:
+                    tornado.ioloop.IOLoop.current().call_later(self.bot_wait, self.match_with_bot, player_token)
 
-            new_game = game.Game(unmatched_player, player_token)
-            self.session_token_game_dict[unmatched_player] = game.GameProxy(new_game, unmatched_player)
-            self.session_token_game_dict[player_token] = game.GameProxy(new_game, player_token)
+        return self.futures[player_token]
+
+    def match_with_bot(self, player_token):
+        """
+        Matches the player with a bot if the player is still waiting and has been waiting for bot_wait seconds
+        """
+        variant = self.matchmaker.take(player_token, self.bot_wait)
+        if variant is None:
+            return
+        self._waiting_changed()
+        bot_token = bot.TOKEN_PREFIX + self.generate_token()
+        logger.debug('Matching players %s and %s' % (player_token, bot_token))
+        new_game = variant.create_game(player_token, bot_token)
+        self.store.game_created(new_game)
+        self._add_game(new_game)
+        self._start_bot(bot_token)
 
-            self.futures[unmatched_player].set_result(self.session_token_game_dict[unmatched_player])
+    def _start_bot(self, bot_token):
+        bot.Bot(self.session_token_game_dict[bot_token], bot_token).play()
+
+    def poll_ended(self, player_token, abandoned=False):
+        """
+        To be called when a poll for a game returned or was abandoned before the player was matched
+        :param abandoned: true if the player closed the connection, which stops the player from waiting
+        """
+        if abandoned:
+            self.matchmaker.cancel(player_token)
+            self._waiting_changed()
+        else:
+            self.matchmaker.poll_ended(player_token)
+
+    def _add_game(self, new_game):
+        """
+        Makes the game available to both of its players
+        """
+        new_game.listeners.append(self.store.record)
+        for player_token in (new_game.p1_token, new_game.p2_token):
+            self.session_token_game_dict[player_token] = game.GameProxy(new_game, player_token)
+            if player_token not in self.futures:
+                self.futures[player_token] = tornado.concurrent.Future()
             self.futures[player_token].set_result(self.session_token_game_dict[player_token])
+        self.games_by_id[spectate.game_id(new_game)] = new_game
+        self.touch(new_game.p1_token)
 
-        return self.futures[player_token]
+    def restore(self):
+        """
+        Restores the games of the store, e.g. after a restart
+        :return: number of restored games
+        """
+        restored_games = self.store.load_games()
+        for restored_game in restored_games:
+            self._add_game(restored_game)
+            for player_token in (restored_game.p1_token, restored_game.p2_token):
+                if bot is not None and bot.is_bot_token(player_token):
+                    self._start_bot(player_token)
+        return len(restored_games)
 
     def get(self, key, default=None):
+        if key in self.session_token_game_dict:
+            self.touch(key)
         return self.session_token_game_dict.get(key, default)
 
     def __getitem__(self, key):
@@ -67,39 +224,228 @@ class SessionTokenToGame(object):
 
     def __delitem__(self, key):
         del self.session_token_game_dict[key]
-        del self.futures[key]
+        future = self.futures.pop(key)
+        if not future.done():
+            # wake up a pending /waitforgame of a player who was never matched
+            future.set_result(None)
+        self.matchmaker.cancel(key)
+        self._waiting_changed()
+        self.last_access.pop(key, None)
+        self.finished_last_access.pop(key, None)
+
+    def _waiting_changed(self):
+        if self.LOBBY is not None:
+            self.LOBBY.update(self.SHARD, len(self.matchmaker))
+
+    def __len__(self):
+        return len(self.session_token_game_dict)
+
+    def touch(self, player_token):
+        """
+        Records an access to the session of the given player, and of the opponent if matched,
+        as both sessions belong to the same game.
+        """
+        now = time.monotonic()
+        player_game = self.session_token_game_dict[player_token]
+        if player_game is None or player_game.get_opponent() not in self.session_token_game_dict:
+            # the opponent's session is gone once they left the game
+            tokens = (player_token,)
+        else:
+            tokens = (player_token, player_game.get_opponent())
+
+        if player_game is not None and player_game.is_over():
+            access, other_access = self.finished_last_access, self.last_access
+        else:
+            access, other_access = self.last_access, self.finished_last_access
+
+        for token in tokens:
+            other_access.pop(token, None)
+            access[token] = now
+            access.move_to_end(token)
+
+    def evict(self, player_token):
+        """
+        Forgets the session of the given player. The game is ended, so that all requests waiting for it
+        return immediately. The opponent's session is kept as finished, so that the opponent learns
+        from the following requests that the player left, until the finished timeout evicts it.
+        """
+        player_game = self.session_token_game_dict.get(player_token)
+        if player_token in self.session_token_game_dict:
+            del self[player_token]
+        else:
+            self.last_access.pop(player_token, None)
+            self.finished_last_access.pop(player_token, None)
+        if player_game is not None:
+            player_game.abandon()
+            opponent_token = player_game.get_opponent()
+            if opponent_token in self.session_token_game_dict:
+                self.touch(opponent_token)
+            game_id = spectate.game_id(player_game)
+            self.games_by_id.pop(game_id, None)
+            move_stream = self.move_streams.pop(game_id, None)
+            if move_stream is not None:
+                move_stream.close()
+
+    def get_move_stream(self, game_id):
+        """
+        :return: spectate.MoveStream of the game with the given public id, None if there is no such game
+        """
+        move_stream = self.move_streams.get(game_id)
+        if move_stream is None and game_id in self.games_by_id:
+            move_stream = self.move_streams[game_id] = spectate.MoveStream(self.games_by_id[game_id])
+        return move_stream
+
+    def evict_expired(self):
+        """
+        Evicts all sessions that have not been accessed within their timeout.
+        Only the expired sessions are looked at.
+        :return: number of evicted sessions
+        """
+        now = time.monotonic()
+        sessions_before = len(self)
+        for (access, timeout) in ((self.last_access, self.session_timeout),
+                                  (self.finished_last_access, self.finished_timeout)):
+            while access:
+                token, last_access = next(iter(access.items()))
+                if now - last_access < timeout:
+                    break
+                self.evict(token)
+        evicted = sessions_before - len(self)
+        if evicted:
+            logger.debug('Evicted %d sessions, %d left' % (evicted, len(self)))
+        return evicted
+
+    def start_sweeper(self):
+        """
+        Periodically evicts expired sessions on the current IOLoop.
+        """
+        self.sweeper = tornado.ioloop.PeriodicCallback(self.evict_expired, self.SWEEP_INTERVAL_SECONDS * 1000)
+        self.sweeper.start()
 
     @classmethod
-    def generate_token(self):
-        return uuid.uuid1().hex
+    def generate_token(cls):
+        token = uuid.uuid1().hex
+        if cls.LOBBY is not None:
+            # new players belong to the shard where players are waiting, so that they need not be moved there
+            token = sharding.token_with_shard(token, cls.LOBBY.choose(cls.SHARD))
+        elif cls.SHARD is not None:
+            token = sharding.token_with_shard(token, cls.SHARD)
+        return token
+
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='ASCII'?>\n"
+
+XML_ATTRIBUTE_ESCAPES = {
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    '\n': '&#10;',
+    '\r': '&#13;',
+    '\t': '&#9;',
+}
+XML_ATTRIBUTE_SPECIAL_CHARS = re.compile('[&<>"\n\r\t]')
+XML_INCOMPATIBLE_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
 
 
-class XMLHandler(tornado.web.RequestHandler):
+@functools.lru_cache(maxsize=4096)
+def serialize_xml_element(tagname, attribute_items):
+    """
+    Serializes a document consisting of a single element with attributes, byte for byte like
+    etree.tostring(etree.ElementTree(etree.Element(tagname, **attributes)), xml_declaration=True),
+    but without building a tree. Responses repeat a lot, so the results are cached.
+    :param tagname: name of the element
+    :param attribute_items: tuple of (name, value) pairs, values being strings
+    :return: bytes
+    :raises ValueError if a value contains characters not allowed in XML
+    """
+    parts = [tagname]
+    for (name, value) in attribute_items:
+        if XML_INCOMPATIBLE_CHARS.search(value):
+            raise ValueError('All strings must be XML compatible: %r' % value)
+        escaped = XML_ATTRIBUTE_SPECIAL_CHARS.sub(lambda match: XML_ATTRIBUTE_ESCAPES[match.group()], value)
+        parts.append('%s="%s"' % (name, escaped))
+    return XML_DECLARATION + ('<%s/>' % ' '.join(parts)).encode('ascii', 'xmlcharrefreplace')
+
+
+class TracedRenderMixin(object):
+    """
+    Times the template renders as tracing spans, see profiling.span
+    """
+
+    def render_string(self, template_name, **kwargs):
+        with profiling.span('render ' + template_name):
+            return super().render_string(template_name, **kwargs)
+
+
+class XMLHandler(TracedRenderMixin, tornado.web.RequestHandler):
+    RESPONSE_LOG_SAMPLE_RATE = 1.0
+    """
+    Fraction of the responses written to the debug log
+    """
+
     # called before running any other methods (get, post, etc)
     def prepare(self):
         self.set_header("Content-Type", "application/xml")
 
+    def compute_etag(self):
+        # responses depend on the state of the game, hashing them for an ETag is wasted time
+        return None
+
+    @profiling.traced('XMLHandler.write_xml')
     def write_xml(self, tagname="response", **attributes):
-        xml_doc = etree.ElementTree(etree.Element(tagname, **attributes))
-        response = etree.tostring(xml_doc, xml_declaration=True)
-        logger.debug("Response: %s", response)
+        response = serialize_xml_element(tagname, tuple(attributes.items()))
+        if self.RESPONSE_LOG_SAMPLE_RATE >= 1 or random.random() < self.RESPONSE_LOG_SAMPLE_RATE:
+            logger.debug("Response: %s", response)
         self.write(response)
 
+    def log_exception(self, typ, value, tb):
+        metrics.METRICS.record_exception(type(self).__name__, typ.__name__)
+        super().log_exception(typ, value, tb)
+
 
 # new instances of the request handlers are created on every request,
 # so changes to member variables won't be seen across requests
 class DialogHandler(XMLHandler):
+    PRERENDER = False
+    """
+    If true, dialog.xml is rendered only once per explicit_feedback variant, and the token of
+    each new call is spliced into the cached result
+    """
+
+    TOKEN_PLACEHOLDER = 'TOKENPLACEHOLDER'
+
+    prerendered = {}
+    """
+    dialog.xml rendered with TOKEN_PLACEHOLDER as token, split at the placeholder, per explicit_feedback
+    """
+
     def get(self):
         explicit_feedback = bool(int(self.get_argument('explicit_feedback', '1')))
+        token = SessionTokenToGame.generate_token()
+        # the dialog contains the token of the call, so it must never be cached or revalidated
+        self.set_header('Cache-Control', 'no-store')
+
+        if not self.PRERENDER:
+            self.render("dialog.xml", **self._template_data(token, explicit_feedback))
+            return
 
-        template_data = {
-            'token': SessionTokenToGame.generate_token(),
+        if explicit_feedback not in self.prerendered:
+            # rendered in a request, as the template uses the handler's UI modules
+            rendered = self.render_string("dialog.xml", **self._template_data(self.TOKEN_PLACEHOLDER,
+                                                                              explicit_feedback))
+            DialogHandler.prerendered[explicit_feedback] = rendered.split(self.TOKEN_PLACEHOLDER.encode())
+        self.write(token.encode().join(self.prerendered[explicit_feedback]))
+
+    @staticmethod
+    def _template_data(token, explicit_feedback):
+        return {
+            'token': token,
             'grid_size': game.Game.GRID_SIZE,
             'ships': game.Game.AVAILABLE_SHIPS,
             'explicit_feedback': explicit_feedback,
             'feedback_timeout': '2s'
         }
-        self.render("dialog.xml", **template_data)
 
 
 class DynamicDataHandler(XMLHandler):
@@ -118,24 +464,102 @@ class DynamicDataHandler(XMLHandler):
         self.render("error.xml", **error_data)
 
 
+class PollShedException(tornado.gen.TimeoutError):
+    """
+    Raised instead of waiting when too many long-polls are waiting already
+    """
+    pass
+
+
 class PollDynamicDataHandler(DynamicDataHandler):
-    POLL_INTERVAL_SECONDS = 0.5
+    """
+    Base of the long-poll handlers, with admission control: at most MAX_POLLS requests wait at a time,
+    and their timeouts are shortened as the number of waiting requests approaches MAX_POLLS, so that
+    connections are given back sooner. Requests beyond MAX_POLLS are answered at once like a timed out
+    poll, with a retry attribute telling the dialog to pause before polling again.
+    """
 
-    def check_with_timeout(self, what, as_long_as_returns=None, timeout_seconds=0.0):
-        # TODO: refactor to be idiomatic wrt. to Tornado!
+    TIMEOUTS = timingwheel.TimingWheel(tick_seconds=0.1)
+    """
+    Timeouts of all waiting requests
+    """
 
-        if timeout_seconds > 0:
-            times = math.floor(timeout_seconds / self.POLL_INTERVAL_SECONDS)
-        else:
-            times = 1
-        if not times:
-            times = 1
-
-        for _ in range(times):
-            result = what()
-            if result != as_long_as_returns:
-                return result
-            yield tornado.gen.sleep(self.POLL_INTERVAL_SECONDS)
+    MAX_POLLS = 0
+    """
+    Maximum number of requests waiting at a time, unlimited if 0
+    """
+
+    MAX_TIMEOUT_SECONDS = 9.0
+    """
+    Upper bound of the timeout requested by the clients
+    """
+
+    SHORTEN_ABOVE_LOAD = 0.5
+    """
+    Fraction of MAX_POLLS above which timeouts are shortened, linearly down to MIN_TIMEOUT_SECONDS at MAX_POLLS
+    """
+
+    MIN_TIMEOUT_SECONDS = 1.0
+
+    RETRY_SECONDS = 2
+    """
+    Seconds the clients are asked to pause before polling again when their request was shed;
+    the dialog has the same pause
+    """
+
+    active_polls = 0
+    """
+    Number of requests currently waiting in wait_for
+    """
+
+    shed_polls = 0
+    """
+    Number of requests answered without waiting because MAX_POLLS requests were waiting
+    """
+
+    shortened_polls = 0
+    """
+    Number of requests whose timeout was shortened because of the load
+    """
+
+    @classmethod
+    def admitted_timeout(cls, timeout_seconds):
+        """
+        :return: seconds a request asking for timeout_seconds may wait, given the current load
+        """
+        timeout_seconds = max(0.0, min(timeout_seconds, cls.MAX_TIMEOUT_SECONDS))
+        if cls.MAX_POLLS:
+            load = cls.active_polls / cls.MAX_POLLS
+            if load > cls.SHORTEN_ABOVE_LOAD:
+                factor = (1 - load) / (1 - cls.SHORTEN_ABOVE_LOAD)
+                shortened = max(min(timeout_seconds, cls.MIN_TIMEOUT_SECONDS), timeout_seconds * factor)
+                if shortened < timeout_seconds:
+                    # counted on the base class, which /metrics reports, not on the handler class
+                    PollDynamicDataHandler.shortened_polls += 1
+                    timeout_seconds = shortened
+        return timeout_seconds
+
+    @tornado.gen.coroutine
+    def wait_for(self, future, timeout_seconds):
+        """
+        Waits for the future, but at most timeout_seconds, shortened under load
+        :return: result of the future
+        :raises tornado.gen.TimeoutError if the future is not done in time
+        :raises PollShedException if the request was not admitted; the retry attribute is set in out
+        """
+        # answers that are ready anyway never wait, so they are always admitted
+        if not future.done() and timeout_seconds > 0:
+            if self.MAX_POLLS and PollDynamicDataHandler.active_polls >= self.MAX_POLLS:
+                PollDynamicDataHandler.shed_polls += 1
+                self.out['retry'] = str(self.RETRY_SECONDS)
+                raise PollShedException()
+            timeout_seconds = self.admitted_timeout(timeout_seconds)
+
+        PollDynamicDataHandler.active_polls += 1
+        try:
+            result = yield self.TIMEOUTS.with_timeout(timeout_seconds, future)
+        finally:
+            PollDynamicDataHandler.active_polls -= 1
         return result
 
 
@@ -163,16 +587,117 @@ class WaitForGameHandler(PollDynamicDataHandler):
     def get(self):
         logger.debug("WaitForGame: %s", self.request.query)
         timeout_seconds = float(self.get_argument('timeout', 0))
-        #ready = yield from self.check_with_timeout(lambda: GAMES.get_game(self.token), as_long_as_returns=None,
-                                                   #timeout_seconds=timeout_seconds)
+        explicit_feedback = self.get_argument('feedback', 'explicit') != 'implicit'
+        variant = matchmaking.Variant.default(explicit_feedback=explicit_feedback)
         try:
-            yield tornado.gen.with_timeout(datetime.timedelta(seconds=timeout_seconds),
-                                           GAMES.get_game(self.token))
-            self.out['ready'] = "true"
+            matched_game = yield self.wait_for(GAMES.get_game(self.token, variant), timeout_seconds)
+            if matched_game is None:
+                # the session was evicted while waiting
+                self.out['ready'] = "false"
+            elif matched_game.get_game_state() is game.GameState.opponentLeft:
+                self.out['ready'] = "opponentleft"
+                # the next poll matches the player with someone else
+                GAMES.evict(self.token)
+            else:
+                self.out['ready'] = "true"
         except tornado.gen.TimeoutError:
             self.out['ready'] = "false"
+            GAMES.poll_ended(self.token)
         self.write_xml(**self.out)
 
+    def on_connection_close(self):
+        # the caller hung up while waiting, nobody should be matched with them anymore
+        GAMES.poll_ended(self.token, abandoned=True)
+
+
+# The responses of the game handlers are built by these functions, so that the HTTP handlers
+# and the push channel send exactly the same data.
+
+ORIENTATIONS = {
+    'horizontally': game.Orientation.horizontal,
+    'vertically': game.Orientation.vertical,
+}
+
+
+def next_ship_info(player_game):
+    """
+    :return: dict with name and size of the ship to place next, empty if all ships have been placed
+    """
+    ship = player_game.get_ship_to_place()
+    if ship:
+        return {
+            'name': ship.name,
+            'size': str(ship.size),
+        }
+    return {}
+
+
+def parse_coord(player_game, coord):
+    """
+    :param coord: coordinate string, e.g. 'A1'
+    :raises HTTPError 400 if it is not a coordinate
+    :raises IndexError if the coordinate is out of the grid of the game
+    """
+    try:
+        return game.Coord.parse(coord, player_game.grid_size)
+    except ValueError as e:
+        raise tornado.web.HTTPError(400, str(e))
+
+
+def place_ship(player_game, coord, orientation):
+    """
+    :param coord: coordinate string, e.g. 'A1'
+    :param orientation: 'horizontally' or 'vertically'
+    :return: dict with the outcome and the ship to place next
+    """
+    out = {
+        'conflictingcoords': '',
+        'allowed': 'yes',
+    }
+    try:
+        player_game.place_ship(top_left_coord=parse_coord(player_game, coord), orientation=ORIENTATIONS[orientation])
+    except game.OccupiedFieldsException as e:
+        out['conflictingcoords'] = ' '.join(str(occ) for occ in e.occupied_fields)
+        out['allowed'] = 'conflict'
+    except IndexError:
+        out['allowed'] = 'beyondfield'
+    out.update(next_ship_info(player_game))
+    return out
+
+
+def turn_info(player_game):
+    """
+    :return: dict with the game state and the last move of the opponent
+    """
+    game_state = player_game.get_game_state()
+    out = {'gamestate': game_state.name}
+    if game_state in (game.GameState.canPlay, game.GameState.lost):
+        (coord, what_was_at_coord) = player_game.get_last_opponent_move()
+        if coord:
+            out['coordhit'] = str(coord)
+        if what_was_at_coord:
+            out['shiptypehit'] = what_was_at_coord.name
+            out['shippartsleft'] = str(what_was_at_coord.fields_intact)
+    return out
+
+
+def shoot(player_game, coord):
+    """
+    :param coord: coordinate string, e.g. 'A1'
+    :return: dict with the ShotResult
+    """
+    return {'shot': player_game.shoot_field(parse_coord(player_game, coord)).name}
+
+
+def ship_coords(player_game):
+    """
+    :return: dict with the coordinates of the player's and the opponent's ships
+    """
+    return {
+        'owncoords': player_game.get_own_ship_coords_string(),
+        'opponentcoords': player_game.get_opponent_ship_coords_string(),
+    }
+
 
 class PlaceShipHandler(GameDynamicDataHandler):
     def prepare(self):
@@ -182,84 +707,76 @@ class PlaceShipHandler(GameDynamicDataHandler):
 
     def get(self):
         logger.debug("GET-PlaceShip: %s", self.request.query)
-        self._add_next_ship_info_to_output()
+        if not self.opponent_left():
+            self.out.update(next_ship_info(self.game))
         self.write_xml(**self.out)
 
-    def _add_next_ship_info_to_output(self):
-        ship = self.game.get_ship_to_place()
-        if ship:
-            self.out.update({
-                'name': ship.name,
-                'size': str(ship.size),
-            })
-
+    @profiling.traced('PlaceShipHandler.post')
     def post(self):
         logger.debug("POST-PlaceShip: %s", self.request.body)
-        self.out.update({
-            'conflictingcoords': '',
-            'allowed': 'yes',
-        })
-
-        coord = game.Coord(*self.get_argument('coord'))
-        map_orientation = {
-            'horizontally': game.Orientation.horizontal,
-            'vertically': game.Orientation.vertical,
-        }
-
-        orientation = map_orientation[self.get_argument('orientation')]
-        try:
-            self.game.place_ship(top_left_coord=coord, orientation=orientation)
-        except game.OccupiedFieldsException as e:
-            self.out['conflictingcoords'] = ' '.join(str(occ) for occ in e.occupied_fields)
-            self.out['allowed'] = 'conflict'
-        except IndexError:
-            self.out['allowed'] = 'beyondfield'
-        self._add_next_ship_info_to_output()
+        if not self.opponent_left():
+            self.out.update(place_ship(self.game, self.get_argument('coord'), self.get_argument('orientation')))
         self.write_xml(**self.out)
 
+    def opponent_left(self):
+        """
+        :return: true if the opponent left while the player was placing ships; the game state is then set in out
+        """
+        if self.game.get_game_state() is game.GameState.opponentLeft:
+            self.out['gamestate'] = game.GameState.opponentLeft.name
+            return True
+        return False
+
 
 class WaitForTurnHandler(GameDynamicDataHandler, PollDynamicDataHandler):
+    @profiling.traced('WaitForTurnHandler.get')
     @tornado.gen.coroutine
     def get(self):
         logger.debug("WaitForTurn: %s", self.request.query)
         timeout_seconds = float(self.get_argument('timeout', 0))
         try:
-            yield tornado.gen.with_timeout(datetime.timedelta(seconds=timeout_seconds),
-                                           self.game.wait_for_turn())
+            yield self.wait_for(self.game.wait_for_turn(), timeout_seconds)
         except tornado.gen.TimeoutError:
             pass
-        #game_state = yield from self.check_with_timeout(lambda: self.game.get_game_state(),
-        #                                                as_long_as_returns=game.GameState.wait,
-        #                                                timeout_seconds=timeout_seconds)
-        game_state = self.game.get_game_state()
-        self.out['gamestate'] = game_state.name
-        if game_state in (game.GameState.canPlay, game.GameState.lost):
-            (coord, what_was_at_coord) = self.game.get_last_opponent_move()
-            if coord:
-                self.out['coordhit'] = str(coord)
-            if what_was_at_coord:
-                self.out['shiptypehit'] = what_was_at_coord.name
-                self.out['shippartsleft'] = str(what_was_at_coord.fields_intact)
+        self.out.update(turn_info(self.game))
         self.write_xml(**self.out)
 
 
 class PutCoordHandler(GameDynamicDataHandler):
+    @profiling.traced('PutCoordHandler.get')
     def get(self):
         logger.debug("PutCoord: %s", self.request.query)
-        coord = game.Coord(*self.get_argument('coord'))
-        shot_result = self.game.shoot_field(coord)
-        self.out['shot'] = shot_result.name
+        self.out.update(shoot(self.game, self.get_argument('coord')))
+        self.write_xml(**self.out)
+
+
+class ShootAndWaitHandler(GameDynamicDataHandler, PollDynamicDataHandler):
+    """
+    /putcoord and /waitforturn in one request, saving a round trip per turn: shoots, then waits for
+    the opponent's move. Answers with the shot attribute of /putcoord and the attributes of /waitforturn,
+    whose game state is 'wait' if the opponent has not moved in time. A field that was shot at already
+    does not pass the turn, the answer then only has the shot attribute.
+    """
+
+    @profiling.traced('ShootAndWaitHandler.get')
+    @tornado.gen.coroutine
+    def get(self):
+        logger.debug("ShootAndWait: %s", self.request.query)
+        timeout_seconds = float(self.get_argument('timeout', 0))
+        self.out.update(shoot(self.game, self.get_argument('coord')))
+        if self.out['shot'] != game.ShotResult.alreadyShot.name:
+            try:
+                yield self.wait_for(self.game.wait_for_turn(), timeout_seconds)
+            except tornado.gen.TimeoutError:
+                pass
+            self.out.update(turn_info(self.game))
         self.write_xml(**self.out)
 
 
 class QuitAppHandler(DynamicDataHandler):
     def post(self):
         logger.debug("QuitGame: %s", self.request.query)
-        game = GAMES.get(self.token)
-        if game:
-            opponent_token = game.get_opponent()
-            del GAMES[self.token]
-            del GAMES[opponent_token]
+        GAMES.evict(self.token)
         self.write_xml(**self.out)
 
 
@@ -274,43 +791,523 @@ class LogHandler(XMLHandler):
 
 class GetShipCoordsHandler(GameDynamicDataHandler):
     def get(self):
-        self.out['owncoords'] = ' '.join(str(coord) for coord in self.game.get_own_ship_coords())
-        self.out['opponentcoords'] = ' '.join(str(coord) for coord in self.game.get_opponent_ship_coords())
+        self.out.update(ship_coords(self.game))
         self.write_xml(**self.out)
 
-class WebViewHandler(tornado.web.RequestHandler):
+class PushSession(object):
+    """
+    Pushes the events of a player's game: 'matched' with the first ship to place once an opponent
+    is found, and 'turn' with the same data as /waitforturn whenever it becomes the player's turn
+    or the game ends. Events are dicts passed to the send callback.
+    """
+
+    def __init__(self, token, send):
+        """
+        :param token: session token of the player
+        :param send: callable taking an event dict
+        """
+        self.token = token
+        self.send = send
+        self.game = None
+        self.closed = False
+        self.watching = False
+
+    @tornado.gen.coroutine
+    def run(self):
+        player_game = yield GAMES.get_game(self.token)
+        if self.closed:
+            return
+        if player_game is None:
+            # the session was evicted before an opponent was found
+            self.send({'event': 'evicted'})
+            return
+        self.game = player_game
+        self.game.listeners.append(self.on_game_changed)
+        event = {'event': 'matched'}
+        event.update(next_ship_info(self.game))
+        self.send(event)
+        if not self.game.get_ship_to_place():
+            self.watch_turn()
+
+    def on_game_changed(self, changed_game, method_name, player_token, *args):
+        """
+        Game listener: once the player has placed all ships or made a move, wait for the next turn.
+        If someone left, the game is over even if the player is still placing ships.
+        """
+        if method_name == 'abandon':
+            if not self.watching:
+                self.watch_turn()
+        elif player_token != self.token:
+            return
+        elif method_name == 'shoot_field' or (method_name == 'place_ship' and not self.game.get_ship_to_place()):
+            self.watch_turn()
+
+    @tornado.gen.coroutine
+    def watch_turn(self):
+        self.watching = True
+        yield self.game.wait_for_turn()
+        self.watching = False
+        if not self.closed:
+            event = {'event': 'turn'}
+            event.update(turn_info(self.game))
+            self.send(event)
+
+    def handle_command(self, command):
+        """
+        Executes a command sent by the player
+        :param command: dict with 'command' being one of placeship, putcoord or getshipcoords
+        :return: event with the result of the command
+        """
+        player_game = GAMES.get(self.token)
+        if not player_game:
+            return {'event': 'error', 'type': GameVanishedException.__name__}
+        name = command.get('command')
+        if name == 'placeship':
+            event = place_ship(player_game, command['coord'], command['orientation'])
+        elif name == 'putcoord':
+            event = shoot(player_game, command['coord'])
+        elif name == 'getshipcoords':
+            event = ship_coords(player_game)
+        else:
+            return {'event': 'error', 'type': 'UnknownCommand', 'message': str(name)}
+        event['event'] = name
+        return event
+
+    def start(self, on_failure):
+        """
+        Runs the session in the background
+        :param on_failure: called without arguments if the session failed, once the error is logged
+                           and the session is closed
+        """
+        def check(running):
+            if running.exception() is not None:
+                logger.error('Push session of %s failed', self.token, exc_info=running.exception())
+                self.close()
+                on_failure()
+        tornado.ioloop.IOLoop.current().add_future(self.run(), check)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.game is None:
+            # the player hung up while waiting, nobody should be matched with them anymore
+            GAMES.poll_ended(self.token, abandoned=True)
+        elif self.on_game_changed in self.game.listeners:
+            self.game.listeners.remove(self.on_game_changed)
+
+
+class PushSocketHandler(tornado.websocket.WebSocketHandler):
+    """
+    Push channel over a WebSocket. Commands are accepted as JSON messages over the same connection.
+    """
+
+    def open(self):
+        self.token = self.get_argument('token')
+        logger.debug("Push-Open: %s", self.request.query)
+        self.session = PushSession(self.token, self.send_event)
+        self.session.start(self.close)
+
+    def send_event(self, event):
+        if self.ws_connection is not None:
+            self.write_message(json.dumps(event))
+
+    def on_message(self, message):
+        logger.debug("Push-Command: %s %s", self.token, message)
+        try:
+            event = self.session.handle_command(json.loads(message))
+        except Exception as e:
+            event = {'event': 'error', 'type': type(e).__name__, 'message': str(e)}
+        self.send_event(event)
+
+    def on_close(self):
+        self.session.close()
+
+
+class PushEventsHandler(tornado.web.RequestHandler):
+    """
+    Push channel as server-sent events, for clients without WebSockets.
+    Commands are sent to the usual endpoints (/placeship, /putcoord, /getshipcoords).
+    """
+
+    KEEPALIVE_SECONDS = 15
+
+    @tornado.gen.coroutine
+    def get(self):
+        token = self.get_argument('token')
+        logger.debug("Push-Events: %s", self.request.query)
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-store')
+        self.session = PushSession(token, self.send_event)
+        failed = tornado.locks.Event()
+        self.session.start(failed.set)
+        # keep the stream open until the client goes away or the session fails, with comments keeping
+        # proxies from closing it
+        while not self.session.closed:
+            self.write(': keepalive\n\n')
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
+                break
+            try:
+                yield failed.wait(timeout=datetime.timedelta(seconds=self.KEEPALIVE_SECONDS))
+            except tornado.gen.TimeoutError:
+                pass
+
+    def send_event(self, event):
+        if not self.session.closed:
+            self.write('data: %s\n\n' % json.dumps(event))
+            self.flush()
+
+    def on_connection_close(self):
+        self.session.close()
+
+
+class SpectateHandler(tornado.web.RequestHandler):
+    """
+    Without game argument, lists the running games as JSON. With the id of a game, streams its moves
+    as server-sent events from the sequence number given as since, or after the Last-Event-ID of
+    a reconnecting EventSource, until the game is gone.
+    """
+
+    KEEPALIVE_SECONDS = 15
+
+    @tornado.gen.coroutine
+    def get(self):
+        game_id = self.get_argument('game', None)
+        if game_id is None:
+            self.write({'games': [
+                {'game': running_id, 'moves': sum(len(player.moves) for player in running_game.players.values()),
+                 'spectators': len(GAMES.move_streams[running_id].spectators) if running_id in GAMES.move_streams
+                 else 0}
+                for (running_id, running_game) in GAMES.games_by_id.items()
+            ]})
+            return
+
+        move_stream = GAMES.get_move_stream(game_id)
+        if move_stream is None:
+            raise tornado.web.HTTPError(404, 'no such game')
+        last_event_id = self.request.headers.get('Last-Event-ID')
+        try:
+            since = int(self.get_argument('since', int(last_event_id) + 1 if last_event_id else 0))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'since and Last-Event-ID must be sequence numbers')
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-store')
+        self.closed = False
+        self.move_stream = move_stream
+        self.spectator = move_stream.subscribe(self.send_events, self.close_stream, since)
+        while not self.closed:
+            self.write(': keepalive\n\n')
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
+                break
+            yield tornado.gen.sleep(self.KEEPALIVE_SECONDS)
+        self.move_stream.unsubscribe(self.spectator)
+
+    def send_events(self, events):
+        """
+        :param events: encoded events, shared with the other spectators
+        """
+        if not self.closed:
+            self.write(events)
+            self.flush()
+
+    def close_stream(self):
+        if not self.closed:
+            self.closed = True
+            self.finish()
+
+    def on_connection_close(self):
+        self.closed = True
+        if getattr(self, 'spectator', None) is not None:
+            self.move_stream.unsubscribe(self.spectator)
+
+
+class WebViewHandler(TracedRenderMixin, tornado.web.RequestHandler):
     def get(self):
         self.render("webview.html", token=SessionTokenToGame.generate_token(),
                     gridsize=game.Game.GRID_SIZE)
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Serves the request metrics and the state of the sessions in the Prometheus text format
+    """
+
+    STALL_DETECTOR = None
+    """
+    profiling.StallDetector of the process, if any
+    """
+
+    def get(self):
+        # gauges are computed here rather than kept up to date on every change, scrapes are rare
+        pending_futures = sum(not future.done() for future in GAMES.futures.values())
+        game_states = collections.Counter()
+        for player_game in GAMES.session_token_game_dict.values():
+            if player_game is not None:
+                game_states[player_game.get_game_state()] += 1
+                pending_futures += not player_game.wait_for_turn().done()
+        matchmaking_stats = GAMES.matchmaker.stats()
+
+        lines = metrics.METRICS.format()
+        lines += metrics.format_gauge('battleships_sessions', 'Live sessions.', len(GAMES))
+        lines += metrics.format_gauge('battleships_waiting_players', 'Players waiting for a game.',
+                                      len(GAMES.matchmaker))
+        lines += metrics.format_gauge('battleships_pending_futures', 'Futures players may be waiting for.',
+                                      pending_futures)
+        lines += metrics.format_gauge('battleships_long_polls', 'Long-poll requests currently waiting.',
+                                      PollDynamicDataHandler.active_polls)
+        lines += metrics.format_gauge('battleships_long_poll_limit',
+                                      'Maximum number of waiting long-polls, 0 if unlimited.',
+                                      PollDynamicDataHandler.MAX_POLLS)
+        lines += metrics.format_counter('battleships_long_polls_shed_total',
+                                        'Long-polls answered at once with a retry because of the limit.',
+                                        PollDynamicDataHandler.shed_polls)
+        lines += metrics.format_counter('battleships_long_polls_shortened_total',
+                                        'Long-polls whose timeout was shortened because of the load.',
+                                        PollDynamicDataHandler.shortened_polls)
+        lines += metrics.format_counter('battleships_long_polls_timed_out_total',
+                                        'Long-polls that timed out without an answer.',
+                                        PollDynamicDataHandler.TIMEOUTS.expired)
+        lines += metrics.format_gauge('battleships_spectators', 'Spectators of the running games.',
+                                      sum(len(move_stream.spectators) for move_stream in GAMES.move_streams.values()))
+        lines += metrics.format_gauge('battleships_players', 'Matched players per game state.',
+                                      {'state="%s"' % state.name: game_states[state] for state in game.GameState})
+        lines += metrics.format_counter('battleships_matched_total', 'Players matched with an opponent.',
+                                        matchmaking_stats['matched'])
+        lines += metrics.format_counter('battleships_match_cancelled_total', 'Players who stopped waiting.',
+                                        matchmaking_stats['cancelled'])
+        lines += metrics.format_counter('battleships_match_dropped_idle_total',
+                                        'Waiting players dropped because they stopped polling.',
+                                        matchmaking_stats['dropped_idle'])
+        lines += metrics.format_gauge('battleships_time_to_match_median_seconds',
+                                      'Median time to match of the recent matches.',
+                                      matchmaking_stats['time_to_match_median'] or 0)
+        if self.STALL_DETECTOR is not None:
+            lines += metrics.format_counter('battleships_ioloop_stalls_total',
+                                            'Times a callback blocked the IOLoop longer than the stall threshold.',
+                                            self.STALL_DETECTOR.stalls)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write('\n'.join(lines) + '\n')
+
+
+class AdminHandler(tornado.web.RequestHandler):
+    """
+    Base of the handlers of the admin application, which only listens on localhost. Requests from
+    elsewhere are refused all the same, in case it is ever put behind a proxy.
+    """
+
+    LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+    def prepare(self):
+        if self.request.remote_ip not in self.LOCAL_ADDRESSES:
+            raise tornado.web.HTTPError(403)
+
+
+class ProfileHandler(AdminHandler):
+    """
+    Samples the stack of the IOLoop thread for some seconds and answers with the collapsed stacks,
+    e.g. for flamegraph.pl or speedscope:
+      curl 'http://127.0.0.1:ADMINPORT/admin/profile?seconds=30' > battleships.folded
+    """
+
+    MAX_SECONDS = 300
+
+    profiler = None
+    """
+    the running profiler; there is one at most
+    """
+
+    @tornado.gen.coroutine
+    def get(self):
+        seconds = float(self.get_argument('seconds', '10'))
+        interval_seconds = float(self.get_argument('interval', '0.005'))
+        if not 0 < seconds <= self.MAX_SECONDS or not 0.0001 <= interval_seconds <= 1:
+            raise tornado.web.HTTPError(400, 'seconds must be in (0, %d], interval in [0.0001, 1]' % self.MAX_SECONDS)
+        if ProfileHandler.profiler is not None:
+            raise tornado.web.HTTPError(409, 'A profile is already being taken')
+        profiler = ProfileHandler.profiler = profiling.SamplingProfiler(threading.get_ident(), interval_seconds)
+        logger.info('Profiling for %gs' % seconds)
+        profiler.start()
+        try:
+            yield tornado.gen.sleep(seconds)
+        finally:
+            profiler.stop()
+            ProfileHandler.profiler = None
+        logger.info('Profiled %d samples' % profiler.sample_count)
+        self.set_header('Content-Type', 'text/plain')
+        self.write('\n'.join(profiler.collapsed()) + '\n')
+
+
+class TracingHandler(AdminHandler):
+    """
+    GET: whether tracing is enabled, and the times of the spans recorded so far.
+    POST enabled=1|0 to switch tracing on or off, reset=1 to forget the recorded spans.
+    """
+
+    def get(self):
+        self.write({'enabled': profiling.TRACER.enabled, 'spans': profiling.TRACER.stats()})
+
+    def post(self):
+        enabled = self.get_argument('enabled', None)
+        if enabled is not None:
+            if bool(int(enabled)):
+                profiling.TRACER.enable()
+            else:
+                profiling.TRACER.disable()
+            logger.info('Tracing %s' % ('enabled' if profiling.TRACER.enabled else 'disabled'))
+        if bool(int(self.get_argument('reset', '0'))):
+            profiling.TRACER.reset()
+        self.get()
+
+
+def log_request(handler):
+    """
+    Logs a structured record for every finished request, instead of Tornado's access log
+    """
+    status = handler.get_status()
+    duration = handler.request.request_time()
+    metrics.METRICS.record_request(type(handler).__name__, status, duration)
+    if status < 400:
+        level = logging.INFO
+    elif status < 500:
+        level = logging.WARNING
+    else:
+        level = logging.ERROR
+    request = handler.request
+    out = getattr(handler, 'out', None) or {}
+    logger.log(level, "Request: %s %s %d", request.method, request.path, status, extra={
+        'handler': type(handler).__name__,
+        'token': getattr(handler, 'token', None),
+        'method': request.method,
+        'path': request.path,
+        'status': status,
+        'duration': duration,
+        'gamestate': out.get('gamestate'),
+    })
+
+
+STATIC_PATH = 'static'
+
+
+def make_app(**settings):
+    # the assets are read into memory now rather than on the first request
+    assets.StaticAssetHandler.get_store(STATIC_PATH)
+    return tornado.web.Application([
+                                       (r"/dialog", DialogHandler),
+                                       (r"/waitforgame", WaitForGameHandler),
+                                       (r"/placeship", PlaceShipHandler),
+                                       (r"/waitforturn", WaitForTurnHandler),
+                                       (r"/putcoord", PutCoordHandler),
+                                       (r"/shootandwait", ShootAndWaitHandler),
+                                       (r"/getshipcoords", GetShipCoordsHandler),
+                                       (r"/quitapp", QuitAppHandler),
+                                       (r"/log", LogHandler),
+                                       (r"/webview", WebViewHandler),
+                                       (r"/push", PushSocketHandler),
+                                       (r"/events", PushEventsHandler),
+                                       (r"/metrics", MetricsHandler),
+                                       (r"/spectate", SpectateHandler),
+                                   ], template_path="templates", log_function=log_request,
+                                   static_path=STATIC_PATH, static_handler_class=assets.StaticAssetHandler, **settings)
+
+
+def make_admin_app():
+    """
+    :return: application of the admin endpoints, to listen on localhost only
+    """
+    return tornado.web.Application([
+        (r"/admin/profile", ProfileHandler),
+        (r"/admin/tracing", TracingHandler),
+    ], log_function=log_request)
+
+
 if __name__ == "__main__":
     args = docopt(__doc__)
-    loop = tornado.ioloop.IOLoop.current()
     logger = logging.getLogger('battleships-web')
     logger.setLevel(logging.DEBUG)
-    logger.addHandler(logging.FileHandler("battleships.log"))
-
-    # debug=True will reload the application if a file is changed,
-    # and disable the template cache, among other things
-    app = tornado.web.Application([
-                                      (r"/dialog", DialogHandler),
-                                      (r"/waitforgame", WaitForGameHandler),
-                                      (r"/placeship", PlaceShipHandler),
-                                      (r"/waitforturn", WaitForTurnHandler),
-                                      (r"/putcoord", PutCoordHandler),
-                                      (r"/getshipcoords", GetShipCoordsHandler),
-                                      (r"/quitapp", QuitAppHandler),
-                                      (r"/log", LogHandler),
-                                      (r"/webview", WebViewHandler),
-                                      (r"/static/(.*)", tornado.web.StaticFileHandler, {'path': 'static'})
-                                  ], template_path="templates", debug=True)
+    XMLHandler.RESPONSE_LOG_SAMPLE_RATE = float(args['--response-log-sample'])
+    if args['--grid'] not in ('Grid', 'BitboardGrid'):
+        raise SystemExit('--grid must be Grid or BitboardGrid')
+    game.Game.GRID_CLASS = getattr(game, args['--grid'])
+    PollDynamicDataHandler.MAX_POLLS = int(args['--max-long-polls'])
+    PollDynamicDataHandler.MAX_TIMEOUT_SECONDS = float(args['--max-poll-timeout'])
 
     port = int(args['--port'])
     address = args['--listen'] or ''
-    app.listen(port, address=address)
-    logger.debug('Server listening on %s:%s' % (address, port))
-    GAMES = SessionTokenToGame()
+    workers = int(args['--workers'])
+    production = args['--production']
+    session_timeout = float(args['--session-timeout'])
+    store_path = args['--store']
+    bot_wait = float(args['--bot-wait'])
+    admin_port = int(args['--admin-port'])
+    stall_threshold = float(args['--stall-threshold'])
+    if bot_wait and bot is None:
+        raise SystemExit('--bot-wait needs NumPy')
+
+    if workers:
+        worker_port = int(args['--worker-port'])
+        worker_urls = ['http://127.0.0.1:%d' % (worker_port + shard) for shard in range(workers)]
+        if workers > sharding.MAX_SHARDS:
+            raise SystemExit('At most %d workers are supported' % sharding.MAX_SHARDS)
+        SessionTokenToGame.LOBBY = sharding.Lobby(workers)
+        # all workers accept the connections of the public port. Crashed processes are restarted.
+        sockets = tornado.netutil.bind_sockets(port, address=address)
+        shard = tornado.process.fork_processes(workers)
+        SessionTokenToGame.SHARD = spectate.SHARD = shard
+        if admin_port:
+            admin_port += shard
+        if store_path:
+            store_path = '%s.%d' % (store_path, shard)
+        # autoreload does not work with multiple processes
+        app = make_app(debug=not production, autoreload=False)
+    else:
+        # debug=True will reload the application if a file is changed,
+        # and disable the template cache, among other things
+        app = make_app(debug=not production)
+    DialogHandler.PRERENDER = production
+
+    # the thread writing the log has to be started after forking. Records are not passed on
+    # to the synchronous stderr handler of the root logger.
+    logger.propagate = False
+    asynclog.log_to_file(logger, "battleships.log", structured=args['--log-format'] == 'json',
+                         max_queue_size=int(args['--log-queue-size']))
+    loop = tornado.ioloop.IOLoop.current()
+    if workers:
+        router = sharding.ShardRouter(shard, worker_urls, SessionTokenToGame.LOBBY,
+                                      lambda token: token in GAMES.session_token_game_dict,
+                                      session_timeout=session_timeout)
+        tornado.httpserver.HTTPServer(sharding.ShardingDelegate(app, router)).add_sockets(sockets)
+        tornado.httpserver.HTTPServer(sharding.ShardingDelegate(app, router, private=True)).listen(
+            worker_port + shard, address='127.0.0.1')
+        logger.debug('Worker %d listening on %s:%s and 127.0.0.1:%s' % (shard, address, port, worker_port + shard))
+    else:
+        app.listen(port, address=address)
+        logger.debug('Server listening on %s:%s' % (address, port))
+    if admin_port:
+        make_admin_app().listen(admin_port, address='127.0.0.1')
+        logger.debug('Admin endpoints listening on 127.0.0.1:%s' % admin_port)
+    if stall_threshold:
+        MetricsHandler.STALL_DETECTOR = profiling.StallDetector(stall_threshold)
+        MetricsHandler.STALL_DETECTOR.start()
+    store = None
+    if store_path:
+        store = gamestore.SQLiteGameStore(store_path, snapshot_interval=float(args['--snapshot-interval']))
+    GAMES = SessionTokenToGame(session_timeout=session_timeout,
+                               finished_timeout=float(args['--finished-timeout']),
+                               max_sessions=int(args['--max-sessions']),
+                               store=store,
+                               bot_wait=bot_wait)
+    if store:
+        started = time.monotonic()
+        restored = GAMES.restore()
+        # folds the log of the restored games into their states
+        loop.add_callback(store.snapshot)
+        logger.debug('Restored %d games in %.2fs' % (restored, time.monotonic() - started))
+        store.start()
+    GAMES.start_sweeper()
 
     # this starts the event loop. Tornado is single threaded,
     # and will sleep until it is notified of new events on one of
@@ -0,0 +1,172 @@
+"""
+Matchmaking of the players waiting for a game: first come, first served queues, one per game variant.
+"""
+
+import collections
+import functools
+import logging
+import time
+
+import game
+
+logger = logging.getLogger('battleships-web')
+
+
+class Variant(collections.namedtuple('Variant', 'grid_size fleet explicit_feedback')):
+    """
+    Game configuration players are matched by; only players waiting for the same variant are matched.
+    fleet is a tuple of (name, size, count) of the ships to place.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def default(cls, explicit_feedback=True):
+        """
+        :return: Variant with the grid size and fleet configured in game.Game
+        """
+        fleet = tuple((ship.name, ship.size, count) for (ship, count) in game.Game.AVAILABLE_SHIPS)
+        return cls(game.Game.GRID_SIZE, fleet, explicit_feedback)
+
+    @functools.lru_cache(maxsize=None)
+    def available_ships(self):
+        """
+        :return: the fleet as tuple of (Ship, count) like game.Game.AVAILABLE_SHIPS, the same templates
+                 for all games of the variant
+        """
+        return tuple((game.Ship(name, size), count) for (name, size, count) in self.fleet)
+
+    def create_game(self, p1_token, p2_token):
+        return game.Game(p1_token, p2_token, grid_size=self.grid_size, available_ships=self.available_ships())
+
+
+class Matchmaker(object):
+    """
+    Keeps the waiting players in one queue per Variant, in order of arrival, and matches every newly
+    arriving player with the one who has been waiting longest. Adding, matching and removing a waiting
+    player are O(1).
+
+    A player is waiting while polling /waitforgame. Between two polls a player is idle; players who have
+    been idle for longer than IDLE_TIMEOUT_SECONDS, e.g. because they hung up, are dropped when their turn
+    to be matched comes instead of being matched.
+    """
+
+    IDLE_TIMEOUT_SECONDS = 20
+
+    RECENT_MATCHES = 1000
+    """
+    Number of recent times to match kept for the statistics
+    """
+
+    def __init__(self):
+        # per Variant, the tokens of the waiting players mapped to the time they started waiting,
+        # in order of arrival
+        self.pools = collections.defaultdict(collections.OrderedDict)
+        self.variants = {}
+        """
+        Variant of every waiting player
+        """
+        self.idle_since = {}
+        """
+        time the last poll of every idle waiting player ended
+        """
+        self.match_times = collections.deque(maxlen=self.RECENT_MATCHES)
+        """
+        seconds the first player of the most recent matches waited
+        """
+        self.matched = 0
+        self.cancelled = 0
+        self.dropped_idle = 0
+
+    def is_waiting(self, player_token):
+        return player_token in self.variants
+
+    def match(self, player_token, variant):
+        """
+        Matches the player with the longest waiting player of the variant, or lets the player wait
+        :param player_token: token of a player who is not waiting yet
+        :param variant: Variant the player wants to play
+        :return: token of the opponent, None if the player has to wait
+        """
+        pool = self.pools[variant]
+        now = time.monotonic()
+        while pool:
+            (opponent_token, waiting_since) = pool.popitem(last=False)
+            del self.variants[opponent_token]
+            idle_since = self.idle_since.pop(opponent_token, None)
+            if idle_since is not None and now - idle_since > self.IDLE_TIMEOUT_SECONDS:
+                self.dropped_idle += 1
+                continue
+            self.matched += 1
+            self.match_times.append(now - waiting_since)
+            logger.debug('Time to match %.3fs, %d players waiting' % (now - waiting_since, len(self.variants)))
+            return opponent_token
+
+        pool[player_token] = now
+        self.variants[player_token] = variant
+        return None
+
+    def take(self, player_token, min_waiting_seconds=0):
+        """
+        Removes a waiting player to be matched by other means, e.g. with a bot
+        :param player_token: token of the player
+        :param min_waiting_seconds: minimum time the player must have been waiting
+        :return: Variant the player was waiting for, None if the player is not waiting, has not been
+                 waiting long enough or has been idle for longer than IDLE_TIMEOUT_SECONDS
+        """
+        variant = self.variants.get(player_token)
+        if variant is None:
+            return None
+        now = time.monotonic()
+        waiting_since = self.pools[variant][player_token]
+        idle_since = self.idle_since.get(player_token)
+        if now - waiting_since < min_waiting_seconds or \
+                (idle_since is not None and now - idle_since > self.IDLE_TIMEOUT_SECONDS):
+            return None
+        del self.variants[player_token]
+        del self.pools[variant][player_token]
+        self.idle_since.pop(player_token, None)
+        self.matched += 1
+        self.match_times.append(now - waiting_since)
+        return variant
+
+    def poll_started(self, player_token):
+        self.idle_since.pop(player_token, None)
+
+    def poll_ended(self, player_token):
+        """
+        To be called when a poll of a waiting player returned without a game
+        """
+        if player_token in self.variants:
+            self.idle_since[player_token] = time.monotonic()
+
+    def cancel(self, player_token):
+        """
+        Stops the player from waiting, e.g. because the player hung up
+        """
+        variant = self.variants.pop(player_token, None)
+        if variant is not None:
+            del self.pools[variant][player_token]
+            self.idle_since.pop(player_token, None)
+            self.cancelled += 1
+
+    def __len__(self):
+        """
+        :return: number of waiting players
+        """
+        return len(self.variants)
+
+    def stats(self):
+        """
+        :return: dict of the counters, the number of waiting players per variant and the median and
+                 maximum of the recent times to match in seconds
+        """
+        match_times = sorted(self.match_times)
+        return {
+            'waiting': {variant: len(pool) for (variant, pool) in self.pools.items() if pool},
+            'matched': self.matched,
+            'cancelled': self.cancelled,
+            'dropped_idle': self.dropped_idle,
+            'time_to_match_median': match_times[len(match_times) // 2] if match_times else None,
+            'time_to_match_max': match_times[-1] if match_times else None,
+        }
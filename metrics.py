@@ -0,0 +1,171 @@
+"""
+Request metrics, exposed in the Prometheus text format.
+
+Everything runs on the IOLoop thread, so the counters are plain ints. Recording a request only
+increments a few ints of structures that are created on the first request of each handler.
+"""
+
+import bisect
+import collections
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+"""
+Upper bounds of the buckets of the latency histograms in seconds; the long-polls end up in the upper ones
+"""
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        """
+        number of observations per bucket, not cumulative; the last one counts those above all buckets
+        """
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def format(self, name, labels):
+        """
+        :param labels: label string without braces, e.g. 'handler="DialogHandler"'
+        :return: list of lines in the Prometheus text format
+        """
+        lines = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, self.count))
+        lines.append('%s_sum{%s} %s' % (name, labels, repr(self.sum)))
+        lines.append('%s_count{%s} %d' % (name, labels, self.count))
+        return lines
+
+
+class HandlerMetrics(object):
+    __slots__ = ('statuses', 'exceptions', 'latency')
+
+    def __init__(self):
+        self.statuses = {}
+        """
+        number of requests per status code
+        """
+        self.exceptions = {}
+        """
+        number of uncaught exceptions per exception class name
+        """
+        self.latency = Histogram()
+
+
+class Metrics(object):
+    """
+    Counts requests, their latency, status codes and uncaught exceptions per handler
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        """
+        HandlerMetrics per handler class name
+        """
+
+    def _handler(self, handler_name):
+        metrics = self.handlers.get(handler_name)
+        if metrics is None:
+            metrics = self.handlers[handler_name] = HandlerMetrics()
+        return metrics
+
+    def record_request(self, handler_name, status, duration):
+        """
+        :param handler_name: name of the handler class
+        :param status: HTTP status code of the response
+        :param duration: seconds from receiving the request to finishing the response
+        """
+        metrics = self._handler(handler_name)
+        metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+        metrics.latency.observe(duration)
+
+    def record_exception(self, handler_name, exception_name):
+        metrics = self._handler(handler_name)
+        metrics.exceptions[exception_name] = metrics.exceptions.get(exception_name, 0) + 1
+
+    def format(self):
+        """
+        :return: list of lines in the Prometheus text format
+        """
+        handlers = sorted(self.handlers.items())
+        lines = [
+            '# HELP battleships_requests_total Requests per handler and status code.',
+            '# TYPE battleships_requests_total counter',
+        ]
+        for (handler_name, metrics) in handlers:
+            for (status, count) in sorted(metrics.statuses.items()):
+                lines.append('battleships_requests_total{handler="%s",status="%d"} %d' % (handler_name, status, count))
+        lines.append('# HELP battleships_exceptions_total Uncaught exceptions per handler and exception.')
+        lines.append('# TYPE battleships_exceptions_total counter')
+        for (handler_name, metrics) in handlers:
+            for (exception_name, count) in sorted(metrics.exceptions.items()):
+                lines.append('battleships_exceptions_total{handler="%s",exception="%s"} %d' %
+                             (handler_name, exception_name, count))
+        lines.append('# HELP battleships_request_duration_seconds Time to respond per handler, long-polls included.')
+        lines.append('# TYPE battleships_request_duration_seconds histogram')
+        for (handler_name, metrics) in handlers:
+            lines.extend(metrics.latency.format('battleships_request_duration_seconds', 'handler="%s"' % handler_name))
+        return lines
+
+
+def format_gauge(name, help_text, values):
+    """
+    :param values: number, or dict of label string (without braces) to number
+    :return: list of lines in the Prometheus text format
+    """
+    lines = ['# HELP %s %s' % (name, help_text), '# TYPE %s gauge' % name]
+    if isinstance(values, dict):
+        lines.extend('%s{%s} %s' % (name, labels, value) for (labels, value) in sorted(values.items()))
+    else:
+        lines.append('%s %s' % (name, values))
+    return lines
+
+
+def format_counter(name, help_text, value):
+    return ['# HELP %s %s' % (name, help_text), '# TYPE %s counter' % name, '%s %s' % (name, value)]
+
+
+def merge_shards(shard_lines):
+    """
+    Merges the metrics of several processes, adding a shard label to every sample
+    :param shard_lines: list of lines in the Prometheus text format per shard, index in the list is the shard number
+    :return: list of lines in the Prometheus text format, with the samples of a metric of all shards grouped
+             after its HELP and TYPE lines
+    """
+    families = collections.OrderedDict()
+    """
+    tuple of the comment lines and the samples per metric name
+    """
+    for (shard, lines) in enumerate(shard_lines):
+        (comments, samples) = ([], [])
+        for line in lines:
+            if line.startswith('# '):
+                # '# HELP name text' or '# TYPE name type', the samples of the metric follow
+                (comments, samples) = families.setdefault(line.split(' ', 3)[2], ([], []))
+                if line not in comments:
+                    comments.append(line)
+            elif line:
+                (series, value) = line.rsplit(' ', 1)
+                if '{' in series:
+                    series = series.replace('{', '{shard="%d",' % shard, 1)
+                else:
+                    series = '%s{shard="%d"}' % (series, shard)
+                samples.append('%s %s' % (series, value))
+    merged = []
+    for (comments, samples) in families.values():
+        merged.extend(comments)
+        merged.extend(samples)
+    return merged
+
+
+METRICS = Metrics()
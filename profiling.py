@@ -0,0 +1,285 @@
+"""
+Visibility into the IOLoop thread, for latency spikes in production:
+
+- SamplingProfiler samples the stack of the IOLoop thread from another thread, for an on-demand
+  profile in the collapsed-stack format read by flamegraph.pl, speedscope and the like.
+- Tracing spans time the hot paths, see traced and span. They are toggled at runtime with
+  TRACER.enable and TRACER.disable. While tracing is off, a span only costs a check of a flag,
+  and traced methods are not wrapped at all.
+- StallDetector logs the stack of the IOLoop thread whenever a callback blocks it for too long.
+
+All of them look at one thread from another with sys._current_frames, so the IOLoop thread does
+no work for the profiler, and a blocked IOLoop is caught while it is still blocked.
+"""
+
+import collections
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+import tornado.ioloop
+
+logger = logging.getLogger('battleships-web')
+
+
+def frame_label(code):
+    """
+    :return: label of a function in a collapsed stack, which must not contain ';'
+    """
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler of one thread: a background thread takes a sample of its stack every interval.
+    The samples are counted per stack of code objects, which are only turned into text at the end.
+    """
+
+    def __init__(self, thread_id, interval_seconds=0.005):
+        """
+        :param thread_id: ident of the thread to sample, e.g. threading.get_ident() on the IOLoop thread
+        """
+        self.thread_id = thread_id
+        self.interval_seconds = interval_seconds
+        self.samples = collections.Counter()
+        """
+        number of samples per stack, as tuple of code objects from the outermost frame
+        """
+        self.sample_count = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            self.samples[tuple(stack)] += 1
+            self.sample_count += 1
+
+    def collapsed(self):
+        """
+        :return: one line per stack, the frames from the outermost one joined with ';' and the number
+                 of samples, most frequent first
+        """
+        labels = {}
+        lines = []
+        for (stack, count) in self.samples.most_common():
+            for code in stack:
+                if code not in labels:
+                    labels[code] = frame_label(code)
+            lines.append('%s %d' % (';'.join(labels[code] for code in stack), count))
+        return lines
+
+
+class SpanStats(object):
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class Tracer(object):
+    """
+    Times of the spans per name. Spans are only recorded while enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = {}
+        """
+        SpanStats per span name
+        """
+        self.null_span = NullSpan()
+        self.traced_methods = []
+        """
+        tuples (class, attribute name, function, span name) of the methods wrapped while enabled
+        """
+
+    def trace(self, owner, attribute, name):
+        """
+        Times every call of the method of the class as a span of the name while enabled
+        """
+        method = (owner, attribute, owner.__dict__[attribute], name)
+        self.traced_methods.append(method)
+        if self.enabled:
+            self._wrap(*method)
+
+    def enable(self):
+        self.enabled = True
+        for method in self.traced_methods:
+            self._wrap(*method)
+
+    def disable(self):
+        self.enabled = False
+        for (owner, attribute, function, _) in self.traced_methods:
+            setattr(owner, attribute, function)
+
+    def _wrap(self, owner, attribute, function, name):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - started)
+        setattr(owner, attribute, wrapper)
+
+    def record(self, name, seconds):
+        stats = self.spans.get(name)
+        if stats is None:
+            stats = self.spans[name] = SpanStats()
+        stats.count += 1
+        stats.total += seconds
+        if seconds > stats.max:
+            stats.max = seconds
+
+    def reset(self):
+        self.spans = {}
+
+    def stats(self):
+        """
+        :return: dict of count, total and maximum milliseconds per span name
+        """
+        return {name: {'count': stats.count, 'total_ms': stats.total * 1000, 'max_ms': stats.max * 1000,
+                       'mean_ms': stats.total * 1000 / stats.count}
+                for (name, stats) in sorted(self.spans.items())}
+
+
+class Span(object):
+    __slots__ = ('tracer', 'name', 'started')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, time.perf_counter() - self.started)
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+TRACER = Tracer()
+
+
+def span(name):
+    """
+    :return: context manager timing its block as a span of the name, if tracing is enabled
+    """
+    if not TRACER.enabled:
+        return TRACER.null_span
+    return Span(TRACER, name)
+
+
+class TracedMethod(object):
+    """
+    Stands in for a traced method while its class is created, then puts the method itself in its place
+    and has TRACER wrap it while tracing is enabled
+    """
+
+    def __init__(self, function, name):
+        self.function = function
+        self.name = name
+
+    def __set_name__(self, owner, attribute):
+        setattr(owner, attribute, self.function)
+        TRACER.trace(owner, attribute, self.name)
+
+
+def traced(name):
+    """
+    Decorator of methods, timing every call as a span of the name while tracing is enabled. Methods
+    are looked up on their class at every call, so that the class can be given the wrapper only then.
+    For coroutines, the span ends when they first wait.
+    """
+    return lambda function: TracedMethod(function, name)
+
+
+class StallDetector(object):
+    """
+    Logs the stack of the IOLoop thread when it has not run a callback for more than threshold_seconds.
+
+    A periodic callback on the IOLoop keeps a heartbeat, a watchdog thread checks that it is recent.
+    The stack is thus taken while the IOLoop is still blocked, and once more per further threshold
+    the stall lasts; when the IOLoop is back, the total duration of the stall is logged.
+    """
+
+    def __init__(self, threshold_seconds):
+        self.threshold_seconds = threshold_seconds
+        self.check_seconds = threshold_seconds / 4
+        self.thread_id = None
+        self.heartbeat = time.monotonic()
+        self.reported = None
+        """
+        heartbeat of the stall that has been reported last, None if the current one has not been reported
+        """
+        self.stalls = 0
+        """
+        number of stalls detected so far
+        """
+        self.stopped = threading.Event()
+
+    def start(self):
+        """
+        To be called on the IOLoop thread
+        """
+        self.thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        tornado.ioloop.PeriodicCallback(self.beat, self.check_seconds * 1000).start()
+        threading.Thread(target=self._watch, name='stall-detector', daemon=True).start()
+
+    def beat(self):
+        now = time.monotonic()
+        if self.reported is not None and self.reported == self.heartbeat:
+            logger.warning('IOLoop was blocked for %.3fs', now - self.heartbeat)
+        self.reported = None
+        self.heartbeat = now
+
+    def _watch(self):
+        next_report = self.threshold_seconds
+        while not self.stopped.wait(self.check_seconds):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat
+            if blocked <= self.threshold_seconds:
+                next_report = self.threshold_seconds
+            elif blocked > next_report:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is None:
+                    continue
+                if self.reported != heartbeat:
+                    self.stalls += 1
+                self.reported = heartbeat
+                next_report = blocked + self.threshold_seconds
+                logger.warning('IOLoop blocked for %.3fs so far, in:\n%s', blocked,
+                               ''.join(traceback.format_stack(frame)))
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Replays the traffic recorded in battleships.log against a server
+
+Rebuilds the requests of every caller from the structured (JSON Lines) log: the arguments from
+the messages the handlers log when a request starts (WaitForGame:, POST-PlaceShip:, ...), the
+status and response time from the record logged when it is finished. The callers are then replayed
+with their recorded tokens, each request being sent at its recorded time relative to the start of
+the replay, divided by the speed, but never before the previous request of the same caller has
+been answered. As fast as possible, every caller sends its next request as soon as the previous
+one is answered.
+
+Reports the response times per endpoint of the recording and the replay, and the requests whose
+status differs, e.g. to compare a change of main.py or game.py against real traffic. The recorded
+times were measured by the server, the replayed ones by this client, so they include the HTTP
+client and network. Players may be matched differently than in the recording, so the long-polls
+are only roughly comparable; compare replays of the same log against each other for precise numbers.
+
+Usage:
+  replay.py [options] LOGFILE
+
+Options:
+  -h, --help                  Show this screen.
+  -u URL, --url=URL           Server to replay the requests against [default: http://127.0.0.1:8080]
+  -s FACTOR, --speed=FACTOR   Replay this many times faster than recorded, as fast as possible if 0 [default: 1]
+  --skip=SECONDS              Seconds of the recording to skip from its start [default: 0]
+  -d SECONDS, --duration=SECONDS
+                              Seconds of the recording to replay, all if 0 [default: 0]
+  -o FILE, --output=FILE      File to write the results to as JSON
+"""
+
+import ast
+import collections
+import json
+import time
+import urllib.parse
+
+from docopt import docopt
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+
+from turnextract import PERCENTILES, percentiles
+
+MESSAGE_REQUESTS = {
+    'WaitForGame': ('GET', '/waitforgame'),
+    'GET-PlaceShip': ('GET', '/placeship'),
+    'POST-PlaceShip': ('POST', '/placeship'),
+    'WaitForTurn': ('GET', '/waitforturn'),
+    'PutCoord': ('GET', '/putcoord'),
+    'ShootAndWait': ('GET', '/shootandwait'),
+    'QuitGame': ('POST', '/quitapp'),
+    'GET-LOG': ('GET', '/log'),
+    'POST-LOG': ('POST', '/log'),
+}
+"""
+Request (method, path) per name of the message logged by its handler with the query or body
+"""
+
+REPLAYED_PATHS = frozenset(['/dialog'] + [path for (method, path) in MESSAGE_REQUESTS.values()])
+"""
+Paths of the requests that are replayed; the push channels are not
+"""
+
+# only lines containing one of these can be of interest, the others are skipped without parsing
+INTERESTING = (b'"Request: ',) + tuple(('"%s: ' % name).encode() for name in MESSAGE_REQUESTS)
+
+CONNECTION_ERROR = 599
+"""
+Status of requests that got no response, as used by Tornado
+"""
+
+
+class RecordedRequest(object):
+    __slots__ = ('start', 'method', 'path', 'arguments', 'status', 'duration')
+
+    def __init__(self, start, method, path, arguments, status, duration):
+        """
+        :param start: time the request was received, in seconds since the epoch
+        :param arguments: list of (name, value) of the query or body
+        """
+        self.start = start
+        self.method = method
+        self.path = path
+        self.arguments = arguments
+        self.status = status
+        self.duration = duration
+
+
+def parse_arguments(payload):
+    """
+    :param payload: query as logged, or body as logged, i.e. the repr of the bytes
+    :return: list of (name, value)
+    """
+    if payload.startswith(("b'", 'b"')):
+        payload = ast.literal_eval(payload).decode('utf-8', 'replace')
+    return urllib.parse.parse_qsl(payload, keep_blank_values=True)
+
+
+def read_log(path):
+    """
+    :return: dict of the lists of RecordedRequests per token, in the order they were received. Requests
+             without token, e.g. of /dialog, are each in a list of their own with a key (None, number).
+    """
+    pending = collections.defaultdict(collections.OrderedDict)
+    """
+    deques of the arguments of the requests that have started but not finished, per token per (method, path)
+    """
+    callers = collections.defaultdict(list)
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'{') or not any(interesting in line for interesting in INTERESTING):
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'path' in record and 'duration' in record:
+                if record['path'] not in REPLAYED_PATHS:
+                    continue
+                token = record.get('token')
+                started = pending[(record['method'], record['path'])]
+                if token is None and started:
+                    # e.g. /log, whose handler does not keep the token: the request started first
+                    token = next(iter(started))
+                if token in started:
+                    arguments = started[token].popleft()
+                    if not started[token]:
+                        del started[token]
+                else:
+                    # e.g. /quitapp, whose token is in the body while the query is logged
+                    arguments = [('token', token)] if token else []
+                request = RecordedRequest(record['time'] - record['duration'], record['method'], record['path'],
+                                          arguments, record['status'], record['duration'])
+                callers[token if token else (None, len(callers))].append(request)
+            else:
+                (name, _, payload) = record.get('message', '').partition(': ')
+                if name in MESSAGE_REQUESTS:
+                    arguments = parse_arguments(payload)
+                    token = dict(arguments).get('token')
+                    pending[MESSAGE_REQUESTS[name]].setdefault(token, collections.deque()).append(arguments)
+    for requests in callers.values():
+        requests.sort(key=lambda request: request.start)
+    return callers
+
+
+def select(callers, skip, duration):
+    """
+    :return: dict of the callers whose first request is in the window, with their requests in it
+    """
+    if not callers:
+        return {}
+    origin = min(requests[0].start for requests in callers.values()) + skip
+    end = origin + duration if duration else float('inf')
+    selected = {}
+    for (key, requests) in callers.items():
+        if origin <= requests[0].start < end:
+            selected[key] = [request for request in requests if request.start < end]
+    return selected
+
+
+class Replay(object):
+    def __init__(self, base_url, callers, speed):
+        """
+        :param callers: dict of the lists of RecordedRequests per caller
+        :param speed: factor to speed up the recording by, as fast as possible if 0
+        """
+        self.base_url = base_url
+        self.callers = callers
+        self.speed = speed
+        self.http_client = tornado.httpclient.AsyncHTTPClient()
+        self.results = []
+        """
+        list of (RecordedRequest, status, duration) of the replayed requests
+        """
+        self.late = 0
+        """
+        number of requests sent later than scheduled, because the previous request of the caller took longer
+        """
+        self.started = None
+        self.origin = None
+
+    @tornado.gen.coroutine
+    def send(self, request):
+        query = urllib.parse.urlencode(request.arguments)
+        url = self.base_url + request.path
+        body = None
+        if request.method == 'POST':
+            body = query
+        elif query:
+            url += '?' + query
+        started = time.perf_counter()
+        try:
+            response = yield self.http_client.fetch(url, method=request.method, body=body, raise_error=False,
+                                                    request_timeout=request.duration + 60)
+            status = response.code
+        except (OSError, tornado.httpclient.HTTPClientError):
+            status = CONNECTION_ERROR
+        self.results.append((request, status, time.perf_counter() - started))
+
+    @tornado.gen.coroutine
+    def replay_caller(self, requests):
+        for request in requests:
+            if self.speed:
+                delay = self.started + (request.start - self.origin) / self.speed - time.monotonic()
+                if delay > 0:
+                    yield tornado.gen.sleep(delay)
+                elif request is not requests[0] and delay < -0.1:
+                    self.late += 1
+            yield self.send(request)
+
+    @tornado.gen.coroutine
+    def run(self):
+        self.origin = min(requests[0].start for requests in self.callers.values())
+        self.started = time.monotonic()
+        yield [self.replay_caller(requests) for requests in self.callers.values()]
+        return time.monotonic() - self.started
+
+    def summary(self, seconds):
+        recorded = collections.defaultdict(list)
+        replayed = collections.defaultdict(list)
+        status_changes = collections.Counter()
+        for (request, status, duration) in self.results:
+            recorded[request.path].append(request.duration)
+            replayed[request.path].append(duration)
+            if status != request.status:
+                status_changes[(request.path, request.status, status)] += 1
+        endpoints = {}
+        for path in sorted(recorded):
+            endpoint = endpoints[path] = {'requests': len(recorded[path])}
+            for (p, recorded_value, replayed_value) in zip(PERCENTILES, percentiles(recorded[path]),
+                                                          percentiles(replayed[path])):
+                endpoint['recorded_p%d_ms' % p] = recorded_value * 1000
+                endpoint['replayed_p%d_ms' % p] = replayed_value * 1000
+        return {
+            'speed': self.speed,
+            'callers': len(self.callers),
+            'requests': len(self.results),
+            'seconds': seconds,
+            'late_requests': self.late,
+            'endpoints': endpoints,
+            'status_changes': [{'path': path, 'recorded': recorded_status, 'replayed': replayed_status,
+                                'count': count}
+                               for ((path, recorded_status, replayed_status), count)
+                               in sorted(status_changes.items())],
+        }
+
+
+def report(summary):
+    lines = ['%d callers, %d requests replayed in %.1fs at %s, %d sent late' %
+             (summary['callers'], summary['requests'], summary['seconds'],
+              '%gx speed' % summary['speed'] if summary['speed'] else 'full speed', summary['late_requests'])]
+    lines.append('')
+    lines.append('%-16s %9s  %s' % ('endpoint', 'requests', '  '.join('%21s' % ('p%d recorded/replayed' % p)
+                                                                         for p in PERCENTILES)))
+    for (path, endpoint) in summary['endpoints'].items():
+        lines.append('%-16s %9d  ' % (path, endpoint['requests']) + '  '.join(
+            '%9.1fms/%8.1fms' % (endpoint['recorded_p%d_ms' % p], endpoint['replayed_p%d_ms' % p])
+            for p in PERCENTILES))
+    lines.append('')
+    if summary['status_changes']:
+        lines.append('Status changes (path, recorded -> replayed: count)')
+        for change in summary['status_changes']:
+            lines.append('  %-16s %3d -> %3d %8d' % (change['path'], change['recorded'], change['replayed'],
+                                                      change['count']))
+    else:
+        lines.append('No status changes')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    callers = select(read_log(args['LOGFILE']), float(args['--skip']), float(args['--duration']))
+    if not callers:
+        raise SystemExit('No requests to replay in %s' % args['LOGFILE'])
+
+    # every caller has at most one request in flight
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=len(callers))
+    replay = Replay(args['--url'].rstrip('/'), callers, float(args['--speed']))
+    seconds = tornado.ioloop.IOLoop.current().run_sync(replay.run)
+    summary = replay.summary(seconds)
+
+    print(report(summary))
+    if args['--output']:
+        with open(args['--output'], 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
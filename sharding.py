@@ -0,0 +1,448 @@
+"""
+Multi-process mode: sessions are sharded across worker processes, each running the
+ordinary application with its own SessionTokenToGame.
+
+All workers accept connections on the public port, so no single process sees all the traffic.
+Every worker reads a request, then either handles it itself or forwards it to the worker owning
+the session, over the private port of that worker (see ShardingDelegate). Requests about all
+workers, i.e. /metrics and the list of games of /spectate, are answered by gathering the
+responses of all workers (see GatherHandler).
+"""
+
+import collections
+import json
+import logging
+import multiprocessing
+import time
+import urllib.parse
+
+import tornado.gen
+import tornado.http1connection
+import tornado.httpclient
+import tornado.httputil
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpclient
+import tornado.web
+import tornado.websocket
+
+import metrics
+
+logger = logging.getLogger('battleships-web')
+
+MAX_SHARDS = 256
+
+
+def token_with_shard(token, shard):
+    """
+    Encodes the shard in the last byte of a hex token.
+    The last bytes of uuid1 tokens hold the host's node id, which is the same for all tokens anyway.
+    :param token: hex token
+    :param shard: number of the shard, 0 <= shard < MAX_SHARDS
+    :return: token of the same length
+    """
+    return '%s%02x' % (token[:-2], shard)
+
+
+def shard_of_token(token, shards):
+    """
+    :param token: token created by token_with_shard
+    :param shards: total number of shards
+    :return: number of the shard encoded in the token; 0 for malformed tokens
+    """
+    try:
+        return int(token[-2:], 16) % shards
+    except ValueError:
+        return 0
+
+
+class Lobby(object):
+    """
+    Where players are waiting for a game, shared by the worker processes: the number of players waiting
+    on every shard, in shared memory written only by the worker of the shard. Players starting to wait
+    are sent to a shard where others are waiting, so that they can be matched by its SessionTokenToGame.
+    """
+
+    def __init__(self, shards):
+        """
+        To be created before forking the workers
+        """
+        self.waiting = multiprocessing.RawArray('i', shards)
+
+    def update(self, shard, waiting):
+        """
+        :param waiting: number of players now waiting on the shard
+        """
+        self.waiting[shard] = waiting
+
+    def choose(self, shard):
+        """
+        :param shard: shard of the worker asking
+        :return: shard for a player starting to wait: the own shard if players are waiting there or nowhere,
+                 otherwise the first shard where players are waiting
+        """
+        if self.waiting[shard]:
+            return shard
+        for (other_shard, waiting) in enumerate(self.waiting):
+            if waiting:
+                return other_shard
+        return shard
+
+
+class ShardRouter(object):
+    """
+    Decides which worker handles a request, as seen from the worker of one shard.
+
+    Requests carrying a token belong to the shard encoded in the token, and are forwarded there.
+    That worker, the home of the session, handles them itself, unless the session was moved to another
+    shard for matchmaking: a player starting to wait for a game without a session yet is sent to the
+    shard chosen by the Lobby. The home remembers these moved sessions until they are no longer accessed,
+    and forwards their requests to the shard they were moved to.
+    """
+
+    MATCHMAKING_PATHS = ('/waitforgame', '/push', '/events')
+
+    def __init__(self, shard, worker_urls, lobby, has_session, session_timeout=300):
+        """
+        :param shard: shard of this worker
+        :param worker_urls: base URLs of the private ports of the workers, index in the list is the shard number
+        :param lobby: Lobby shared by the workers
+        :param has_session: callable telling whether this worker has a session of the given token
+        :param session_timeout: seconds after which moved sessions that have not been accessed are forgotten
+        """
+        self.shard = shard
+        self.worker_urls = worker_urls
+        self.lobby = lobby
+        self.has_session = has_session
+        self.session_timeout = session_timeout
+        # maps tokens to the time of the last access, in order of last access
+        self.moved_sessions = collections.OrderedDict()
+        self.moved_session_shards = {}
+
+    def route(self, path, token):
+        """
+        :param path: path of the request
+        :param token: session token of the request, or for /spectate the id of the game, or None
+        :return: tuple (shard, final): shard of the worker to handle the request, and whether that worker
+                 has to handle it itself rather than route it again
+        """
+        now = time.monotonic()
+        self._expire(now)
+
+        if token is None:
+            # requests without session, e.g. /dialog minting new tokens, are handled by whoever accepted them
+            return self.shard, True
+        home = shard_of_token(token, len(self.worker_urls))
+        if path == '/spectate':
+            # games do not move, their ids hold the shard of the worker running them, see spectate.game_id
+            return home, True
+        if home != self.shard:
+            return home, False
+
+        if token in self.moved_session_shards:
+            shard = self.moved_session_shards[token]
+            if path == '/quitapp':
+                del self.moved_sessions[token]
+                del self.moved_session_shards[token]
+            else:
+                self.moved_sessions[token] = now
+                self.moved_sessions.move_to_end(token)
+            return shard, True
+        if path in self.MATCHMAKING_PATHS and not self.has_session(token):
+            shard = self.lobby.choose(self.shard)
+            if shard != self.shard:
+                self.moved_session_shards[token] = shard
+                self.moved_sessions[token] = now
+            return shard, True
+        return self.shard, True
+
+    def _expire(self, now):
+        while self.moved_sessions:
+            token, last_access = next(iter(self.moved_sessions.items()))
+            if now - last_access < self.session_timeout:
+                break
+            del self.moved_sessions[token]
+            del self.moved_session_shards[token]
+
+
+ROUTED_HEADER = 'X-Battleships-Routed'
+"""
+Header of requests forwarded to the worker that has to handle them itself; only trusted on the private ports
+"""
+SHARD_HEADER = 'X-Battleships-Shard'
+"""
+Header telling the DispatchHandler which worker to forward a request to, set by the ShardingDelegate
+"""
+GATHERED_PATHS = ('/metrics', '/spectate')
+
+
+class ShardingDelegate(tornado.httputil.HTTPServerConnectionDelegate):
+    """
+    Front of a worker for tornado.httpserver.HTTPServer: reads every request including the body, which may
+    hold the token, and then passes it on to the application if it is handled by this worker, or to the
+    forwarder otherwise.
+    """
+
+    def __init__(self, app, router, private=False, max_clients=10000):
+        """
+        :param app: application of the worker
+        :param router: ShardRouter of the worker
+        :param private: whether this is the private port, taking requests routed by the other workers
+        :param max_clients: maximum number of concurrently forwarded requests, including long-polls and
+                            event streams
+        """
+        self.app = app
+        self.router = router
+        self.private = private
+        tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=max_clients)
+        self.forwarder = tornado.web.Application([
+            (r"/push", DispatchSocketHandler, {'router': router}),
+            (r"/.*", DispatchHandler, {'router': router}),
+        ])
+        self.gatherer = tornado.web.Application([
+            (r"/.*", GatherHandler, {'router': router}),
+        ])
+
+    def start_request(self, server_conn, request_conn):
+        return RoutingMessageDelegate(self, server_conn, request_conn)
+
+    def target(self, start_line, headers, body):
+        """
+        Decides who handles a request; the headers are changed accordingly
+        :return: HTTPServerConnectionDelegate to pass the request on to
+        """
+        routed = headers.pop(ROUTED_HEADER, None) is not None and self.private
+        headers.pop(SHARD_HEADER, None)
+        if routed:
+            return self.app
+        (path, _, query) = start_line.path.partition('?')
+        arguments = tornado.httputil.parse_qs_bytes(query, keep_blank_values=True)
+        if start_line.method == 'POST':
+            tornado.httputil.parse_body_arguments(headers.get('Content-Type', ''), body, arguments, {}, headers)
+        if path == '/spectate':
+            token = arguments.get('game', [b''])[-1].decode() or None
+        else:
+            token = arguments.get('token', [b''])[-1].decode() or None
+
+        if path in GATHERED_PATHS and token is None:
+            if path == '/metrics' and 'shard' in arguments:
+                (shard, final) = (int(arguments['shard'][-1]), True)
+            else:
+                return self.gatherer
+        else:
+            (shard, final) = self.router.route(path, token)
+        if shard == self.router.shard:
+            return self.app
+        headers[SHARD_HEADER] = str(shard)
+        if final:
+            headers[ROUTED_HEADER] = '1'
+        return self.forwarder
+
+
+class RoutingMessageDelegate(tornado.httputil.HTTPMessageDelegate):
+    """
+    Reads a request, then replays it to the delegate of the chosen application
+    """
+
+    def __init__(self, sharding_delegate, server_conn, request_conn):
+        self.sharding_delegate = sharding_delegate
+        self.server_conn = server_conn
+        self.request_conn = request_conn
+        self.start_line = None
+        self.headers = None
+        self.chunks = []
+        self.delegate = None
+
+    def headers_received(self, start_line, headers):
+        self.start_line = start_line
+        self.headers = headers
+
+    def data_received(self, chunk):
+        self.chunks.append(chunk)
+
+    def finish(self):
+        body = b''.join(self.chunks)
+        target = self.sharding_delegate.target(self.start_line, self.headers, body)
+        self.delegate = target.start_request(self.server_conn, self.request_conn)
+        self.delegate.headers_received(self.start_line, self.headers)
+        if body:
+            self.delegate.data_received(body)
+        self.delegate.finish()
+
+    def on_connection_close(self):
+        if self.delegate is not None:
+            self.delegate.on_connection_close()
+
+
+class DispatchHandler(tornado.web.RequestHandler):
+    """
+    Forwards a request to the worker chosen by the ShardingDelegate.
+    The event streams are passed on as they arrive, see forward_stream; all other responses at once.
+    """
+
+    REQUEST_TIMEOUT_SECONDS = 120
+    STREAMING_PATHS = ('/events', '/spectate')
+    HOP_BY_HOP_HEADERS = ('Connection', 'Keep-Alive', 'Transfer-Encoding', 'Content-Length', 'Host', SHARD_HEADER)
+    FORWARDED_HEADERS = ('Content-Type', 'Content-Encoding', 'Vary', 'Cache-Control', 'ETag', 'Last-Modified',
+                         'Expires')
+
+    def initialize(self, router):
+        self.router = router
+        self.worker_stream = None
+        """
+        connection to the worker of a forwarded event stream
+        """
+
+    @tornado.gen.coroutine
+    def get(self):
+        yield self.forward()
+
+    @tornado.gen.coroutine
+    def post(self):
+        yield self.forward()
+
+    @tornado.gen.coroutine
+    def forward(self):
+        path = self.request.path
+        worker_url = self.router.worker_urls[int(self.request.headers[SHARD_HEADER])]
+        headers = tornado.httputil.HTTPHeaders(self.request.headers)
+        for header in self.HOP_BY_HOP_HEADERS:
+            headers.pop(header, None)
+        if path in self.STREAMING_PATHS and self.request.method == 'GET':
+            yield self.forward_stream(worker_url, headers)
+            return
+        response = yield tornado.httpclient.AsyncHTTPClient().fetch(
+            worker_url + self.request.uri,
+            method=self.request.method,
+            headers=headers,
+            body=self.request.body if self.request.method == 'POST' else None,
+            follow_redirects=False,
+            # compressed responses, e.g. of the static assets, are passed on as they are
+            decompress_response=False,
+            raise_error=False,
+            request_timeout=self.REQUEST_TIMEOUT_SECONDS)
+        if response.code == 599:
+            logger.error('Forwarding %s to %s failed: %s', path, worker_url, response.error)
+            raise tornado.web.HTTPError(502)
+
+        self.pass_on_status(response.code, response.reason, response.headers)
+        if response.body:
+            self.write(response.body)
+
+    @tornado.gen.coroutine
+    def forward_stream(self, worker_url, headers):
+        """
+        Forwards the request over a connection of its own, passing the response on chunk by chunk.
+        Unlike a request of the HTTP client, the connection can be closed as soon as the client goes away,
+        which ends the stream on the worker as well.
+        """
+        worker = urllib.parse.urlsplit(worker_url)
+        try:
+            self.worker_stream = yield tornado.tcpclient.TCPClient().connect(worker.hostname, worker.port)
+        except IOError as e:
+            logger.error('Forwarding %s to %s failed: %s', self.request.path, worker_url, e)
+            raise tornado.web.HTTPError(502)
+        if self.request.connection.stream.closed():
+            self.worker_stream.close()
+            return
+        headers['Host'] = worker.netloc
+        connection = tornado.http1connection.HTTP1Connection(self.worker_stream, True)
+        connection.write_headers(tornado.httputil.RequestStartLine('GET', self.request.uri, 'HTTP/1.1'), headers)
+        connection.finish()
+        try:
+            yield connection.read_response(WorkerStream(self))
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.worker_stream.close()
+
+    def pass_on_status(self, code, reason, headers):
+        self.set_status(code, reason)
+        for header in self.FORWARDED_HEADERS:
+            if header in headers:
+                self.set_header(header, headers[header])
+
+    def on_connection_close(self):
+        if self.worker_stream is not None:
+            self.worker_stream.close()
+
+class WorkerStream(tornado.httputil.HTTPMessageDelegate):
+    """
+    Passes the response of a worker on to the client of a DispatchHandler as it arrives
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def headers_received(self, start_line, headers):
+        self.handler.pass_on_status(start_line.code, start_line.reason, headers)
+
+    def data_received(self, chunk):
+        self.handler.write(chunk)
+        self.handler.flush()
+
+
+class DispatchSocketHandler(tornado.websocket.WebSocketHandler):
+    """
+    Relays the messages of a WebSocket, i.e. of the push channel, to and from the worker owning the session
+    """
+
+    def initialize(self, router):
+        self.router = router
+        self.worker = None
+
+    @tornado.gen.coroutine
+    def open(self):
+        worker_url = self.router.worker_urls[int(self.request.headers[SHARD_HEADER])]
+        request = tornado.httpclient.HTTPRequest('ws' + worker_url[len('http'):] + self.request.uri)
+        if ROUTED_HEADER in self.request.headers:
+            request.headers[ROUTED_HEADER] = '1'
+        try:
+            self.worker = yield tornado.websocket.websocket_connect(request)
+        except Exception as e:
+            logger.error('Forwarding %s to %s failed: %s', self.request.path, worker_url, e)
+            self.close()
+            return
+        tornado.ioloop.IOLoop.current().spawn_callback(self.relay_from_worker)
+
+    @tornado.gen.coroutine
+    def relay_from_worker(self):
+        while True:
+            message = yield self.worker.read_message()
+            if message is None or self.ws_connection is None:
+                break
+            self.write_message(message)
+        self.close()
+
+    def on_message(self, message):
+        self.worker.write_message(message)
+
+    def on_close(self):
+        if self.worker is not None:
+            self.worker.close()
+
+
+class GatherHandler(tornado.web.RequestHandler):
+    """
+    Answers the requests about all workers, /metrics and the list of games of /spectate, from the responses
+    of all workers. The metrics of the workers are told apart by a shard label.
+    """
+
+    def initialize(self, router):
+        self.router = router
+
+    @tornado.gen.coroutine
+    def get(self):
+        responses = yield [tornado.httpclient.AsyncHTTPClient().fetch(
+            worker_url + self.request.uri, headers={ROUTED_HEADER: '1'},
+            request_timeout=DispatchHandler.REQUEST_TIMEOUT_SECONDS)
+            for worker_url in self.router.worker_urls]
+        if self.request.path == '/metrics':
+            lines = metrics.merge_shards([response.body.decode().splitlines() for response in responses])
+            self.set_header('Content-Type', 'text/plain; version=0.0.4')
+            self.write('\n'.join(lines) + '\n')
+        else:
+            games = []
+            for response in responses:
+                games.extend(json.loads(response.body)['games'])
+            self.write({'games': games})
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Plays games between shooting strategies on the headless game core
+
+Games are played in batches on a pool of processes, the strategies taking turns at starting.
+Reports the win rate of every strategy, a histogram of the game lengths (shots of both players)
+and the throughput in games per second per core.
+
+Strategies:
+  random   shoots at random fields
+  hunt     shoots at random until it hits, then at the neighbours of the hits
+  density  the bot's strategy, shoots where most placements of the remaining ships are possible
+
+Usage:
+  simulate.py [options] STRATEGY STRATEGY
+
+Options:
+  -h, --help                  Show this screen.
+  -n NUMBER, --games=NUMBER   Number of games to play [default: 10000]
+  -j NUMBER, --jobs=NUMBER    Number of processes, number of cores if 0 [default: 0]
+  -b NUMBER, --batch=NUMBER   Number of games per batch [default: 500]
+  -g SIZE, --grid-size=SIZE   Size of the grid, the one configured in the game if 0 [default: 0]
+  --seed=NUMBER               Seed of the random number generators [default: 0]
+"""
+
+import collections
+import multiprocessing
+import random
+import time
+
+from docopt import docopt
+import numpy
+
+import bot
+import gamecore
+from game import GameProxy
+
+
+class RandomStrategy(bot.Bot):
+    def choose_shot(self):
+        (x, y) = numpy.unravel_index(self.rng.choice(numpy.flatnonzero(~self.shot)), self.shot.shape)
+        return gamecore.Coord(int(x), int(y))
+
+
+class HuntStrategy(bot.Bot):
+    def choose_shot(self):
+        if self.hits.any():
+            # unshot neighbours of the hits of ships that have not been sunk
+            hits = self.hits.astype(bool)
+            neighbours = numpy.zeros_like(hits)
+            neighbours[1:] |= hits[:-1]
+            neighbours[:-1] |= hits[1:]
+            neighbours[:, 1:] |= hits[:, :-1]
+            neighbours[:, :-1] |= hits[:, 1:]
+            candidates = numpy.flatnonzero(neighbours & ~self.shot)
+            if len(candidates):
+                (x, y) = numpy.unravel_index(self.rng.choice(candidates), self.shot.shape)
+                return gamecore.Coord(int(x), int(y))
+        return RandomStrategy.choose_shot(self)
+
+
+STRATEGIES = {
+    'random': RandomStrategy,
+    'hunt': HuntStrategy,
+    'density': bot.Bot,
+}
+
+
+class BatchResult(object):
+    def __init__(self):
+        self.games = 0
+        self.wins = collections.Counter()
+        """
+        number of games won per strategy
+        """
+        self.lengths = collections.Counter()
+        """
+        number of games per number of shots of both players
+        """
+        self.cpu_seconds = 0.0
+
+    def merge(self, other):
+        self.games += other.games
+        self.wins.update(other.wins)
+        self.lengths.update(other.lengths)
+        self.cpu_seconds += other.cpu_seconds
+
+
+def play_game(strategies, grid_size, rng):
+    """
+    :param strategies: tuple of the strategy classes of player 1 and player 2
+    :return: tuple (index of the winning player, number of shots of both players)
+    """
+    tokens = ('p1', 'p2')
+    core = gamecore.GameCore(tokens[0], tokens[1], grid_size=grid_size)
+    players = {token: strategy(GameProxy(core, token), token, rng) for (token, strategy) in zip(tokens, strategies)}
+    for player in players.values():
+        player.place_fleet()
+    while core.get_game_state(core.whose_turn) is gamecore.GameState.canPlay:
+        players[core.whose_turn].shoot()
+    winner = tokens.index(core.p1_token if core.get_game_state(core.p1_token) is gamecore.GameState.won
+                          else core.p2_token)
+    return winner, len(core.get_own_moves(tokens[0])) + len(core.get_own_moves(tokens[1]))
+
+
+def play_batch(args):
+    """
+    :param args: tuple (strategy names, number of games, grid size, seed)
+    :return: BatchResult
+    """
+    (names, games, grid_size, seed) = args
+    started = time.process_time()
+    rng = random.Random(seed)
+    result = BatchResult()
+    for number in range(games):
+        # the strategies take turns at starting
+        order = (0, 1) if (seed + number) % 2 == 0 else (1, 0)
+        (winner, length) = play_game(tuple(STRATEGIES[names[i]] for i in order), grid_size, rng)
+        result.wins['%d:%s' % (order[winner], names[order[winner]])] += 1
+        result.lengths[length] += 1
+    result.games = games
+    result.cpu_seconds = time.process_time() - started
+    return result
+
+
+def report(names, result, wall_seconds, jobs):
+    lines = ['%d games in %.1fs on %d processes, %.0f games/s/core' %
+             (result.games, wall_seconds, jobs, result.games / result.cpu_seconds if result.cpu_seconds else 0)]
+    lines.append('')
+    lines.append('Win rates')
+    for (index, name) in enumerate(names):
+        wins = result.wins['%d:%s' % (index, name)]
+        lines.append('  %-10s %8d  %5.1f%%' % (name, wins, 100.0 * wins / result.games))
+    lines.append('')
+    lines.append('Game lengths (shots of both players)')
+    most = max(result.lengths.values())
+    for (length, count) in sorted(result.lengths.items()):
+        lines.append('  %4d %8d %s' % (length, count, '#' * int(round(50.0 * count / most))))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    names = tuple(args['STRATEGY'])
+    for name in names:
+        if name not in STRATEGIES:
+            raise SystemExit('Unknown strategy %s, one of %s' % (name, ', '.join(sorted(STRATEGIES))))
+    games = int(args['--games'])
+    batch = int(args['--batch'])
+    jobs = int(args['--jobs']) or multiprocessing.cpu_count()
+    grid_size = int(args['--grid-size']) or None
+    seed = int(args['--seed'])
+
+    batches = [(names, min(batch, games - start), grid_size, seed + start) for start in range(0, games, batch)]
+    started = time.monotonic()
+    total = BatchResult()
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            for result in pool.imap_unordered(play_batch, batches):
+                total.merge(result)
+    else:
+        for batch_args in batches:
+            total.merge(play_batch(batch_args))
+    print(report(names, total, time.monotonic() - started, jobs))
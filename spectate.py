@@ -0,0 +1,194 @@
+"""
+Spectators of games. Every game has a move stream of server-sent events numbered from 0: one event per
+shot, and a last one when the game is over. Each event is encoded once, and the same bytes are sent
+to all spectators of the game, in batches on later IOLoop iterations, so that the player whose move
+is broadcast gets the response first. Spectators joining late catch up from any sequence number
+with a slice of the encoded events.
+
+Spectators only learn the shots, never where the ships are placed. The game itself keeps its moves
+packed per player (see gamecore.PlayerState.moves), and the players take turns, so the stream of a
+game is only built when the first spectator subscribes.
+"""
+
+import hashlib
+import json
+
+import tornado.gen
+import tornado.ioloop
+
+import game
+import sharding
+
+FANOUT_BATCH_SIZE = 500
+"""
+Number of spectators sent an event per IOLoop iteration
+"""
+
+
+SHARD = None
+"""
+Shard of this process in multi-process mode, encoded into every game id
+"""
+
+
+def game_id(spectated_game):
+    """
+    :return: public id of the game. The tokens of the players must stay secret, so it is a hash of the
+             first player's token. The last byte holds the shard of this process like the tokens do (see
+             sharding.token_with_shard), so that spectators are sent to the process running the game,
+             also if the players were moved there for matchmaking.
+    """
+    token = spectated_game.p1_token
+    hashed = hashlib.sha1(token.encode()).hexdigest()[:len(token)]
+    if SHARD is None:
+        return hashed[:-2] + token[-2:]
+    return sharding.token_with_shard(hashed, SHARD)
+
+
+def encode_event(seq, data):
+    """
+    :return: the event as bytes of a server-sent event with seq as id
+    """
+    data['seq'] = seq
+    return ('id: %d\ndata: %s\n\n' % (seq, json.dumps(data, sort_keys=True))).encode()
+
+
+class Spectator(object):
+    __slots__ = ('send', 'close', 'next_seq')
+
+    def __init__(self, send, close, next_seq):
+        """
+        :param send: callable taking bytes of one or more encoded events
+        :param close: callable called when the game is gone
+        :param next_seq: sequence number of the next event to send
+        """
+        self.send = send
+        self.close = close
+        self.next_seq = next_seq
+
+
+class MoveStream(object):
+    """
+    The encoded events of a game and its spectators
+    """
+
+    def __init__(self, spectated_game):
+        """
+        Encodes the moves made so far and starts listening to the game
+        :param spectated_game: game.Game
+        """
+        self.game = spectated_game
+        self.id = game_id(spectated_game)
+        self.events = []
+        """
+        encoded events, the sequence number being the index
+        """
+        self.spectators = set()
+        self.hits = {}
+        """
+        number of hits per Ship, to tell when a shot sank it
+        """
+        self.ended = False
+
+        players = (spectated_game.p1_token, spectated_game.p2_token)
+        moves = [spectated_game.get_own_moves(player_token) for player_token in players]
+        # player 1 starts, and every move passes the turn
+        for number in range(len(moves[0]) + len(moves[1])):
+            (coord, ship) = moves[number % 2][number // 2]
+            self._add_move(number % 2 + 1, coord, ship)
+        self._add_end()
+        spectated_game.listeners.append(self.on_game_changed)
+
+    def _add_move(self, player_number, coord, ship):
+        data = {'event': 'shot', 'player': player_number, 'coord': str(coord), 'result': 'miss'}
+        if ship is not None:
+            self.hits[ship] = self.hits.get(ship, 0) + 1
+            data['result'] = 'sunk' if self.hits[ship] == ship.size else 'hit'
+            data['ship'] = ship.name
+        self.events.append(encode_event(len(self.events), data))
+
+    def _add_end(self):
+        """
+        Adds the last event if the game is over
+        """
+        if self.ended:
+            return
+        spectated_game = self.game
+        players = (spectated_game.p1_token, spectated_game.p2_token)
+        if spectated_game.abandoned_by is not None:
+            data = {'event': 'left', 'player': players.index(spectated_game.abandoned_by) + 1}
+        elif spectated_game.is_over(players[0]):
+            winner = 1 if spectated_game.get_game_state(players[0]) is game.GameState.won else 2
+            data = {'event': 'over', 'winner': winner}
+        else:
+            return
+        self.ended = True
+        self.events.append(encode_event(len(self.events), data))
+
+    def on_game_changed(self, changed_game, method_name, player_token, *args):
+        """
+        Game listener encoding the shots and the end of the game
+        """
+        events_before = len(self.events)
+        if method_name == 'shoot_field':
+            (coord, ship) = changed_game.get_last_own_move(player_token)
+            self._add_move(1 if player_token == changed_game.p1_token else 2, coord, ship)
+            self._add_end()
+        elif method_name == 'abandon':
+            self._add_end()
+        if len(self.events) > events_before and self.spectators:
+            tornado.ioloop.IOLoop.current().add_callback(self.fan_out, len(self.events))
+
+    @tornado.gen.coroutine
+    def fan_out(self, end_seq):
+        """
+        Sends the events up to end_seq to all spectators who have not got them yet
+        """
+        shared = {}
+        """
+        the encoded events each spectator still needs, per first sequence number, joined only once
+        """
+        spectators = list(self.spectators)
+        for start in range(0, len(spectators), FANOUT_BATCH_SIZE):
+            if start:
+                yield tornado.gen.moment
+            for spectator in spectators[start:start + FANOUT_BATCH_SIZE]:
+                next_seq = spectator.next_seq
+                if next_seq >= end_seq or spectator not in self.spectators:
+                    continue
+                if next_seq not in shared:
+                    shared[next_seq] = b''.join(self.events[next_seq:end_seq])
+                spectator.next_seq = end_seq
+                spectator.send(shared[next_seq])
+
+    def subscribe(self, send, close, since=0):
+        """
+        Sends the events from since on at once, and the following ones as they happen
+        :param send: callable taking bytes of one or more encoded events
+        :param close: callable called when the game is gone
+        :param since: sequence number of the first event to send
+        :return: Spectator to unsubscribe
+        """
+        since = max(0, min(since, len(self.events)))
+        spectator = Spectator(send, close, len(self.events))
+        if since < len(self.events):
+            send(b''.join(self.events[since:]))
+        self.spectators.add(spectator)
+        return spectator
+
+    def unsubscribe(self, spectator):
+        self.spectators.discard(spectator)
+
+    def close(self):
+        """
+        To be called when the game is gone; sends the events not sent yet, e.g. that a player left,
+        and closes the streams of all spectators
+        """
+        if self.on_game_changed in self.game.listeners:
+            self.game.listeners.remove(self.on_game_changed)
+        spectators = self.spectators
+        self.spectators = set()
+        for spectator in spectators:
+            if spectator.next_seq < len(self.events):
+                spectator.send(b''.join(self.events[spectator.next_seq:]))
+            spectator.close()
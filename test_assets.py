@@ -0,0 +1,28 @@
+import os
+
+import assets
+
+
+def test_assets_are_read_again_when_used_after_a_reset(tmp_path, monkeypatch):
+    (tmp_path / 'js').mkdir()
+    (tmp_path / 'js' / 'utils.js').write_text('var a = 1;')
+    store = assets.StaticAssetHandler.get_store(str(tmp_path))
+    version = store.get('js/utils.js').version
+
+    (tmp_path / 'js' / 'utils.js').write_text('var a = 2;')
+    os.utime(str(tmp_path / 'js' / 'utils.js'), (0, 0))
+    (tmp_path / 'new.txt').write_text('new')
+    # unchanged until the next reset, which does not look at the files
+    assert store.get('js/utils.js').version == version
+    assert store.get('new.txt') is None
+    monkeypatch.setattr(os.path, 'getmtime', None)
+    assets.StaticAssetHandler.reset()
+    monkeypatch.undo()
+
+    assert store.get('js/utils.js').content == b'var a = 2;'
+    assert store.get('new.txt').content == b'new'
+    (tmp_path / 'new.txt').unlink()
+    assert store.get('new.txt').content == b'new'
+    assets.StaticAssetHandler.reset()
+    assert store.get('new.txt') is None
+    assert store.get('../outside.txt') is None
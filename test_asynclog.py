@@ -0,0 +1,39 @@
+import json
+import logging
+import queue
+
+import asynclog
+
+
+def log_exception(tmp_path, formatter):
+    """
+    :return: what the writer wrote for an exception logged through the queue
+    """
+    logger = logging.getLogger('test-asynclog')
+    logger.propagate = False
+    record_queue = queue.Queue()
+    handler = asynclog.DroppingQueueHandler(record_queue)
+    writer = asynclog.BatchingLogWriter(record_queue, str(tmp_path / 'test.log'), formatter, handler)
+    writer.start()
+    logger.addHandler(handler)
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        logger.exception('Failed %s', 'here')
+    finally:
+        logger.removeHandler(handler)
+        writer.stop()
+    return (tmp_path / 'test.log').read_text()
+
+
+def test_exceptions_are_written_apart_from_the_message(tmp_path):
+    record = json.loads(log_exception(tmp_path, asynclog.JSONLinesFormatter()))
+    assert record['message'] == 'Failed here'
+    assert record['exception'].startswith('Traceback')
+    assert record['exception'].endswith("ValueError: boom")
+
+
+def test_text_lines_keep_the_traceback(tmp_path):
+    lines = log_exception(tmp_path, logging.Formatter("%(levelname)s:%(message)s")).splitlines()
+    assert lines[0].endswith(':Failed here')
+    assert lines[-1] == 'ValueError: boom'
@@ -0,0 +1,17 @@
+import copy
+
+import pytest
+
+import game
+
+
+def test_game_proxy_binds_the_player_methods():
+    the_game = game.Game('a', 'b')
+    proxy = game.GameProxy(the_game, 'a')
+    assert proxy.get_opponent() == 'b'
+    assert proxy.get_opponent is proxy.get_opponent
+    assert proxy.grid_size == the_game.grid_size
+    copied = copy.copy(proxy)
+    assert copied.get_opponent() == 'b'
+    with pytest.raises(AttributeError):
+        game.GameProxy.__new__(game.GameProxy).get_opponent
@@ -0,0 +1,72 @@
+import random
+
+import pytest
+
+import gamecore
+
+
+def test_coords_with_several_digits_and_letters():
+    for (coord_string, x, y) in (('A10', 0, 9), ('Z1', 25, 0), ('AA1', 26, 0), ('AB12', 27, 11)):
+        coord = gamecore.Coord.parse(coord_string, 30)
+        assert (coord.x, coord.y) == (x, y)
+    for (x, y) in ((0, 0), (9, 11), (25, 0), (26, 99), (701, 0), (702, 5)):
+        parsed = gamecore.Coord.parse(str(gamecore.Coord(x, y)), 1000)
+        assert (parsed.x, parsed.y) == (x, y)
+    assert str(gamecore.Coord(701, 0)) == 'ZZ1'
+    assert str(gamecore.Coord(702, 0)) == 'AAA1'
+
+
+def test_coords_of_the_fields_are_interned():
+    assert gamecore.Coord.parse('A10', 12) is gamecore.Coord(0, 9)
+    assert gamecore.Coord('B', '3') is gamecore.Coord(1, 2)
+    assert gamecore.Coord(gamecore.Coord.INTERNED_SIZE, 0) is not gamecore.Coord(gamecore.Coord.INTERNED_SIZE, 0)
+
+
+def test_invalid_coords():
+    for coord_string in ('', 'A', '10', 'a1', 'A0', 'A01', '1A', 'A1 ', 'A-1', 'A1B'):
+        with pytest.raises(ValueError):
+            gamecore.Coord.parse(coord_string, 6)
+    for coord_string in ('G1', 'A7', 'AA1', 'A10'):
+        with pytest.raises(IndexError):
+            gamecore.Coord.parse(coord_string, 6)
+
+
+def test_bitboard_grid_agrees_with_grid():
+    rng = random.Random(3)
+    for grid_size in (6, 10, 32):
+        for _ in range(20):
+            grids = (gamecore.Grid(grid_size), gamecore.BitboardGrid(grid_size))
+            ships = []
+            for _ in range(rng.randrange(1, 8)):
+                # a few ships off the grid or across others
+                (x, y, size) = (rng.randrange(grid_size), rng.randrange(grid_size), rng.randrange(1, 6))
+                if rng.random() < 0.5:
+                    coords = [gamecore.Coord(x + i, y) for i in range(size)]
+                else:
+                    coords = [gamecore.Coord(x, y + i) for i in range(size)]
+                ship = gamecore.Ship('Ship', size)
+                outcomes = []
+                for grid in grids:
+                    try:
+                        grid.put(ship, coords)
+                        outcomes.append(None)
+                    except IndexError:
+                        outcomes.append(IndexError)
+                    except gamecore.OccupiedFieldsException as e:
+                        outcomes.append([str(coord) for coord in e.occupied_fields])
+                assert outcomes[0] == outcomes[1]
+                if outcomes[0] is None:
+                    ships.append(ship)
+            fields = [gamecore.Coord(x, y) for x in range(grid_size) for y in range(grid_size)]
+            for coord in rng.sample(fields, len(fields) // 2) + rng.sample(fields, 5):
+                assert grids[0].shoot(coord) is grids[1].shoot(coord)
+                assert grids[0].all_sunk() == grids[1].all_sunk()
+            for coord in fields:
+                assert grids[0][coord] is grids[1][coord]
+            for ship in ships:
+                assert grids[0].is_sunk(ship) == grids[1].is_sunk(ship)
+            for coord in fields:
+                assert grids[0].shoot(coord) is grids[1].shoot(coord)
+            assert grids[0].all_sunk() and grids[1].all_sunk()
+            with pytest.raises(IndexError):
+                grids[1].shoot(gamecore.Coord(grid_size, 0))
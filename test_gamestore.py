@@ -0,0 +1,121 @@
+import random
+
+import tornado.ioloop
+
+import game
+import gamestore
+
+
+def place_all_ships(new_game):
+    for player_token in (new_game.p1_token, new_game.p2_token):
+        row = 0
+        while new_game.get_ship_to_place(player_token):
+            new_game.place_ship(player_token, game.Coord(0, row), game.Orientation.horizontal)
+            row += 1
+
+
+def play(new_game, moves, rng):
+    """
+    Shoots at random fields not shot yet, alternating like the players
+    """
+    fields = {token: [game.Coord(x, y) for x in range(new_game.grid_size) for y in range(new_game.grid_size)]
+              for token in (new_game.p1_token, new_game.p2_token)}
+    for token in fields:
+        rng.shuffle(fields[token])
+    for _ in range(moves):
+        if new_game.is_over(new_game.p1_token):
+            break
+        token = new_game.whose_turn
+        new_game.shoot_field(token, fields[token].pop())
+
+
+def new_store_game(store, number):
+    new_game = game.Game('p1-%d' % number, 'p2-%d' % number)
+    store.game_created(new_game)
+    new_game.listeners.append(store.record)
+    return new_game
+
+
+def run(coroutine_function):
+    return tornado.ioloop.IOLoop.current().run_sync(coroutine_function)
+
+
+def test_state_round_trip():
+    rng = random.Random(1)
+    original = game.Game('a', 'b')
+    place_all_ships(original)
+    play(original, 9, rng)
+    restored = game.Game.from_state(original.get_state())
+    assert restored.get_state() == original.get_state()
+    for token in ('a', 'b'):
+        assert restored.get_game_state(token) is original.get_game_state(token)
+        assert restored.get_own_ship_coords_string(token) == original.get_own_ship_coords_string(token)
+        assert [(coord, ship and (ship.name, ship.fields_intact)) for (coord, ship) in restored.get_own_moves(token)] \
+            == [(coord, ship and (ship.name, ship.fields_intact)) for (coord, ship) in original.get_own_moves(token)]
+        assert restored.wait_for_turn(token).done() == original.wait_for_turn(token).done()
+    # the restored game goes on like the original
+    token = original.whose_turn
+    coord = next(game.Coord(x, y) for x in range(6) for y in range(6)
+                 if game.Coord(x, y) not in [move for (move, _) in original.get_own_moves(token)])
+    assert restored.shoot_field(token, coord) is original.shoot_field(token, coord)
+
+
+def test_state_of_a_game_being_set_up():
+    original = game.Game('a', 'b')
+    original.place_ship('a', game.Coord(2, 2), game.Orientation.vertical)
+    restored = game.Game.from_state(original.get_state())
+    assert restored.get_ship_to_place('a').name == original.get_ship_to_place('a').name
+    assert restored.get_own_ship_coords_string('a') == 'C3 C4 C5 C6'
+    assert not restored.wait_for_turn('a').done()
+
+
+def test_snapshot_and_restore(tmp_path):
+    path = str(tmp_path / 'games.sqlite')
+    rng = random.Random(2)
+    store = gamestore.SQLiteGameStore(path)
+    games = [new_store_game(store, number) for number in range(5)]
+    for running_game in games:
+        place_all_ships(running_game)
+        play(running_game, 6, rng)
+    won = games[1]
+    play(won, 1000, rng)
+    assert won.is_over(won.p1_token)
+    games[2].abandon(games[2].p2_token)
+    run(store.snapshot)
+
+    # changes after the snapshot are only in the log
+    play(games[3], 2, rng)
+    late = new_store_game(store, 99)
+    late.place_ship(late.p1_token, game.Coord(0, 0), game.Orientation.horizontal)
+    store.flush().result()
+
+    restored = {restored_game.p1_token: restored_game
+                for restored_game in gamestore.SQLiteGameStore(path).load_games()}
+    assert sorted(restored) == sorted(['p1-0', 'p1-3', 'p1-4', 'p1-99'])
+    for original in (games[0], games[3], games[4], late):
+        assert restored[original.p1_token].get_state() == original.get_state()
+
+    # the ended games are gone from the database, not only skipped
+    states = store.writer.submit(store._read_games).result()[0]
+    assert sorted(states) == ['p1-0', 'p1-3', 'p1-4']
+
+
+def test_snapshot_is_taken_in_chunks(tmp_path):
+    store = gamestore.SQLiteGameStore(str(tmp_path / 'games.sqlite'))
+    store.SNAPSHOT_CHUNK_SIZE = 2
+    games = [new_store_game(store, number) for number in range(5)]
+    for running_game in games:
+        place_all_ships(running_game)
+    chunks = []
+    write_snapshot = store._write_snapshot
+
+    def record_chunk(states, ended):
+        chunks.append(len(states) + len(ended))
+        write_snapshot(states, ended)
+
+    store._write_snapshot = record_chunk
+    run(store.snapshot)
+    assert chunks == [2, 2, 1]
+    (states, calls_by_game) = store.writer.submit(store._read_games).result()
+    assert len(states) == 5
+    assert not calls_by_game
@@ -0,0 +1,24 @@
+import profiling
+
+
+class Traced(object):
+    def answer(self, value):
+        return value
+
+    answer_traced = profiling.traced('Traced.answer')(answer)
+
+
+def test_traced_methods_are_only_wrapped_while_tracing():
+    tracer = profiling.TRACER
+    assert Traced.__dict__['answer_traced'] is Traced.answer
+    tracer.enable()
+    try:
+        assert Traced.__dict__['answer_traced'] is not Traced.answer
+        assert Traced().answer_traced(42) == 42
+        assert tracer.stats()['Traced.answer']['count'] == 1
+    finally:
+        tracer.disable()
+        tracer.reset()
+    assert Traced.__dict__['answer_traced'] is Traced.answer
+    assert Traced().answer_traced(42) == 42
+    assert 'Traced.answer' not in tracer.stats()
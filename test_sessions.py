@@ -0,0 +1,228 @@
+import gzip
+import logging
+import os
+import urllib.parse
+
+import tornado.gen
+import tornado.testing
+import tornado.websocket
+
+import assets
+import game
+import main
+
+
+class SessionTestCase(tornado.testing.AsyncHTTPTestCase):
+    """
+    The application with fresh sessions, and helpers to make requests and match players
+    """
+
+    def get_app(self):
+        main.logger = logging.getLogger('battleships-web')
+        main.GAMES = main.SessionTokenToGame()
+        return main.make_app()
+
+    def request(self, path, method='GET', **arguments):
+        query = urllib.parse.urlencode(arguments)
+        if method == 'POST':
+            response = self.fetch(path, method='POST', body=query)
+        else:
+            response = self.fetch(path + '?' + query)
+        return response
+
+    def match(self):
+        (p1_token, p2_token) = ('a' * 32, 'b' * 32)
+        main.GAMES.get_game(p1_token)
+        main.GAMES.get_game(p2_token)
+        return (p1_token, p2_token)
+
+    @tornado.gen.coroutine
+    def wait_until(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            yield tornado.gen.sleep(0.01)
+        self.fail('condition not met in time')
+
+
+class CoordTest(SessionTestCase):
+    def test_coords_are_checked(self):
+        (p1_token, p2_token) = self.match()
+        beyond = self.request('/placeship', 'POST', token=p1_token, coord='A10', orientation='horizontally')
+        self.assertIn(b'allowed="beyondfield"', beyond.body)
+        malformed = self.request('/placeship', 'POST', token=p1_token, coord='A1x', orientation='horizontally')
+        self.assertEqual(malformed.code, 400)
+        placed = self.request('/placeship', 'POST', token=p1_token, coord='B2', orientation='horizontally')
+        self.assertIn(b'allowed="yes"', placed.body)
+        self.assertEqual(main.GAMES[p1_token].get_own_ship_coords_string(), 'B2 C2 D2 E2')
+
+
+class QuitTest(SessionTestCase):
+    def test_opponent_learns_that_the_player_left(self):
+        (p1_token, p2_token) = self.match()
+        self.assertEqual(self.request('/quitapp', 'POST', token=p1_token).code, 200)
+
+        placeship = self.request('/placeship', token=p2_token)
+        self.assertEqual(placeship.code, 200)
+        self.assertIn(b'gamestate="opponentLeft"', placeship.body)
+        turn = self.request('/waitforturn', token=p2_token, timeout=1)
+        self.assertEqual(turn.code, 200)
+        self.assertIn(b'gamestate="opponentLeft"', turn.body)
+
+        self.assertNotIn(p1_token, main.GAMES.session_token_game_dict)
+        self.assertIn(p2_token, main.GAMES.finished_last_access)
+        self.assertNotIn(p2_token, main.GAMES.last_access)
+
+    def test_opponent_session_is_evicted_after_the_finished_timeout(self):
+        (p1_token, p2_token) = self.match()
+        main.GAMES.evict(p1_token)
+        main.GAMES.finished_timeout = 0
+        self.assertEqual(main.GAMES.evict_expired(), 1)
+        self.assertEqual(len(main.GAMES), 0)
+        self.assertFalse(main.GAMES.finished_last_access)
+        self.assertFalse(main.GAMES.last_access)
+
+    def test_waiting_for_a_game_whose_opponent_left_starts_matching_again(self):
+        (p1_token, p2_token) = self.match()
+        main.GAMES[p2_token].abandon()
+        response = self.request('/waitforgame', token=p1_token)
+        self.assertIn(b'ready="opponentleft"', response.body)
+        self.assertNotIn(p1_token, main.GAMES.session_token_game_dict)
+        p3_token = 'c' * 32
+        main.GAMES.get_game(p3_token)
+        main.GAMES.get_game(p1_token)
+        self.assertIsInstance(main.GAMES[p1_token], game.GameProxy)
+        self.assertEqual(main.GAMES[p1_token].get_opponent(), p3_token)
+
+
+class EvictionTest(SessionTestCase):
+    def test_idle_sessions_are_evicted(self):
+        self.match()
+        main.GAMES.get_game('c' * 32)
+        main.GAMES.session_timeout = 0
+        main.GAMES.finished_timeout = 0
+        self.assertEqual(main.GAMES.evict_expired(), 2)
+        # the opponent of an evicted player is kept as finished until the next sweep
+        self.assertEqual(main.GAMES.evict_expired(), 1)
+        self.assertEqual(len(main.GAMES), 0)
+        self.assertFalse(main.GAMES.last_access)
+
+    def test_sessions_beyond_the_maximum_are_refused(self):
+        main.GAMES.max_sessions = 2
+        self.match()
+        self.assertEqual(self.request('/waitforgame', token='c' * 32).code, 503)
+        self.assertEqual(len(main.GAMES), 2)
+
+
+class AdmissionTest(SessionTestCase):
+    def setUp(self):
+        super().setUp()
+        main.PollDynamicDataHandler.MAX_POLLS = 4
+        main.PollDynamicDataHandler.shed_polls = 0
+        main.PollDynamicDataHandler.shortened_polls = 0
+
+    def tearDown(self):
+        main.PollDynamicDataHandler.MAX_POLLS = 0
+        main.PollDynamicDataHandler.active_polls = 0
+        super().tearDown()
+
+    def test_polls_beyond_the_limit_are_shed(self):
+        main.PollDynamicDataHandler.active_polls = 4
+        response = self.request('/waitforgame', token='a' * 32, timeout=5)
+        self.assertIn(b'ready="false"', response.body)
+        self.assertIn(b'retry="2"', response.body)
+        self.assertEqual(main.PollDynamicDataHandler.shed_polls, 1)
+        # the shed player keeps the place in the queue
+        self.assertTrue(main.GAMES.matchmaker.is_waiting('a' * 32))
+
+    def test_timeouts_shrink_under_load(self):
+        self.assertEqual(main.WaitForTurnHandler.admitted_timeout(60), 9)
+        main.PollDynamicDataHandler.active_polls = 3
+        self.assertEqual(main.WaitForTurnHandler.admitted_timeout(8), 4)
+        self.assertEqual(main.WaitForTurnHandler.admitted_timeout(0.5), 0.5)
+        self.assertEqual(main.PollDynamicDataHandler.shortened_polls, 1)
+        self.assertNotIn('shortened_polls', vars(main.WaitForTurnHandler))
+
+
+class StaticAssetTest(SessionTestCase):
+    def test_versioned_urls_are_cached_and_compressed(self):
+        url = assets.StaticAssetHandler.make_static_url(self._app.settings, 'grammar.xml')
+        response = self.fetch(url, headers={'Accept-Encoding': 'gzip'}, decompress_response=False)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Cache-Control'], assets.IMMUTABLE_CACHE_CONTROL)
+        with open(os.path.join(main.STATIC_PATH, 'grammar.xml'), 'rb') as grammar:
+            self.assertEqual(gzip.decompress(response.body), grammar.read())
+
+        revalidated = self.fetch('/static/grammar.xml', headers={'Accept-Encoding': 'gzip',
+                                                                 'If-None-Match': response.headers['ETag']},
+                                 decompress_response=False)
+        self.assertEqual(revalidated.code, 304)
+        self.assertEqual(self.fetch('/static/missing.js').code, 404)
+
+
+class ShootAndWaitTest(SessionTestCase):
+    @tornado.testing.gen_test
+    def test_shot_is_answered_with_the_reply_of_the_opponent(self):
+        (p1_token, p2_token) = self.match()
+        for token in (p1_token, p2_token):
+            player_game = main.GAMES[token]
+            row = 0
+            while player_game.get_ship_to_place():
+                player_game.place_ship(game.Coord(0, row), game.Orientation.horizontal)
+                row += 1
+        url = self.get_url('/shootandwait?token=%s&coord=F6&timeout=5' % p1_token)
+        response_future = self.http_client.fetch(url)
+        yield self.wait_until(lambda: main.GAMES[p2_token].is_players_turn())
+        main.GAMES[p2_token].shoot_field(game.Coord(0, 0))
+        response = yield response_future
+        self.assertIn(b'shot="miss"', response.body)
+        self.assertIn(b'gamestate="canPlay"', response.body)
+        self.assertIn(b'coordhit="A1"', response.body)
+
+        # a field shot at already does not pass the turn, so there is nothing to wait for
+        response = yield self.http_client.fetch(url)
+        self.assertIn(b'shot="alreadyShot"', response.body)
+        self.assertNotIn(b'gamestate=', response.body)
+
+
+class PushTest(SessionTestCase):
+    @tornado.testing.gen_test
+    def test_closing_before_the_match_stops_waiting(self):
+        token = 'a' * 32
+        connection = yield tornado.websocket.websocket_connect(
+            self.get_url('/push?token=' + token).replace('http', 'ws'))
+        yield self.wait_until(lambda: main.GAMES.matchmaker.is_waiting(token))
+        connection.close()
+        yield self.wait_until(lambda: not main.GAMES.matchmaker.is_waiting(token))
+        self.assertEqual(main.GAMES.matchmaker.cancelled, 1)
+        # nobody is matched with the player who left
+        main.GAMES.get_game('b' * 32)
+        self.assertIsNone(main.GAMES['b' * 32])
+
+    @tornado.testing.gen_test
+    def test_failing_session_closes_the_stream(self):
+        main.GAMES.max_sessions = 1
+        main.GAMES.get_game('b' * 32)
+        with self.assertLogs('battleships-web', 'ERROR'):
+            connection = yield tornado.websocket.websocket_connect(
+                self.get_url('/push?token=' + 'a' * 32).replace('http', 'ws'))
+            message = yield connection.read_message()
+        self.assertIsNone(message)
+
+    @tornado.testing.gen_test
+    def test_failing_session_ends_the_event_stream(self):
+        main.GAMES.max_sessions = 1
+        main.GAMES.get_game('b' * 32)
+        with self.assertLogs('battleships-web', 'ERROR'):
+            response = yield self.http_client.fetch(self.get_url('/events?token=' + 'a' * 32), request_timeout=5)
+        self.assertEqual(response.body, b': keepalive\n\n')
+
+
+class SpectateTest(SessionTestCase):
+    def test_malformed_sequence_numbers_are_rejected(self):
+        self.match()
+        (game_id, ) = main.GAMES.games_by_id
+        self.assertEqual(self.request('/spectate', game=game_id, since='x').code, 400)
+        response = self.fetch('/spectate?game=' + game_id, headers={'Last-Event-ID': 'x'})
+        self.assertEqual(response.code, 400)
+        self.assertFalse(main.GAMES.move_streams[game_id].spectators)
@@ -0,0 +1,242 @@
+import json
+import logging
+import types
+import urllib.parse
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.tcpclient
+import tornado.testing
+import tornado.websocket
+
+import game
+import main
+import sharding
+import spectate
+
+WORKER_URLS = ['http://worker-%d' % shard for shard in range(4)]
+
+
+def token(shard, number=0):
+    return sharding.token_with_shard('%030x00' % number, shard)
+
+
+def make_router(shard, lobby=None, sessions=()):
+    return sharding.ShardRouter(shard, WORKER_URLS, lobby or sharding.Lobby(len(WORKER_URLS)),
+                                lambda session_token: session_token in sessions)
+
+
+def test_requests_go_to_the_home_of_the_token():
+    router = make_router(2)
+    assert router.route('/placeship', token(1)) == (1, False)
+    assert router.route('/putcoord', token(7)) == (3, False)
+    assert router.route('/placeship', token(2)) == (2, True)
+    assert router.route('/dialog', None) == (2, True)
+
+
+def test_spectators_go_to_the_shard_of_the_game():
+    router = make_router(0)
+    # the id only depends on the first player's token
+    spectated_game = types.SimpleNamespace(p1_token=token(1))
+    spectate.SHARD = 3
+    try:
+        game_id = spectate.game_id(spectated_game)
+    finally:
+        spectate.SHARD = None
+    assert router.route('/spectate', game_id) == (3, True)
+
+
+def test_lobby_prefers_the_own_shard_then_the_first_with_waiting_players():
+    lobby = sharding.Lobby(4)
+    assert lobby.choose(2) == 2
+    lobby.update(3, 1)
+    lobby.update(1, 2)
+    assert lobby.choose(2) == 1
+    assert lobby.choose(3) == 3
+    lobby.update(1, 0)
+    assert lobby.choose(2) == 3
+
+
+def test_players_starting_to_wait_are_moved_to_the_lobby():
+    lobby = sharding.Lobby(4)
+    lobby.update(1, 1)
+    router = make_router(2, lobby, sessions=[token(2, 1)])
+    moved = token(2, 2)
+    assert router.route('/waitforgame', moved) == (1, True)
+    # the moved session stays where it was moved to, wherever the players wait later on
+    lobby.update(1, 0)
+    assert router.route('/placeship', moved) == (1, True)
+    assert router.route('/waitforgame', moved) == (1, True)
+    assert router.route('/quitapp', moved) == (1, True)
+    assert router.route('/placeship', moved) == (2, True)
+    # players with a session here stay here
+    lobby.update(1, 1)
+    assert router.route('/events', token(2, 1)) == (2, True)
+
+
+class RecordingShardingDelegate(sharding.ShardingDelegate):
+    def __init__(self, *args, **kwargs):
+        super(RecordingShardingDelegate, self).__init__(*args, **kwargs)
+        self.handled = []
+
+    def target(self, start_line, headers, body):
+        target = super(RecordingShardingDelegate, self).target(start_line, headers, body)
+        if target is self.app:
+            self.handled.append(start_line.path.partition('?')[0])
+        return target
+
+
+class ShardingTest(tornado.testing.AsyncHTTPTestCase):
+    """
+    Two workers in the process of the test: the public port of worker 0, and the private ports of both.
+    They share the application and thus the sessions, the tests look at where the requests end up.
+    """
+
+    def setUp(self):
+        main.logger = logging.getLogger('battleships-web')
+        main.GAMES = main.SessionTokenToGame()
+        sockets = [tornado.testing.bind_unused_port() for _ in range(2)]
+        self.worker_urls = ['http://127.0.0.1:%d' % port for (_, port) in sockets]
+        self.lobby = sharding.Lobby(2)
+        self.routers = [sharding.ShardRouter(shard, self.worker_urls, self.lobby,
+                                             lambda session_token: session_token in main.GAMES.session_token_game_dict)
+                        for shard in range(2)]
+        super(ShardingTest, self).setUp()
+        self.workers = [RecordingShardingDelegate(self._app.app, router, private=True) for router in self.routers]
+        self.servers = []
+        for ((worker_socket, _), worker) in zip(sockets, self.workers):
+            server = tornado.httpserver.HTTPServer(worker)
+            server.add_sockets([worker_socket])
+            self.servers.append(server)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        super(ShardingTest, self).tearDown()
+
+    def get_app(self):
+        return sharding.ShardingDelegate(main.make_app(), self.routers[0])
+
+    def start_game(self, shard):
+        (p1_token, p2_token) = (token(shard, 1), token(shard, 2))
+        spectate.SHARD = shard
+        try:
+            main.GAMES.get_game(p1_token)
+            main.GAMES.get_game(p2_token)
+        finally:
+            spectate.SHARD = None
+        for player_token in (p1_token, p2_token):
+            player_game = main.GAMES[player_token]
+            row = 0
+            while player_game.get_ship_to_place():
+                player_game.place_ship(game.Coord(0, row), game.Orientation.horizontal)
+                row += 1
+        return main.GAMES[p1_token]
+
+    def test_requests_of_sessions_of_another_shard_are_forwarded_with_their_body(self):
+        main.GAMES.get_game(token(1, 1))
+        main.GAMES.get_game(token(1, 2))
+        response = self.fetch('/placeship', method='POST',
+                              body=urllib.parse.urlencode({'token': token(1, 1), 'coord': 'A1',
+                                                           'orientation': 'vertically'}))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(main.GAMES[token(1, 1)].get_own_ship_coords_string(), 'A1 A2 A3 A4')
+        # worker 0 forwards to the home of the token, which handles it
+        self.assertEqual(self.workers[1].handled, ['/placeship'])
+
+    def test_requests_of_own_sessions_are_handled_at_once(self):
+        main.GAMES.get_game(token(0, 1))
+        main.GAMES.get_game(token(0, 2))
+        response = self.fetch('/placeship?token=' + token(0, 1))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.workers[0].handled + self.workers[1].handled, [])
+
+    def test_waiting_player_is_moved_to_where_others_wait(self):
+        self.lobby.update(1, 1)
+        response = self.fetch('/waitforgame?timeout=0&token=' + token(0, 5))
+        self.assertIn(b'ready="false"', response.body)
+        self.assertEqual(self.workers[1].handled, ['/waitforgame'])
+        self.assertEqual(self.routers[0].moved_session_shards, {token(0, 5): 1})
+
+    @tornado.testing.gen_test
+    def test_spectate_stream_is_passed_on_while_the_game_runs(self):
+        player_game = self.start_game(1)
+        (game_id, ) = main.GAMES.games_by_id
+        chunks = []
+        response_future = self.http_client.fetch(self.get_url('/spectate?game=' + game_id),
+                                                 streaming_callback=chunks.append, request_timeout=5)
+        while not chunks:
+            yield tornado.gen.sleep(0.01)
+        self.assertFalse(response_future.done())
+        player_game.shoot_field(game.Coord(5, 5))
+        while not any(b'"seq": 0' in chunk for chunk in chunks):
+            yield tornado.gen.sleep(0.01)
+        self.assertFalse(response_future.done())
+        self.assertEqual(self.workers[1].handled, ['/spectate'])
+
+        main.GAMES.evict(player_game.get_opponent())
+        response = yield response_future
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'text/event-stream')
+        self.assertIn(b'"event": "left"', b''.join(chunks))
+
+    @tornado.testing.gen_test
+    def test_closing_the_spectate_stream_unsubscribes_on_the_worker(self):
+        self.start_game(1)
+        (game_id, ) = main.GAMES.games_by_id
+        stream = yield tornado.tcpclient.TCPClient().connect('127.0.0.1', self.get_http_port())
+        yield stream.write(('GET /spectate?game=%s HTTP/1.1\r\nHost: localhost\r\n\r\n' % game_id).encode())
+        yield stream.read_until(b': keepalive')
+        self.assertTrue(main.GAMES.move_streams[game_id].spectators)
+        stream.close()
+        # the connection to the worker is closed at once, without waiting for the next keepalive
+        for _ in range(100):
+            if not main.GAMES.move_streams[game_id].spectators:
+                break
+            yield tornado.gen.sleep(0.01)
+        self.assertFalse(main.GAMES.move_streams[game_id].spectators)
+
+    @tornado.testing.gen_test
+    def test_push_socket_is_relayed(self):
+        url = self.get_url('/push?token=' + token(1, 1)).replace('http', 'ws')
+        connection = yield tornado.websocket.websocket_connect(url)
+        main.GAMES.get_game(token(1, 2))
+        event = json.loads((yield connection.read_message()))
+        self.assertEqual(event['event'], 'matched')
+        connection.write_message(json.dumps({'command': 'placeship', 'coord': 'A1', 'orientation': 'vertically'}))
+        event = json.loads((yield connection.read_message()))
+        self.assertEqual(event['event'], 'placeship')
+        self.assertEqual(self.workers[1].handled, ['/push'])
+        connection.close()
+
+    @tornado.testing.gen_test
+    def test_event_stream_is_passed_on(self):
+        chunks = []
+        response_future = self.http_client.fetch(self.get_url('/events?token=' + token(1, 1)),
+                                                 streaming_callback=chunks.append, request_timeout=5)
+        while not chunks:
+            yield tornado.gen.sleep(0.01)
+        main.GAMES.get_game(token(1, 2))
+        while not any(b'"event": "matched"' in chunk for chunk in chunks):
+            yield tornado.gen.sleep(0.01)
+        self.assertFalse(response_future.done())
+        self.assertEqual(self.workers[1].handled, ['/events'])
+        self.http_client.close()
+
+    def test_metrics_of_all_workers(self):
+        lines = self.fetch('/metrics').body.decode().splitlines()
+        self.assertEqual(self.workers[0].handled + self.workers[1].handled, ['/metrics', '/metrics'])
+        self.assertIn('battleships_sessions{shard="0"} 0', lines)
+        self.assertIn('battleships_sessions{shard="1"} 0', lines)
+        self.assertEqual(lines.count('# TYPE battleships_sessions gauge'), 1)
+
+        lines = self.fetch('/metrics?shard=1').body.decode().splitlines()
+        self.assertIn('battleships_sessions 0', lines)
+        self.assertEqual(self.workers[1].handled[-1], '/metrics')
+
+    def test_spectate_list_has_the_games_of_all_workers(self):
+        self.start_game(0)
+        games = json.loads(self.fetch('/spectate').body)['games']
+        # both workers share the games of this process
+        self.assertEqual([listed['game'] for listed in games], list(main.GAMES.games_by_id) * 2)
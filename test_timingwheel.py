@@ -0,0 +1,114 @@
+import time
+
+import tornado.gen
+import tornado.ioloop
+
+import timingwheel
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ManualTicker(object):
+    """
+    Stands in for the PeriodicCallback, the tests tick the wheel by hand
+    """
+
+    def stop(self):
+        pass
+
+
+def make_wheel(clock, slots=8):
+    wheel = timingwheel.TimingWheel(tick_seconds=0.1, slots=slots, clock=clock)
+    wheel.ticker = ManualTicker()
+    return wheel
+
+
+def test_fires_after_the_delay_at_most_one_tick_late():
+    clock = FakeClock()
+    wheel = make_wheel(clock)
+    fired = []
+    clock.now += 0.05
+    wheel.call_later(0.3, lambda: fired.append(clock.now))
+    for _ in range(3):
+        clock.now += 0.1
+        wheel.tick()
+    assert fired == []
+    clock.now += 0.1
+    wheel.tick()
+    assert len(fired) == 1
+    assert 0.3 <= fired[0] - 1000.05 < 0.41
+    assert len(wheel) == 0
+    assert wheel.expired == 1
+
+
+def test_missed_ticks_are_caught_up_in_one_call():
+    clock = FakeClock()
+    wheel = make_wheel(clock)
+    fired = []
+    wheel.call_later(0.3, lambda: fired.append('short'))
+    wheel.call_later(1.0, lambda: fired.append('long'))
+    # the IOLoop was blocked: one call of tick for far more than one tick of time
+    clock.now += 0.55
+    wheel.tick()
+    assert fired == ['short']
+    clock.now += 0.5
+    wheel.tick()
+    assert fired == ['short', 'long']
+
+
+def test_timeouts_longer_than_a_turn_and_lag_longer_than_a_turn():
+    clock = FakeClock()
+    wheel = make_wheel(clock, slots=8)
+    fired = []
+    wheel.call_later(2.0, lambda: fired.append(2.0))
+    wheel.call_later(5.0, lambda: fired.append(5.0))
+    clock.now += 1.9
+    wheel.tick()
+    assert fired == []
+    clock.now += 0.2
+    wheel.tick()
+    assert fired == [2.0]
+    clock.now += 10
+    wheel.tick()
+    assert fired == [2.0, 5.0]
+
+
+def test_cancel():
+    clock = FakeClock()
+    wheel = make_wheel(clock)
+    fired = []
+    timeout = wheel.call_later(0.2, lambda: fired.append(1))
+    wheel.cancel(timeout)
+    wheel.cancel(timeout)
+    clock.now += 1
+    wheel.tick()
+    assert fired == []
+    assert len(wheel) == 0
+
+
+def test_with_timeout_on_a_busy_ioloop():
+    wheel = timingwheel.TimingWheel(tick_seconds=0.05)
+
+    def block():
+        time.sleep(0.12)
+
+    @tornado.gen.coroutine
+    def run():
+        blocker = tornado.ioloop.PeriodicCallback(block, 10)
+        blocker.start()
+        started = time.monotonic()
+        try:
+            yield wheel.with_timeout(0.5, tornado.gen.Future())
+        except tornado.gen.TimeoutError:
+            pass
+        blocker.stop()
+        return time.monotonic() - started
+
+    elapsed = tornado.ioloop.IOLoop.current().run_sync(run)
+    assert 0.5 <= elapsed < 0.9
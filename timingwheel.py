@@ -0,0 +1,153 @@
+"""
+Coarse timeouts for many waiters: a hashed timing wheel driven by one periodic callback.
+
+The IOLoop keeps its timeouts in a heap, so each of them costs O(log n) to add and cancelled ones
+stay in the heap until they are due. The wheel instead puts every timeout into the slot of the tick
+it expires in, so arming and cancelling are O(1) dict operations, and all timeouts of a tick
+expire together. Timeouts fire up to one tick late, which does not matter for long-polls.
+"""
+
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+
+class WheelTimeout(object):
+    """
+    Handle of a timeout armed on a TimingWheel, to cancel it
+    """
+
+    __slots__ = ('callback', 'slot', 'deadline')
+
+    def __init__(self, callback, slot, deadline):
+        self.callback = callback
+        self.slot = slot
+        """
+        dict of the wheel the timeout is in, None once it expired or was cancelled
+        """
+        self.deadline = deadline
+        """
+        number of the tick the timeout expires at, counted from the origin of the wheel
+        """
+
+
+class TimingWheel(object):
+    """
+    Calls callbacks after a delay, rounded up to whole ticks.
+
+    The wheel only ticks while timeouts are armed, so an idle server is not woken up. Ticks are
+    counted from the clock rather than from the calls of tick: when the IOLoop is busy, the periodic
+    callback skips runs, and the next run then expires the timeouts of all the ticks it missed.
+    """
+
+    def __init__(self, tick_seconds=0.1, slots=512, clock=time.monotonic):
+        """
+        :param tick_seconds: resolution of the timeouts
+        :param slots: number of slots; timeouts further than tick_seconds * slots seconds stay in their
+                      slot for more than one turn of the wheel
+        :param clock: function returning the current time in seconds
+        """
+        self.tick_seconds = tick_seconds
+        self.slots = [{} for _ in range(slots)]
+        """
+        armed WheelTimeouts per slot, as dicts of the timeouts to None, to remove them in O(1)
+        """
+        self.clock = clock
+        self.origin = clock()
+        self.position = 0
+        """
+        number of the last tick processed, counted from the origin
+        """
+        self.armed = 0
+        self.expired = 0
+        """
+        number of timeouts that have expired so far
+        """
+        self.ticker = None
+
+    def __len__(self):
+        return self.armed
+
+    def current_tick(self):
+        """
+        :return: number of the tick the clock is in, counted from the origin
+        """
+        return int((self.clock() - self.origin) // self.tick_seconds)
+
+    def call_later(self, delay_seconds, callback):
+        """
+        Calls callback after at least delay_seconds, at most one tick more
+        :return: WheelTimeout to pass to cancel
+        """
+        if self.ticker is None:
+            # nothing is armed, so there are no missed ticks to process
+            self.position = self.current_tick()
+        deadline = -int(-(self.clock() - self.origin + delay_seconds) // self.tick_seconds)
+        deadline = max(deadline, self.position + 1)
+        slot = self.slots[deadline % len(self.slots)]
+        timeout = WheelTimeout(callback, slot, deadline)
+        slot[timeout] = None
+        self.armed += 1
+        if self.ticker is None:
+            self.ticker = tornado.ioloop.PeriodicCallback(self.tick, self.tick_seconds * 1000)
+            self.ticker.start()
+        return timeout
+
+    def cancel(self, timeout):
+        """
+        Cancels the timeout, if it has neither expired nor been cancelled already
+        """
+        if timeout.slot is not None:
+            del timeout.slot[timeout]
+            timeout.slot = None
+            self.armed -= 1
+
+    def tick(self):
+        """
+        Processes the slots of all ticks up to the current one and calls the callbacks of the
+        timeouts that expired
+        """
+        last = self.position
+        target = self.current_tick()
+        if target <= last:
+            return
+        self.position = target
+        due = []
+        # after a full turn all slots have been looked at, however many ticks were missed
+        for number in range(last + 1, min(target, last + len(self.slots)) + 1):
+            slot = self.slots[number % len(self.slots)]
+            expired = [timeout for timeout in slot if timeout.deadline <= target]
+            for timeout in expired:
+                del slot[timeout]
+                timeout.slot = None
+            due.extend(expired)
+        self.armed -= len(due)
+        self.expired += len(due)
+        if not self.armed and self.ticker is not None:
+            self.ticker.stop()
+            self.ticker = None
+        for timeout in due:
+            timeout.callback()
+
+    def with_timeout(self, timeout_seconds, future):
+        """
+        Like tornado.gen.with_timeout, but on the wheel
+        :return: Future resolved like future, or failing with tornado.gen.TimeoutError after timeout_seconds
+        """
+        result = tornado.concurrent.Future()
+        tornado.concurrent.chain_future(future, result)
+        if result.done():
+            return result
+        if timeout_seconds <= 0:
+            result.set_exception(tornado.gen.TimeoutError('Timeout'))
+            return result
+
+        def expire():
+            if not result.done():
+                result.set_exception(tornado.gen.TimeoutError('Timeout'))
+
+        timeout = self.call_later(timeout_seconds, expire)
+        result.add_done_callback(lambda _: self.cancel(timeout))
+        return result
@@ -1,26 +1,289 @@
+#!/usr/bin/env python3
+"""Analyses battleships.log
 
+Reconstructs the games, the feedback mode of every player, the time players take for their
+turns (from the /waitforturn or /shootandwait response telling them it is their turn until their
+next /putcoord or /shootandwait) and the response times per endpoint. The log is split into chunks
+processed in parallel.
+
+Turn and response times need the structured (JSON Lines) log; for logs in the text format
+only games, feedback modes and request counts are reported.
+
+With --state, the results and the position in the log are saved, so that running again
+on the grown log only processes what has been appended since.
+
+Usage:
+  turnextract.py [options] LOGFILE
+
+Options:
+  -h, --help                  Show this screen.
+  -j NUMBER, --jobs=NUMBER    Number of processes, number of cores if 0 [default: 0]
+  -c MB, --chunk-size=MB      Size of the chunks the log is split into, in megabytes [default: 32]
+  -s FILE, --state=FILE       File keeping the results and position to continue from
+  --per-player                Report the turn times of every player
+"""
+
+import array
+import collections
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import pickle
 import re
-import sys
 import urllib.parse
 
-if __name__ == '__main__':
-    with open(sys.argv[1]) as f:
-        last_player = None
-        for line in f:
-            match = re.match(r"^\d+\.\d+:INFO:battleships-web:main:POST-LOG: b'(.*)'$", line)
-            if match:
-                query = urllib.parse.parse_qs(match.group(1))
-                if "feedback" in query:
-                    print(query['feedback'][0])
-                    human_player = query['token'][0]
+from docopt import docopt
+
+TEXT_LINE = re.compile(rb"^(\d+\.\d+):(\w+):[^:]*:[^:]*:(.*)$")
+REQUEST_MESSAGE = re.compile(r"^Request: (\w+) (\S+) (\d+)$")
+MATCHING_MESSAGE = re.compile(r"^Matching players (\w+) and (\w+)$")
+POST_LOG_MESSAGE = re.compile(r"^POST-LOG: b'(.*)'$")
+
+# only lines containing one of these can be of interest, the others are skipped without parsing
+INTERESTING = (b'Request: ', b'Matching players', b'POST-LOG: ')
+
+PERCENTILES = (50, 95, 99)
 
-            match = re.match(r"^(\d+\.\d+):DEBUG:battleships-web:main:PutCoord: (.*)$", line)
-            if match:
-                last_player = urllib.parse.parse_qs(match.group(2))['token'][0]
 
-            match = re.match(r"^(\d+\.\d+):DEBUG:battleships-web:main:Response: .*canPlay.*$", line)
+class ChunkResult(object):
+    """
+    What was found in one chunk of the log
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.request_counts = collections.Counter()
+        """
+        number of requests per (path, status)
+        """
+        self.durations = collections.defaultdict(lambda: array.array('d'))
+        """
+        response times per path
+        """
+        self.turn_events = []
+        """
+        list of (time, token, is_turn_start) in log order
+        """
+        self.games = []
+        """
+        list of (time, token, token)
+        """
+        self.feedback = {}
+        """
+        feedback mode per token
+        """
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['durations'] = dict(self.durations)
+        return state
+
+    def __setstate__(self, state):
+        durations = state.pop('durations')
+        self.__dict__.update(state)
+        self.durations = collections.defaultdict(lambda: array.array('d'), durations)
+
+    def add_message(self, time, message):
+        match = MATCHING_MESSAGE.match(message)
+        if match:
+            self.games.append((time, match.group(1), match.group(2)))
+            return
+        match = POST_LOG_MESSAGE.match(message)
+        if match:
+            query = urllib.parse.parse_qs(match.group(1))
+            if 'feedback' in query and 'token' in query:
+                self.feedback[query['token'][0]] = query['feedback'][0]
+            return
+        match = REQUEST_MESSAGE.match(message)
+        if match:
+            self.request_counts[(match.group(2), int(match.group(3)))] += 1
+
+    def add_request(self, record):
+        path = record['path']
+        self.request_counts[(path, record['status'])] += 1
+        self.durations[path].append(record['duration'])
+        token = record.get('token')
+        if path in ('/putcoord', '/shootandwait'):
+            # the time of the record is when the response was sent
+            self.turn_events.append((record['time'] - record['duration'], token, False))
+        if path in ('/waitforturn', '/shootandwait') and record.get('gamestate') == 'canPlay':
+            self.turn_events.append((record['time'], token, True))
+
+    def add_line(self, line):
+        self.lines += 1
+        if not any(interesting in line for interesting in INTERESTING):
+            return
+        if line.startswith(b'{'):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return
+            if 'path' in record and 'duration' in record:
+                self.add_request(record)
+            else:
+                self.add_message(record['time'], record.get('message', ''))
+        else:
+            match = TEXT_LINE.match(line)
             if match:
-                this_time = float(match.group(1))
-                if last_player is not None and last_player == human_player:
-                    print(last_player, "took", this_time - last_time)
-                last_time = this_time
+                self.add_message(float(match.group(1)), match.group(3).decode('utf-8', 'replace'))
+
+
+def process_chunk(args):
+    """
+    :param args: tuple (path, start, end); the lines starting in [start, end) are processed
+    :return: ChunkResult
+    """
+    (path, start, end) = args
+    result = ChunkResult()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if start > 0 and mm[start - 1:start] != b'\n':
+            # the line starting before this chunk belongs to the previous one
+            newline = mm.find(b'\n', start)
+            start = end if newline == -1 else newline + 1
+        position = start
+        while position < end:
+            newline = mm.find(b'\n', position)
+            if newline == -1:
+                break
+            result.add_line(mm[position:newline])
+            position = newline + 1
+    return result
+
+
+def complete_lines_end(path, size):
+    """
+    :return: offset after the last newline of the file, so that a line still being written is not read
+    """
+    with open(path, 'rb') as f:
+        position = size
+        while position > 0:
+            block_start = max(0, position - 65536)
+            f.seek(block_start)
+            block = f.read(position - block_start)
+            newline = block.rfind(b'\n')
+            if newline != -1:
+                return block_start + newline + 1
+            position = block_start
+    return 0
+
+
+class Analysis(object):
+    """
+    Results accumulated over all processed chunks, possibly over several runs
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.total = ChunkResult()
+        self.turn_times = collections.defaultdict(lambda: array.array('d'))
+        """
+        turn times per token
+        """
+        self.turn_started = {}
+        """
+        time the current turn started per token, for players who have not shot yet
+        """
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['turn_times'] = dict(self.turn_times)
+        return state
+
+    def __setstate__(self, state):
+        turn_times = state.pop('turn_times')
+        self.__dict__.update(state)
+        self.turn_times = collections.defaultdict(lambda: array.array('d'), turn_times)
+
+    def merge(self, result):
+        """
+        :param result: ChunkResult of the chunk following all merged ones
+        """
+        total = self.total
+        total.lines += result.lines
+        total.request_counts.update(result.request_counts)
+        for (path, durations) in result.durations.items():
+            total.durations[path].extend(durations)
+        total.games.extend(result.games)
+        total.feedback.update(result.feedback)
+        for (time, token, is_turn_start) in result.turn_events:
+            if is_turn_start:
+                self.turn_started[token] = time
+            elif token in self.turn_started:
+                self.turn_times[token].append(time - self.turn_started.pop(token))
+
+    def process(self, path, jobs, chunk_size):
+        end = complete_lines_end(path, os.path.getsize(path))
+        if end < self.offset:
+            raise SystemExit('%s is shorter than when it was last processed' % path)
+        chunks = [(path, start, min(start + chunk_size, end)) for start in range(self.offset, end, chunk_size)]
+        if len(chunks) > 1 and jobs != 1:
+            with multiprocessing.Pool(jobs or None) as pool:
+                for result in pool.imap(process_chunk, chunks):
+                    self.merge(result)
+        else:
+            for chunk in chunks:
+                self.merge(process_chunk(chunk))
+        self.offset = end
+
+
+def percentiles(values):
+    """
+    :return: list of the PERCENTILES of values using the nearest-rank method
+    """
+    ordered = sorted(values)
+    return [ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] for p in PERCENTILES]
+
+
+def format_distribution(name, values):
+    if not values:
+        return '  %-24s %8d' % (name, 0)
+    return '  %-24s %8d  ' % (name, len(values)) + '  '.join(
+        'p%d %8.3fs' % (p, value) for (p, value) in zip(PERCENTILES, percentiles(values)))
+
+
+def report(analysis, per_player):
+    total = analysis.total
+    lines = ['%d lines, %d games, %d players with known feedback mode' %
+             (total.lines, len(total.games), len(total.feedback))]
+
+    lines.append('')
+    lines.append('Requests (path, status: count)')
+    for ((path, status), count) in sorted(total.request_counts.items()):
+        lines.append('  %-24s %3d %8d' % (path, status, count))
+
+    lines.append('')
+    lines.append('Response times')
+    for (path, durations) in sorted(total.durations.items()):
+        lines.append(format_distribution(path, durations))
+
+    lines.append('')
+    lines.append('Turn times')
+    all_turn_times = [t for turn_times in analysis.turn_times.values() for t in turn_times]
+    lines.append(format_distribution('all players', all_turn_times))
+    by_feedback = collections.defaultdict(list)
+    for (token, turn_times) in analysis.turn_times.items():
+        by_feedback[total.feedback.get(token, 'unknown')].extend(turn_times)
+    for (feedback, turn_times) in sorted(by_feedback.items()):
+        lines.append(format_distribution('%s feedback' % feedback, turn_times))
+    if per_player:
+        for (token, turn_times) in sorted(analysis.turn_times.items()):
+            lines.append(format_distribution(token, turn_times))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    state_path = args['--state']
+    analysis = Analysis()
+    if state_path and os.path.exists(state_path):
+        with open(state_path, 'rb') as f:
+            analysis = pickle.load(f)
+
+    analysis.process(args['LOGFILE'], int(args['--jobs']), int(float(args['--chunk-size']) * 1024 * 1024))
+    if state_path:
+        with open(state_path, 'wb') as f:
+            pickle.dump(analysis, f)
+
+    print(report(analysis, args['--per-player']))